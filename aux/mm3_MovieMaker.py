@@ -9,7 +9,6 @@ import inspect
 import argparse
 import yaml
 import traceback
-import glob
 import math
 import subprocess as sp
 import numpy as np
@@ -223,27 +222,33 @@ if __name__ == "__main__":
             'green': p['moviemaker']['gr_max'],
             'red': p['moviemaker']['rd_max']}
 
-    # find FOV list
-    fov_list = [] # list will hold integers which correspond to FOV ids
-    fov_images = glob.glob(os.path.join(TIFF_dir,'*.tif'))
-    for image_name in fov_images:
-        # add FOV number from filename to list
-        fov_list.append(int(image_name.split('xy')[1].split('.tif')[0]))
+    # number of processes for reading headers of new images into the manifest
+    if namespace.nproc:
+        num_analyzers = namespace.nproc
+    else:
+        num_analyzers = p['num_analyzers']
 
-    # sort and remove duplicates
-    fov_list = sorted(list(set(fov_list)))
+    # find FOV list from the raw image manifest
+    manifest = mm3.update_raw_manifest(num_analyzers)
+    fov_list = np.unique(manifest['fov']).tolist() # list holds integers which correspond to FOV ids
     mm3.information('Found %d FOVs to process.' % len(fov_list))
 
+    # the manifest excludes the end time point, image_end is included
+    if image_end:
+        t_end = image_end + 1
+    else:
+        t_end = None
+
     # start the movie making
     for fov in fov_list: # for every FOV
         # skip fov if not in the group
         if user_spec_fovs and fov not in user_spec_fovs:
             continue
 
-        # grab the images for this fov
-        images = glob.glob(os.path.join(TIFF_dir, '*xy%03d*.tif' % (fov)))
-        if len(images) == 0:
-            images = glob.glob(os.path.join(TIFF_dir, '*xy%02d*.tif' % (fov))) # for filenames with 2 digit FOV
+        # grab the images for this fov in time order, skipping images not specified by param file.
+        image_idx = mm3.query_raw_manifest(manifest, [fov], image_start or None, t_end)
+        images = [os.path.join(TIFF_dir, filename) for filename in manifest['filename'][image_idx]]
+        image_times = manifest['t'][image_idx]
         if len(images) == 0:
             raise ValueError("No images found to export for FOV %d." % fov)
         mm3.information("Found %d files to export." % len(images))
@@ -287,14 +292,7 @@ if __name__ == "__main__":
         pipe = sp.Popen(command, stdin=sp.PIPE)
 
         # display a frame and send it to write
-        for img in images:
-            # skip images not specified by param file.
-            t = mm3.get_time(img)
-            if image_start and t < image_start:
-                continue
-            if image_end and t > image_end:
-                continue
-
+        for img, t in zip(images, image_times):
             image_data = tiff.imread(img) # get the image
 
             if len(image_data.shape) > 2:
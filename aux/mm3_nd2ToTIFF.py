@@ -17,9 +17,12 @@ try:
 except:
     import pickle
 import numpy as np
+import h5py
 from skimage.external import tifffile as tiff
 import pims_nd2
 import warnings
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
 # user modules
 # realpath() will make your script run, even if you symlink it
@@ -38,6 +41,285 @@ if mm3_dir not in sys.path:
 # this is the mm3 module with all the useful functions and classes
 import mm3_helpers as mm3
 
+### functions
+# names of the TIFF files written for one time point and FOV
+def nd2_frame_filenames(file_prefix, t, fov, vertical_crop=False, number_of_rows=1):
+    '''Returns the list of TIFF file names which are saved for one time point of one FOV.
+    Two files are made when two rows of channels are cropped out of the image.
+    '''
+    if vertical_crop and number_of_rows == 2:
+        return [file_prefix + "_t%04dxy%02d_1.tif" % (t, fov),
+                file_prefix + "_t%04dxy%02d_2.tif" % (t, fov)]
+    else:
+        return [file_prefix + "_t%04dxy%02d.tif" % (t, fov)]
+
+# pull the image and metadata for one time point out of the nd2
+def read_nd2_frame(nd2f, t, fov, starttime, planes):
+    '''Reads one time point for the FOV currently set in nd2f.default_coords.
+    The frame is only read once, both the pixel data and the metadata come from it.
+
+    Parameters
+    nd2f : pims_nd2.ND2_Reader
+        Opened nd2 file with the FOV already set.
+    t : int
+        Time point, 1 indexed like the TIFF names.
+    fov : int
+        FOV id used for output, 1 indexed.
+    starttime : float
+        Julian date of the start of the experiment.
+    planes : list of str
+        Names of the color planes.
+
+    Returns
+    image_data : np.ndarray
+    metadata_t : dict
+        Metadata which is saved as json in the TIFF description.
+    '''
+
+    # timepoint output name (1 indexed rather than 0 indexed)
+    t_id = t - 1
+    frame = nd2f[t_id]
+
+    # get time picture was taken
+    seconds = copy.deepcopy(frame.metadata['t_ms']) / 1000.
+    minutes = seconds / 60.
+    hours = minutes / 60.
+    days = hours / 24.
+    acq_time = starttime + days
+
+    # make dictionary which will be the metdata for this TIFF
+    # x and y are the physical location FOV on stage
+    metadata_t = { 'fov': fov,
+                   't' : t,
+                   'jd': acq_time,
+                   'x': frame.metadata['x_um'],
+                   'y': frame.metadata['y_um'],
+                   'planes': planes}
+
+    # copy the pixel data so the reader is free to reuse its buffer
+    image_data = np.array(frame)
+
+    return image_data, metadata_t
+
+# crop and save one time point of one FOV
+def save_nd2_frame(image_data, metadata_t, file_prefix, vertical_crop, number_of_rows,
+                   tif_compress, tif_dir):
+    '''Crops the image if specified and saves it as a TIFF with the metadata in the description.
+    Lots of flags for if there are double rows or multiple colors.
+
+    Returns
+    tif_filenames : list of str
+        The file names which were written.
+    '''
+
+    t = metadata_t['t']
+    fov = metadata_t['fov']
+    tif_filenames = nd2_frame_filenames(file_prefix, t, fov, vertical_crop, number_of_rows)
+    metadata_json = json.dumps(metadata_t)
+
+    # crop tiff if specified.
+    if vertical_crop:
+        # add extra axis to make below slicing simpler.
+        if len(image_data.shape) < 3:
+            image_data = np.expand_dims(image_data, axis=0)
+
+        # for just a simple crop
+        if number_of_rows == 1:
+            nc, H, W = image_data.shape
+            ylo = int(vertical_crop[0]*H)
+            yhi = int(vertical_crop[1]*H)
+            image_data = image_data[:, ylo:yhi, :]
+
+            # save the tiff
+            mm3.information('Saving %s.' % tif_filenames[0])
+            tiff.imsave(os.path.join(tif_dir, tif_filenames[0]), image_data, description=metadata_json, compress=tif_compress, photometric='minisblack')
+
+        # for dealing with two rows of channel
+        elif number_of_rows == 2:
+            # cut and save top row
+            image_data_one = image_data[:,vertical_crop[0][0]:vertical_crop[0][1],:]
+            mm3.information('Saving %s.' % tif_filenames[0])
+            tiff.imsave(os.path.join(tif_dir, tif_filenames[0]), image_data_one, description=metadata_json, compress=tif_compress, photometric='minisblack')
+
+            # cut and save bottom row
+            image_data_two = image_data[:,vertical_crop[1][0]:vertical_crop[1][1],:]
+            mm3.information('Saving %s.' % tif_filenames[1])
+            tiff.imsave(os.path.join(tif_dir, tif_filenames[1]), image_data_two, description=metadata_json, compress=tif_compress, photometric='minisblack')
+
+    else: # just save the image if no cropping was done.
+        mm3.information('Saving %s.' % tif_filenames[0])
+        tiff.imsave(os.path.join(tif_dir, tif_filenames[0]), image_data, description=metadata_json, compress=tif_compress, photometric='minisblack')
+
+    return tif_filenames
+
+# crop and add one time point to the raw HDF5 store of its FOV
+def save_nd2_frame_hdf5(h5f, image_data, metadata_t, vertical_crop):
+    '''Crops the image if specified and writes it to the opened raw HDF5 store.
+    Only one row of channels is supported.
+
+    Returns
+    frame_names : list of str
+        Name of the written frame, for reporting like the TIFF file names.
+    '''
+
+    if vertical_crop:
+        H = image_data.shape[-2]
+        ylo = int(vertical_crop[0]*H)
+        yhi = int(vertical_crop[1]*H)
+        image_data = image_data[..., ylo:yhi, :]
+
+    frame_name = 'xy%03d_raw.hdf5 t%04d' % (metadata_t['fov'], metadata_t['t'])
+    mm3.information('Saving %s.' % frame_name)
+    mm3.write_raw_hdf5_frame(h5f, image_data, metadata_t)
+
+    return [frame_name]
+
+# worker function for the multiprocessing extraction
+def extract_nd2_block(nd2_file, file_prefix, fov_ids, extraction_range, starttime, planes,
+                      vertical_crop, number_of_rows, tif_compress, tif_dir, max_pending=4,
+                      raw_format='TIFF'):
+    '''Extracts a block of FOVs and time points from an nd2 file to TIFF or the raw HDF5 store.
+    Each worker opens its own reader, so no file handle is shared between processes.
+    Compression and writing is done on a background thread so that it overlaps
+    with decoding the next frame from the nd2.
+
+    Parameters
+    fov_ids : list of int
+        Elements FOV indexes (0 indexed) to extract.
+    extraction_range : list of int
+        Time points (1 indexed) to extract.
+    max_pending : int
+        Number of frames which may wait to be written before decoding blocks.
+        Bounds memory use of the worker.
+    raw_format : str
+        'TIFF' or 'HDF5'. With 'HDF5' a block must hold all time points of its FOVs
+        which are extracted, as only one process may write a store.
+
+    Returns
+    tif_filenames : list of str
+        All file names (or frame names for HDF5) written by this worker.
+    '''
+
+    tif_filenames = []
+    writer = ThreadPool(1) # one thread is enough to hide the write behind the decode
+    pending = [] # async results of frames which are being written
+
+    h5f = None # store of the FOV being extracted, closed once its frames are written
+
+    # the writer is always closed and joined, so queued writes are finished and the
+    # thread does not leak when decoding raises
+    try:
+        with pims_nd2.ND2_Reader(nd2_file) as nd2f:
+            # this insures all colors will be saved when saving tiff
+            if len(planes) > 1:
+                nd2f.bundle_axes = [u'c', u'y', u'x']
+
+            for fov_id in fov_ids:
+                # fov_id is the fov index according to elements, fov is the output fov ID
+                fov = fov_id + 1
+
+                # set the FOV we are working on in the nd2 file object
+                nd2f.default_coords[u'm'] = fov_id
+
+                if raw_format == 'HDF5':
+                    h5f = h5py.File(mm3.get_raw_hdf5_path(fov), 'a')
+
+                for t in extraction_range:
+                    image_data, metadata_t = read_nd2_frame(nd2f, t, fov, starttime, planes)
+
+                    if raw_format == 'HDF5':
+                        pending.append(writer.apply_async(save_nd2_frame_hdf5,
+                                                          args=(h5f, image_data, metadata_t,
+                                                                vertical_crop)))
+                    else:
+                        pending.append(writer.apply_async(save_nd2_frame,
+                                                          args=(image_data, metadata_t, file_prefix,
+                                                                vertical_crop, number_of_rows,
+                                                                tif_compress, tif_dir)))
+
+                    # wait on the oldest write if too many frames are in memory
+                    if len(pending) >= max_pending:
+                        tif_filenames += pending.pop(0).get()
+
+                # the store can only be closed when all its frames are written
+                if raw_format == 'HDF5':
+                    for result in pending:
+                        tif_filenames += result.get()
+                    pending = []
+                    h5f.close()
+                    h5f = None
+
+        for result in pending:
+            tif_filenames += result.get()
+    finally:
+        writer.close()
+        writer.join()
+        if h5f is not None:
+            h5f.close()
+
+    return tif_filenames
+
+# split the extraction into blocks for the worker pool
+def make_nd2_extraction_blocks(fov_ids, extraction_range, n_workers):
+    '''Divides the work into blocks of one FOV and a contiguous range of time points.
+    When there are fewer FOVs than workers the time range of each FOV is split as well
+    so all workers have something to do.
+
+    Returns
+    blocks : list of tuples
+        Each tuple is ([fov_id], time_points).
+    '''
+
+    extraction_range = list(extraction_range)
+    if len(fov_ids) == 0 or len(extraction_range) == 0:
+        return []
+
+    n_time_blocks = int(math.ceil(float(n_workers) / len(fov_ids)))
+    block_size = int(math.ceil(float(len(extraction_range)) / n_time_blocks))
+
+    blocks = []
+    for fov_id in fov_ids:
+        for start in range(0, len(extraction_range), block_size):
+            blocks.append(([fov_id], extraction_range[start:start+block_size]))
+
+    return blocks
+
+# make sure everything that should have been extracted is on disk
+def check_nd2_extraction(file_prefix, fov_ids, extraction_range, vertical_crop,
+                         number_of_rows, tif_dir, raw_format='TIFF'):
+    '''Checks that a TIFF, or a frame in the raw HDF5 store, exists for every FOV and
+    time point which was to be extracted.
+
+    Returns
+    missing : list of str
+        File names (or frame names for HDF5) which were not found.
+    '''
+
+    missing = []
+
+    if raw_format == 'HDF5':
+        for fov_id in fov_ids:
+            raw_path = mm3.get_raw_hdf5_path(fov_id + 1)
+            saved_times = []
+            if os.path.isfile(raw_path):
+                with h5py.File(raw_path, 'r') as h5f:
+                    if 't' in h5f:
+                        saved_times = h5f['t'][:].tolist()
+
+            missing += ['xy%03d_raw.hdf5 t%04d' % (fov_id + 1, t) for t in extraction_range
+                        if t not in saved_times]
+
+        return missing
+
+    for fov_id in fov_ids:
+        for t in extraction_range:
+            for tif_filename in nd2_frame_filenames(file_prefix, t, fov_id + 1,
+                                                    vertical_crop, number_of_rows):
+                if not os.path.isfile(os.path.join(tif_dir, tif_filename)):
+                    missing.append(tif_filename)
+
+    return missing
+
 ### Main script
 if __name__ == "__main__":
     '''
@@ -51,6 +333,8 @@ if __name__ == "__main__":
                         required=True, help='Yaml file containing parameters.')
     parser.add_argument('-o', '--fov',  type=str,
                         required=False, help='List of fields of view to analyze. Input "1", "1,2,3", or "1-3", etc.')
+    parser.add_argument('-j', '--nproc',  type=int,
+                        required=False, help='Number of processors to use. More than 1 extracts FOVs in parallel.')
     namespace = parser.parse_args()
 
     # Load the project parameters file
@@ -71,6 +355,12 @@ if __name__ == "__main__":
     else:
         user_spec_fovs = []
 
+    # number of processes for extraction. Default is the old serial extraction.
+    if namespace.nproc:
+        n_workers = namespace.nproc
+    else:
+        n_workers = 1
+
     # number of rows of channels. Used for cropping.
     number_of_rows = p['nd2ToTIFF']['number_of_rows']
 
@@ -90,6 +380,14 @@ if __name__ == "__main__":
     # number between 0 and 9, 0 is no compression, 9 is most compression.
     tif_compress = p['nd2ToTIFF']['tiff_compress']
 
+    # write TIFFs or go straight to the chunked HDF5 raw store
+    raw_format = p['raw_format']
+    if raw_format == 'HDF5':
+        mm3.information('Extracting to the HDF5 raw store rather than TIFFs.')
+        if number_of_rows == 2:
+            mm3.warning('Two rows of channels are not supported with raw_format HDF5. Use TIFF.')
+            sys.exit()
+
     # set up image and analysis folders if they do not already exist
     if not os.path.exists(p['TIFF_dir']):
         os.makedirs(p['TIFF_dir'])
@@ -142,86 +440,78 @@ if __name__ == "__main__":
             extraction_range = range(p['nd2ToTIFF']['image_start'],
                                      p['nd2ToTIFF']['image_end']+1)
 
-            # loop through time points
-            for t in extraction_range:
-                # timepoint output name (1 indexed rather than 0 indexed)
-                t_id = t - 1
-                # set counter for FOV output name
-                #fov = fov_naming_start
-
-                for fov_id in range(0, nd2f.sizes[u'm']): # for every FOV
-                    # fov_id is the fov index according to elements, fov is the output fov ID
-                    fov = fov_id + 1
-
-                    # skip FOVs as specified above
-                    if len(user_spec_fovs) > 0 and not (fov in user_spec_fovs):
-                        continue
-
-                    # set the FOV we are working on in the nd2 file object
-                    nd2f.default_coords[u'm'] = fov_id
-
-                    # get time picture was taken
-                    seconds = copy.deepcopy(nd2f[t_id].metadata['t_ms']) / 1000.
-                    minutes = seconds / 60.
-                    hours = minutes / 60.
-                    days = hours / 24.
-                    acq_time = starttime + days
-
-                    # get physical location FOV on stage
-                    x_um = nd2f[t_id].metadata['x_um']
-                    y_um = nd2f[t_id].metadata['y_um']
-
-                    # make dictionary which will be the metdata for this TIFF
-                    metadata_t = { 'fov': fov,
-                                   't' : t,
-                                   'jd': acq_time,
-                                   'x': x_um,
-                                   'y': y_um,
-                                   'planes': planes}
-                    metadata_json = json.dumps(metadata_t)
-
-                    # get the pixel information
-                    image_data = nd2f[t_id]
-
-                    # crop tiff if specified. Lots of flags for if there are double rows or  multiple colors
-                    if vertical_crop:
-                        # add extra axis to make below slicing simpler.
-                        if len(image_data.shape) < 3:
-                            image_data = np.expand_dims(image_data, axis=0)
-
-                        # for just a simple crop
-                        if number_of_rows == 1:
-
-                            nc, H, W = image_data.shape
-                            ylo = int(vertical_crop[0]*H)
-                            yhi = int(vertical_crop[1]*H)
-                            image_data = image_data[:, ylo:yhi, :]
-
-                            # save the tiff
-                            tif_filename = file_prefix + "_t%04dxy%02d.tif" % (t, fov)
-                            mm3.information('Saving %s.' % tif_filename)
-                            tiff.imsave(os.path.join(p['TIFF_dir'], tif_filename), image_data, description=metadata_json, compress=tif_compress, photometric='minisblack')
-
-                        # for dealing with two rows of channel
-                        elif number_of_rows == 2:
-                            # cut and save top row
-                            image_data_one = image_data[:,vertical_crop[0][0]:vertical_crop[0][1],:]
-                            tif_filename = file_prefix + "_t%04dxy%02d_1.tif" % (t, fov)
-                            mm3.information('Saving %s.' % tif_filename)
-                            tiff.imsave(os.path.join(p['TIFF_dir'], tif_filename), image_data_one, description=metadata_json, compress=tif_compress, photometric='minisblack')
-
-                            # cut and save bottom row
-                            metadata_t['fov'] = fov # update metdata
-                            metadata_json = json.dumps(metadata_t)
-                            image_data_two = image_data[:,vertical_crop[1][0]:vertical_crop[1][1],:]
-                            tif_filename = file_prefix + "_t%04dxy%02d_2.tif" % (t, fov)
-                            mm3.information('Saving %s.' % tif_filename)
-                            tiff.imsave(os.path.join(p['TIFF_dir'], tif_filename), image_data_two, description=metadata_json, compress=tif_compress, photometric='minisblack')
-
-                    else: # just save the image if no cropping was done.
-                        tif_filename = file_prefix + "_t%04dxy%02d.tif" % (t, fov)
-                        mm3.information('Saving %s.' % tif_filename)
-                        tiff.imsave(os.path.join(p['TIFF_dir'], tif_filename), image_data, description=metadata_json, compress=tif_compress, photometric='minisblack')
-
-                    # increase FOV counter
-                    fov += 1
+            # FOVs to extract, skipping FOVs as specified above.
+            # fov_id is the fov index according to elements, fov_id + 1 is the output fov ID
+            fov_ids = [fov_id for fov_id in range(0, nd2f.sizes[u'm'])
+                       if len(user_spec_fovs) == 0 or (fov_id + 1) in user_spec_fovs]
+
+            if n_workers == 1:
+                # raw stores are kept open for the whole file, keyed by fov_id
+                raw_h5fs = {}
+
+                # the stores are closed, and so flushed, even if extraction fails
+                try:
+                    # loop through time points
+                    for t in extraction_range:
+                        for fov_id in fov_ids: # for every FOV
+                            # set the FOV we are working on in the nd2 file object
+                            nd2f.default_coords[u'm'] = fov_id
+
+                            # get the pixel information and metadata
+                            image_data, metadata_t = read_nd2_frame(nd2f, t, fov_id + 1,
+                                                                    starttime, planes)
+
+                            if raw_format == 'HDF5':
+                                if fov_id not in raw_h5fs:
+                                    raw_h5fs[fov_id] = h5py.File(mm3.get_raw_hdf5_path(fov_id + 1), 'a')
+                                save_nd2_frame_hdf5(raw_h5fs[fov_id], image_data, metadata_t,
+                                                    vertical_crop)
+                            else:
+                                save_nd2_frame(image_data, metadata_t, file_prefix, vertical_crop,
+                                               number_of_rows, tif_compress, p['TIFF_dir'])
+                finally:
+                    for h5f in raw_h5fs.values():
+                        h5f.close()
+
+        # each worker opens its own reader, so this is done after the file is closed
+        if n_workers > 1:
+            if raw_format == 'HDF5':
+                # one block per FOV, a store cannot be written by two processes
+                blocks = make_nd2_extraction_blocks(fov_ids, extraction_range,
+                                                    min(n_workers, len(fov_ids)))
+            else:
+                blocks = make_nd2_extraction_blocks(fov_ids, extraction_range, n_workers)
+            mm3.information('Extracting %d blocks of FOVs and time points with %d processes.'
+                            % (len(blocks), n_workers))
+
+            # initialize pool for extraction
+            pool = Pool(n_workers)
+
+            block_results = []
+            for block_fov_ids, block_range in blocks:
+                block_results.append(pool.apply_async(extract_nd2_block,
+                                     args=(nd2_file, file_prefix, block_fov_ids, block_range,
+                                           starttime, planes, vertical_crop, number_of_rows,
+                                           tif_compress, p['TIFF_dir']),
+                                     kwds={'raw_format' : raw_format}))
+
+            pool.close() # tells the process nothing more will be added.
+            pool.join() # blocks script until everything has been processed and workers exit
+
+            for (block_fov_ids, block_range), result in zip(blocks, block_results):
+                if not result.successful():
+                    try:
+                        result.get()
+                    except Exception as e:
+                        mm3.warning('Extraction failed for FOVs %s, time points %d to %d: %s'
+                                    % (', '.join(str(fov_id + 1) for fov_id in block_fov_ids),
+                                       block_range[0], block_range[-1], e))
+
+        # final check that the output set is complete
+        missing = check_nd2_extraction(file_prefix, fov_ids, extraction_range, vertical_crop,
+                                       number_of_rows, p['TIFF_dir'], raw_format)
+        if missing:
+            mm3.warning('%d images were not extracted from %s, for example %s.'
+                        % (len(missing), file_prefix, missing[0]))
+        else:
+            mm3.information('All images extracted from %s.' % file_prefix)
@@ -9,7 +9,6 @@ import time
 import inspect
 import argparse
 import yaml
-import glob
 from pprint import pprint # for human readable file output
 try:
     import cPickle as pickle
@@ -26,7 +25,6 @@ plt.rcParams['axes.linewidth']=0.5
 
 from skimage.exposure import rescale_intensity # for displaying in GUI
 # from scipy.misc import imresize
-from PIL import Image
 from skimage.external import tifffile as tiff
 import multiprocessing
 from multiprocessing import Pool
@@ -89,7 +87,7 @@ def fov_plot_channels(fov_id, crosscorrs, specs, outputdir='.', phase_plane='c1'
             peak_xc = crosscorrs[fov_id][peak_id] # get cross corr data from dict
 
         # load data for figure
-        image_data = mm3.load_stack(fov_id, peak_id, color=phase_plane)
+        image_data = mm3.load_stack(fov_id, peak_id, color=phase_plane, frames=[0, -1])
 
         first_img = rescale_intensity(image_data[0,:,:]) # phase image at t=0
         last_img = rescale_intensity(image_data[-1,:,:]) # phase image at end
@@ -190,7 +188,7 @@ def fov_CNN_plot_channels(fov_id, predictionDict, specs, outputdir='.', phase_pl
             predictions = predictionDict[fov_id][peak_id] # get predictions array
 
         # load data for figure
-        image_data = mm3.load_stack(fov_id, peak_id, color=phase_plane)
+        image_data = mm3.load_stack(fov_id, peak_id, color=phase_plane, frames=[0, -1])
 
         first_img = rescale_intensity(image_data[0,:,:]) # phase image at t=0
         last_img = rescale_intensity(image_data[-1,:,:]) # phase image at end
@@ -550,7 +548,10 @@ def format_channel_plot(ax, peak_id):
 def preload_images(specs, fov_id_list):
     '''This dictionary holds the first and last image
     for all channels in all FOVS. It is passed to the UI so that the
-    figures can be populated much faster
+    figures can be populated much faster.
+
+    The thumbnails saved by mm3_Compile.py are used if they are there,
+    otherwise the two frames are read from each channel stack.
     '''
     global p
 
@@ -559,25 +560,85 @@ def preload_images(specs, fov_id_list):
 
     for fov_id in fov_id_list:
         mm3.information("Preloading images for FOV {}.".format(fov_id))
+        UI_images[fov_id] = mm3.load_channel_thumbnails(fov_id)
+        if UI_images[fov_id] is not None and set(specs[fov_id].keys()) <= set(UI_images[fov_id].keys()):
+            continue
+
         UI_images[fov_id] = {}
         for peak_id in specs[fov_id].keys():
-            image_data = mm3.load_stack(fov_id, peak_id, color=p['phase_plane'])
-            UI_images[fov_id][peak_id] = {'first' : None, 'last' : None} # init dictionary
-             # phase image at t=0. Rescale intenstiy and also cut the size in half
-            # old and new image size
-            first_image = p['channel_picker']['first_image']
-            img_size_old = image_data[first_image,:,:].shape
-            img_size_new = (int(img_size_old[1]/2), int(img_size_old[0]/2))
-
-            UI_images[fov_id][peak_id]['first'] = np.array(Image.fromarray(image_data[first_image,:,:]).resize(img_size_new))
-             # imresize(image_data[first_image,:,:], 0.5)
-            last_image = p['channel_picker']['last_image']
-            # phase image at end
-            UI_images[fov_id][peak_id]['last'] = np.array(Image.fromarray(image_data[last_image,:,:]).resize(img_size_new))
-             # imresize(image_data[last_image,:,:], 0.5)
+            # only read the two frames shown, and cut the size in half
+            first_image, last_image = mm3.get_thumbnail_frames()
+            image_data = mm3.load_stack(fov_id, peak_id, color=p['phase_plane'],
+                                        frames=[first_image, last_image])
+            image_data = mm3.downsample_images(image_data, 2)
+            UI_images[fov_id][peak_id] = {'first' : image_data[0], 'last' : image_data[1]}
 
     return UI_images
 
+# save PDF of a whole FOV drawn as one image, which is much faster than a subplot per channel
+def fov_montage_plot_channels(fov_id, specs, UI_images, scores=None, score_label='',
+                              score_limits=(0, 1), outputdir='.'):
+    '''
+    Plots the first images of all channels side by side, the last images colored by
+    their spec below, and a bar per channel with its score (cross correlation or CNN
+    prediction) at the bottom. The plot is saved in PDF format.
+
+    Parameters
+    fov_id : int
+    specs : dictionary
+        dictionary for channel assignment (Analyze/Don't Analyze/Background).
+    UI_images : dictionary
+        first and last images per fov and peak, from preload_images.
+    scores : dictionary
+        score per peak for this fov, or None.
+    '''
+
+    mm3.information("Plotting channels for FOV %d." % fov_id)
+
+    sorted_peaks = sorted(specs[fov_id].keys())
+    if not sorted_peaks:
+        mm3.information("No channels to plot for FOV %d." % fov_id)
+        return specs
+
+    first_montage, x_ranges = mm3.make_channel_montage([UI_images[fov_id][peak_id]['first'] for peak_id in sorted_peaks])
+    last_montage, x_ranges = mm3.make_channel_montage([UI_images[fov_id][peak_id]['last'] for peak_id in sorted_peaks])
+
+    # color the last images green for analyze, blue for reference and red for don't analyze
+    spec_colors = {1 : (0.1, 1, 0.1), 0 : (0.1, 0.1, 1)}
+    last_rgb = np.repeat(last_montage[:, :, np.newaxis], 3, axis=2)
+    for peak_id, (x_start, x_stop) in zip(sorted_peaks, x_ranges):
+        last_rgb[:, x_start:x_stop] *= spec_colors.get(specs[fov_id][peak_id], (1, 0.1, 0.1))
+
+    # first images on top of the last ones, with a gap between
+    gap = np.full((4,) + last_rgb.shape[1:], np.nan)
+    montage = np.concatenate((np.repeat(first_montage[:, :, np.newaxis], 3, axis=2), gap, last_rgb))
+    montage[np.isnan(montage)] = 1.0
+
+    width = max(montage.shape[1] / 40.0, 4)
+    fig, (ax_img, ax_score) = plt.subplots(2, 1, figsize=(width, 8), sharex=True,
+                                           gridspec_kw={'height_ratios' : [3, 1]})
+    ax_img.imshow(montage, interpolation='nearest', aspect='auto')
+    ax_img.set_yticks([first_montage.shape[0] / 2, first_montage.shape[0] + 4 + last_montage.shape[0] / 2])
+    ax_img.set_yticklabels(['first time point', 'last time point'])
+
+    x_centers = x_ranges.mean(axis=1)
+    if scores:
+        ax_score.bar(x_centers, [scores[peak_id] for peak_id in sorted_peaks],
+                     width=np.diff(x_ranges, axis=1)[:, 0])
+    ax_score.set_ylim(score_limits)
+    ax_score.set_ylabel(score_label)
+    ax_score.set_xticks(x_centers)
+    ax_score.set_xticklabels([str(peak_id) for peak_id in sorted_peaks], rotation=90, fontsize=6)
+    ax_score.set_xlim((0, montage.shape[1]))
+
+    fig.suptitle("FOV {:d}".format(fov_id), fontsize=14)
+    fileout = os.path.join(outputdir, 'fov_xy{:03d}.pdf'.format(fov_id))
+    fig.savefig(fileout, bbox_inches='tight', pad_inches=0)
+    plt.close(fig)
+    mm3.information("Written FOV {}'s channels in {}".format(fov_id, fileout))
+
+    return specs
+
 ### For when this script is run from the terminal ##################################
 if __name__ == "__main__":
     '''mm3_ChannelPicker.py allows the user to identify full and empty channels.
@@ -689,28 +750,24 @@ if __name__ == "__main__":
 
             mm3.information('Inferring good, empty, and defective traps on fov_id {} using CNN.'.format(fov_id))
 
-            # get list of tiff file names
-            tiff_file_names = glob.glob(os.path.join(chnl_dir, "*xy{:0=3}*_c1.tif".format(fov_id)))
-            tiff_file_names.sort()
-            #print(len(tiff_file_names)) # uncomment for debugging
-
-            # parameters to pass to custom image generator class, TrapKymographPredictionDataGenerator
-            cnn_params = {'dim': (210,256),
-                      'batch_size': 40,
-                      'n_classes': 4,
-                      'n_channels': 1,
-                      'shuffle': False}
-            # set up the image data generator
-            channel_image_generator = mm3.TrapKymographPredictionDataGenerator(tiff_file_names, **cnn_params)
-
-            # run the model
-            predictions = model.predict_generator(channel_image_generator)
-            #print(predictions.shape)
-            predictions = predictions[:len(tiff_file_names),:]
+            # centre column kymographs of the channels in peak order, saved by mm3_Compile.py
+            # when slicing. They are made from the channel stacks if they were not saved.
+            sorted_peaks = sorted(channel_masks[fov_id].keys())
+            fov_kymographs = mm3.load_channel_kymographs(fov_id)
+            if fov_kymographs is None:
+                fov_kymographs = {}
+            kymographs = [fov_kymographs[peak_id] if peak_id in fov_kymographs
+                          else mm3.make_channel_kymograph(fov_id, peak_id)
+                          for peak_id in sorted_peaks]
+
+            # run the model on all channels of the fov at once. The model takes
+            # 210 time points and 256 pixels along the channel.
+            X = mm3.make_kymograph_batch(kymographs, (210,256))
+            predictions = model.predict(X, batch_size=40)
             #print(predictions.shape)
 
             # assign each prediction to the proper fov_id, peak_id in predictions dict
-            for i,peak_id in enumerate(sorted(channel_masks[fov_id].keys())):
+            for i,peak_id in enumerate(sorted_peaks):
                 # put prediction array into dictionary
                 #print(i, peak_id) # uncomment for debugging
                 predictionDict[fov_id][peak_id] = predictions[i,:]
@@ -727,6 +784,10 @@ if __name__ == "__main__":
         # a nested dict to hold cross corrs per channel per fov.
         crosscorrs = {}
 
+        # one pool for the channels of all fovs. Channels done before (with the same
+        # images) are loaded from the cross correlation cache instead.
+        pool = Pool(p['num_analyzers'])
+
         # for each fov find cross correlations (sending to pull)
         for fov_id in fov_id_list:
             mm3.information("Calculating cross correlations for FOV %d." % fov_id)
@@ -734,13 +795,8 @@ if __name__ == "__main__":
             # nested dict keys are peak_ids and values are cross correlations
             crosscorrs[fov_id] = {}
 
-            # initialize pool for analyzing image metadata
-            pool = Pool(p['num_analyzers'])
-
             # find all peak ids in the current FOV
             for peak_id in sorted(channel_masks[fov_id].keys()):
-                mm3.information("Calculating cross correlations for peak %d." % peak_id)
-
                 # linear loop
                 # crosscorrs[fov_id][peak_id] = mm3.channel_xcorr(fov_id, peak_id)
 
@@ -748,12 +804,12 @@ if __name__ == "__main__":
                 crosscorrs[fov_id][peak_id] = pool.apply_async(mm3.channel_xcorr,
                                                                args=(fov_id, peak_id,))
 
-            mm3.information('Waiting for cross correlation pool to finish for FOV %d.' % fov_id)
+        mm3.information('Waiting for cross correlation pool to finish.')
 
-            pool.close() # tells the process nothing more will be added.
-            pool.join() # blocks script until everything has been processed and workers exit
+        pool.close() # tells the process nothing more will be added.
+        pool.join() # blocks script until everything has been processed and workers exit
 
-            mm3.information("Finished cross correlations for FOV %d." % fov_id)
+        mm3.information("Finished cross correlations.")
 
         # get results from the pool and put the results in the dictionary if succesful
         for fov_id, peaks in six.iteritems(crosscorrs):
@@ -848,13 +904,18 @@ if __name__ == "__main__":
         outputdir = os.path.join(ana_dir, "fovs")
         if not os.path.isdir(outputdir):
             os.makedirs(outputdir)
+        # each FOV is drawn as one image from the thumbnails
+        UI_images = preload_images(specs, fov_id_list)
         for fov_id in fov_id_list:
             if crosscorrs:
-                specs = fov_plot_channels(fov_id, crosscorrs, specs,
-                                          outputdir=outputdir, phase_plane=p['phase_plane'])
+                scores = {peak_id : xc['cc_avg'] if xc else 0 for peak_id, xc in six.iteritems(crosscorrs[fov_id])}
+                specs = fov_montage_plot_channels(fov_id, specs, UI_images, scores=scores,
+                                                  score_label='avg CC', score_limits=(0.8, 1),
+                                                  outputdir=outputdir)
             elif do_CNN:
-                specs = fov_CNN_plot_channels(fov_id, predictionDict, specs,
-                                              outputdir=outputdir, phase_plane=p['phase_plane'])
+                scores = {peak_id : predictions[0] for peak_id, predictions in six.iteritems(predictionDict[fov_id])}
+                specs = fov_montage_plot_channels(fov_id, specs, UI_images, scores=scores,
+                                                  score_label='p(good)', outputdir=outputdir)
 
     # Save out specs file in yaml format
     if not os.path.isfile(os.path.join(ana_dir, 'specs.yaml')):
@@ -22,7 +22,6 @@ except:
 import multiprocessing
 from multiprocessing import Pool
 import numpy as np
-import warnings
 import h5py
 
 from matplotlib import pyplot as plt
@@ -102,6 +101,39 @@ if __name__ == "__main__":
     else:
         t_start = None
 
+    # slice channels one frame at a time rather than loading the whole FOV into memory
+    if 'stream_slicing' in p['compile']:
+        stream_slicing = p['compile']['stream_slicing']
+    else:
+        stream_slicing = True
+
+    # number of processes and memory budget in GB for slicing FOVs in parallel.
+    # slicing_resume skips FOVs which were already sliced with the same images and masks.
+    if 'slicing_processes' in p['compile']:
+        slicing_processes = p['compile']['slicing_processes']
+    else:
+        slicing_processes = p['num_analyzers']
+    if 'slicing_memory_gb' in p['compile']:
+        slicing_memory_gb = p['compile']['slicing_memory_gb']
+        if slicing_memory_gb == 'None':
+            slicing_memory_gb = None
+    else:
+        slicing_memory_gb = None
+    if 'slicing_resume' in p['compile']:
+        slicing_resume = p['compile']['slicing_resume']
+    else:
+        slicing_resume = True
+
+    # also write the image metadata as text, which is slow for many images
+    if 'metadata_text' in p['compile']:
+        metadata_text = p['compile']['metadata_text']
+    else:
+        metadata_text = False
+
+    # channels are only looked for on the time points used for the masks, see mask_frame_sampling
+    if 'channel_detection_interval' in p['compile']:
+        mm3.warning('channel_detection_interval is not used anymore, set mask_frame_sampling instead.')
+
     # create the subfolders if they don't
     if not os.path.exists(p['ana_dir']):
         os.makedirs(p['ana_dir'])
@@ -119,49 +151,66 @@ if __name__ == "__main__":
     if not p['compile']['do_metadata']:
         mm3.information("Loading image parameters dictionary.")
 
-        with open(os.path.join(p['ana_dir'], 'TIFF_metadata.pkl'), 'rb') as tiff_metadata:
-            analyzed_imgs = pickle.load(tiff_metadata)
+    elif p['raw_format'] == 'HDF5':
+        mm3.information("Finding image parameters from the HDF5 raw store.")
+
+        if p['compile']['find_channels_method'] != 'peaks':
+            mm3.warning('Only the peaks channel finding method works with the HDF5 raw store.')
+            sys.exit()
+
+        # one raw store per FOV
+        found_files = glob.glob(os.path.join(p['TIFF_dir'], 'xy*_raw.hdf5'))
+        fov_ids = sorted([int(re.search('xy(\d+)_raw', filepath.split('/')[-1]).group(1))
+                          for filepath in found_files])
+
+        # if user has specified only certain FOVs, filter for those
+        if (len(user_spec_fovs) > 0):
+            fov_ids = [fov_id for fov_id in fov_ids if fov_id in user_spec_fovs]
+
+        if len(fov_ids) > 0:
+            mm3.information("Found %d FOVs in the raw store." % len(fov_ids))
+        else:
+            mm3.warning('No raw HDF5 files found')
+
+        # initialize pool for analyzing image metadata, one job per FOV
+        pool = Pool(p['num_analyzers'])
+        fov_results = {}
+        for fov_id in fov_ids:
+            fov_results[fov_id] = pool.apply_async(mm3.get_hdf5_raw_params,
+                                                   args=(fov_id, True))
+
+        pool.close() # tells the process nothing more will be added.
+        pool.join() # blocks script until everything has been processed and workers exit
+
+        for fov_id in fov_ids:
+            result = fov_results[fov_id]
+            if result.successful():
+                analyzed_imgs.update(result.get())
+            else:
+                mm3.warning('Failed to get image parameters for FOV %d.' % fov_id)
+
+        # keep images between t_start and t_end
+        for fn in list(analyzed_imgs.keys()):
+            t = analyzed_imgs[fn]['t']
+            if (t_start is not None and t < t_start) or (t_end is not None and t >= t_end):
+                del analyzed_imgs[fn]
 
     else:
         mm3.information("Finding image parameters.")
 
-        # get all the TIFFs in the folder
-        found_files = glob.glob(os.path.join(p['TIFF_dir'],'*.tif')) # get all tiffs
-        found_files = [filepath.split('/')[-1] for filepath in found_files] # remove pre-path
-        found_files = sorted(found_files) # should sort by timepoint
-
-        # keep images starting at this timepoint
+        # get the TIFFs in the folder from the raw image manifest, filtered by time and FOV
+        manifest = mm3.update_raw_manifest(p['num_analyzers'])
         if t_start is not None:
             mm3.information('Removing images before time {}'.format(t_start))
-            # go through list and find first place where timepoint is equivalent to t_start
-            for n, ifile in enumerate(found_files):
-                string = re.compile('t{:0=3}xy|t{:0=4}xy'.format(t_start,t_start)) # account for 3 and 4 digit
-                # if re.search == True then a match was found
-                if re.search(string, ifile):
-                    # cut off every file name prior to this one and quit the loop
-                    found_files = found_files[n:]
-                    break
-
-        # remove images after this timepoint
         if t_end is not None:
             mm3.information('Removing images after time {}'.format(t_end))
-            # go through list and find first place where timepoint is equivalent to t_end
-            for n, ifile in enumerate(found_files):
-                string = re.compile('t%03dxy|t%04dxy' % (t_end, t_end)) # account for 3 and 4 digit
-                if re.search(string, ifile):
-                    found_files = found_files[:n]
-                    break
-
-
-        # if user has specified only certain FOVs, filter for those
         if (len(user_spec_fovs) > 0):
             mm3.information('Filtering TIFFs by FOV.')
-            fitered_files = []
-            for fov_id in user_spec_fovs:
-                fov_string = 'xy%02d' % fov_id # xy01
-                fitered_files += [ifile for ifile in found_files if fov_string in ifile]
+        found_idx = mm3.query_raw_manifest(manifest, user_spec_fovs, t_start, t_end)
+        found_files = manifest['filename'][found_idx].tolist()
 
-            found_files = fitered_files[:]
+        # with mask_frame_sampling N, channels are only found on the images make_masks uses
+        detect_channels = dict(zip(found_files, mm3.is_mask_frame(manifest['t'][found_idx])))
 
         # get information for all these starting tiffs
         if len(found_files) > 0:
@@ -183,7 +232,7 @@ if __name__ == "__main__":
                 # analyzed_imgs[fn] = mm3.get_tif_params(fn, True)
 
                 # Parallelized
-                analyzed_imgs[fn] = pool.apply_async(mm3.get_tif_params, args=(fn, True))
+                analyzed_imgs[fn] = pool.apply_async(mm3.get_tif_params, args=(fn, detect_channels[fn]))
 
             mm3.information('Waiting for image analysis pool to be finished.')
 
@@ -204,19 +253,6 @@ if __name__ == "__main__":
             # Use Unet trained on trap and central channel locations to locate, crop, and align traps
             mm3.information("Identifying channel locations and aligning images using U-net.")
 
-            # load model to pass to algorithm
-            mm3.information("Loading model...")
-
-            if namespace.modelfile:
-                model_file_path = namespace.modelfile
-            else:
-                model_file_path = p['compile']['model_file_traps']
-            # *** Need parameter for weights
-            model = models.load_model(model_file_path,
-                                      custom_objects={'tversky_loss': mm3.tversky_loss,
-                                                      'cce_tversky_loss': mm3.cce_tversky_loss})
-            mm3.information("Model loaded.")
-
             # initialize pool for getting image metadata
             pool = Pool(p['num_analyzers'])
 
@@ -255,9 +291,48 @@ if __name__ == "__main__":
 
             unique_fov_ids = np.unique(fov_ids)
 
+            # pool for cropping and saving FOVs while the model works on the next one.
+            # It is started before the model is loaded so the workers do not get a copy of it.
+            n_croppers = min(slicing_processes, max(len(unique_fov_ids), 1))
+            if n_croppers > 1:
+                crop_pool = Pool(n_croppers)
+            else:
+                crop_pool = None
+            fov_crop_results = {}
+
+            # load model to pass to algorithm
+            mm3.information("Loading model...")
+
+            if namespace.modelfile:
+                model_file_path = namespace.modelfile
+            else:
+                model_file_path = p['compile']['model_file_traps']
+            # *** Need parameter for weights
+            model = models.load_model(model_file_path,
+                                      custom_objects={'tversky_loss': mm3.tversky_loss,
+                                                      'cce_tversky_loss': mm3.cce_tversky_loss})
+            mm3.information("Model loaded.")
+
             if p['compile']['do_channel_masks']:
                 channel_masks = {}
 
+            # number of frames to predict at once for alignment
+            if 'alignment_block_size' in p['compile']:
+                alignment_block_size = p['compile']['alignment_block_size']
+            else:
+                alignment_block_size = 60
+
+            # pixels the traps may move and still be cropped without reading the frame again
+            if 'trap_crop_margin' in p['compile']:
+                trap_crop_margin = p['compile']['trap_crop_margin']
+            else:
+                trap_crop_margin = 20
+            # keep the trap images on disk instead of in memory
+            if 'trap_crop_memmap' in p['compile']:
+                trap_crop_memmap = p['compile']['trap_crop_memmap']
+            else:
+                trap_crop_memmap = False
+
             for fov_id in unique_fov_ids:
 
                 mm3.information('Performing trap segmentation for fov_id: {}'.format(fov_id))
@@ -320,20 +395,12 @@ if __name__ == "__main__":
                     plt.title('Initial trap masks')
                     plt.show();
 
-                trap_labels = measure.label(traps)
-                trap_props = measure.regionprops(trap_labels)
-
-                trap_area_threshold = p['compile']['trap_area_threshold']
-                trap_bboxes = mm3.get_frame_trap_bounding_boxes(trap_labels,
-                                                                   trap_props,
-                                                                   trapAreaThreshold=trap_area_threshold,
-                                                                   trapWidth=trap_align_metadata['trap_width'],
-                                                                   trapHeight=trap_align_metadata['trap_height'])
-
                 # create boolean array to contain filtered, correctly-shaped trap bounding boxes
-                first_frame_trap_mask = np.zeros(traps.shape)
-                for i,bbox in enumerate(trap_bboxes):
-                    first_frame_trap_mask[bbox[0]:bbox[2],bbox[1]:bbox[3]] = True
+                trap_area_threshold = p['compile']['trap_area_threshold']
+                first_frame_trap_mask = mm3.make_frame_trap_mask(traps,
+                                                                 trapAreaThreshold=trap_area_threshold,
+                                                                 trapWidth=trap_align_metadata['trap_width'],
+                                                                 trapHeight=trap_align_metadata['trap_height'])
 
                 good_trap_labels = measure.label(first_frame_trap_mask)
                 good_trap_props = measure.regionprops(good_trap_labels)
@@ -346,20 +413,11 @@ if __name__ == "__main__":
                     plt.title('Dilated trap masks');
                     plt.show();
 
-                dilated_trap_labels = measure.label(dilated_traps)
-                dilated_trap_props = measure.regionprops(dilated_trap_labels)
                 # filter merged trap regions by area
-                areas = [reg.area for reg in dilated_trap_props]
-                labels = [reg.label for reg in dilated_trap_props]
-
-                for idx,area in enumerate(areas):
-                    if area < p['compile']['merged_trap_region_area_threshold']:
-
-                        label = labels[idx]
-                        dilated_traps[dilated_trap_labels == label] = 0
-
                 dilated_trap_labels = measure.label(dilated_traps)
-                dilated_trap_props = measure.regionprops(dilated_trap_labels)
+                dilated_traps = mm3.filter_labels_by_area(dilated_trap_labels,
+                                                          p['compile']['merged_trap_region_area_threshold']) > 0
+                dilated_trap_labels = measure.label(dilated_traps)
 
                 if p['debug']:
                     io.imshow(dilated_traps);
@@ -367,7 +425,7 @@ if __name__ == "__main__":
                     plt.show();
 
                 # get centroids for each "trap region" identified in first frame
-                centroids = np.round(np.asarray([reg.centroid for reg in dilated_trap_props]))
+                centroids = np.round(mm3.get_label_centroids(dilated_trap_labels))
                 if p['debug']:
                     print(centroids)
 
@@ -386,187 +444,98 @@ if __name__ == "__main__":
                 if p['debug']:
                     print(centroid)
 
-                # get the (frame_number,512,512,1)-sized stack for image aligment
-                align_region_stack = np.zeros((trap_align_metadata['frame_count'],512,512,1), dtype='uint16')
-
-                for frame,fn in enumerate(fov_file_names):
-                    imgPath = os.path.join(p['experiment_directory'],p['image_directory'],fn)
-                    frame_img = io.imread(imgPath)
-                    # detect if there are multiple imaging channels, and rearrange image if necessary, keeping only the phase image
-                    frame_img = mm3.permute_image(frame_img, trap_align_metadata)
-                    align_region_stack[frame,:,:,0] = frame_img[centroid[0]-256:centroid[0]+256,
-                                                             centroid[1]-256:centroid[1]+256]
-
-                # if p['debug']:
-                #     colNum = 10
-                #     fig,ax = plt.subplots(ncols=colNum, figsize=(20,20))
-
-                #     for pltIdx in range(colNum):
-                #         ax[pltIdx].imshow(align_region_stack[pltIdx*10,:,:,0])
+                good_trap_bboxes_dict = {}
+                for trap in good_trap_props:
+                    good_trap_bboxes_dict[trap.label] = trap.bbox
 
-                #     plt.title('Alignment stack images');
-                #     plt.show();
+                # windows around the traps are filled in while the frames are read for alignment, so every
+                # frame is only read once. They are uint16, and memory mapped when the crops are or when they
+                # go to the cropping pool
+                if trap_crop_memmap or crop_pool is not None:
+                    buffer_dir = os.path.join(p['ana_dir'], 'trap_buffers_xy%03d' % fov_id)
+                    if not os.path.exists(buffer_dir):
+                        os.makedirs(buffer_dir)
+                else:
+                    buffer_dir = None
+                trap_windows = mm3.make_trap_windows(good_trap_bboxes_dict, trap_crop_margin, img.shape,
+                                                     trap_align_metadata, buffer_dir=buffer_dir)
 
-                # run model on all frames
-                batch_size=p['compile']['channel_prediction_batch_size']
+                # predict traps in the (512,512) region of all frames, block by block, and follow them through time
                 mm3.information("Predicting trap regions for (512,512) slice through all frames.")
-
-                data_gen_args = {'batch_size':batch_size,
-                         'n_channels':1,
-                         'normalize_to_one':True,
-                         'shuffle':False}
-                predict_gen_args = {'verbose':1,
-                        'use_multiprocessing':True,
-                        'workers':p['num_analyzers']}
-
-                img_generator = mm3.TrapSegmentationDataGenerator(align_region_stack, **data_gen_args)
-
-                align_region_predictions = model.predict_generator(img_generator, **predict_gen_args)
-                #align_region_stack = mm3.apply_median_filter_and_normalize(align_region_stack)
-                #align_region_predictions = model.predict(align_region_stack, batch_size=batch_size)
-                # reduce dimensionality such that the class predictions are now (frame_number,512,512), and each voxel is labelled as the predicted region, i.e., 0=trap, 1=central trough, 2=background.
-                align_region_class_predictions = np.argmax(align_region_predictions, axis=3)
-
-                # if p['debug']:
-                #     colNum = 10
-                #     fig,ax = plt.subplots(ncols=colNum, figsize=(20,20))
-
-                #     for pltIdx in range(colNum):
-                #         ax[pltIdx].imshow(align_region_class_predictions[pltIdx*10,:,:])
-
-                #     plt.title('Alignment stack predictions');
-                #     plt.show();
-
-                # get boolean array where trap predictions are True
-                align_traps = align_region_class_predictions == 0
-
-                # if p['debug']:
-                #     colNum = 10
-                #     fig,ax = plt.subplots(ncols=colNum, figsize=(20,20))
-
-                #     for pltIdx in range(colNum):
-                #         ax[pltIdx].imshow(align_traps[pltIdx*10,:,:])
-
-                #     plt.title('Alignment trap masks');
-                #     plt.show();
-
-                # allocate array to store filtered traps over time
-                align_trap_mask_stack = np.zeros(align_traps.shape)
-                for frame in range(trap_align_metadata['frame_count']):
-
-                    frame_trap_labels = measure.label(align_traps[frame,:,:])
-                    frame_trap_props = measure.regionprops(frame_trap_labels)
-
-                    trap_bboxes = mm3.get_frame_trap_bounding_boxes(frame_trap_labels,
-                                                                    frame_trap_props,
-                                                                    trapAreaThreshold=trap_area_threshold,
-                                                                    trapWidth=trap_align_metadata['trap_width'],
-                                                                    trapHeight=trap_align_metadata['trap_height'])
-
-                    for i,bbox in enumerate(trap_bboxes):
-                        align_trap_mask_stack[frame,bbox[0]:bbox[2],bbox[1]:bbox[3]] = True
-
-                # if p['debug']:
-                #     colNum = 10
-                #     fig,ax = plt.subplots(ncols=colNum, figsize=(20,20))
-
-                #     for pltIdx in range(colNum):
-                #         ax[pltIdx].imshow(align_trap_mask_stack[pltIdx*10,:,:])
-
-                #     plt.title('Filtered alignment trap masks');
-                #     plt.show();
-
-                labelled_align_trap_mask_stack = measure.label(align_trap_mask_stack)
-
-                trapTriggered = False
-                for frame in range(trap_align_metadata['frame_count']):
-                    anyTraps = np.any(labelled_align_trap_mask_stack[frame,:,:] > 0)
-                    # if anyTraps is False, that means no traps were detected for this frame. This usuall occurs due to a bug in our imaging system,
-                    #    which can cause it to miss the occasional frame. Should be fine to snag labels from prior frame.
-                    if not anyTraps:
-                        trapTriggered = True
-                        mm3.information("Frame at index {} has no detected traps. Borrowing labels from an adjacent frame.".format(frame))
-                        if frame > 0:
-                            labelled_align_trap_mask_stack[frame,:,:] = labelled_align_trap_mask_stack[frame-1,:,:]
-                        else:
-                            labelled_align_trap_mask_stack[frame,:,:] = labelled_align_trap_mask_stack[frame+1,:,:]
-
-                if trapTriggered:
-                    repaired_align_trap_mask_stack = labelled_align_trap_mask_stack > 0
-                    labelled_align_trap_mask_stack = measure.label(repaired_align_trap_mask_stack)
-
-                align_trap_props = measure.regionprops(labelled_align_trap_mask_stack)
-
-                areas = np.array([trap.area for trap in align_trap_props])
-                labels = [trap.label for trap in align_trap_props]
-                good_align_trap_props = []
-                bad_align_trap_props = []
-                #mode_area = stats.mode(areas)[0]
-                expected_area = trap_align_metadata['trap_width'] * trap_align_metadata['trap_height'] * trap_align_metadata['frame_count']
+                shifts, align_trap_areas = mm3.get_alignment_shifts(fov_file_names, centroid, model,
+                                                                    trap_align_metadata,
+                                                                    block_size=alignment_block_size,
+                                                                    trap_windows=trap_windows)
 
                 if p['debug']:
-                    pprint(areas)
+                    expected_area = trap_align_metadata['trap_width'] * trap_align_metadata['trap_height'] * trap_align_metadata['frame_count']
+                    pprint(align_trap_areas)
                     print(expected_area)
 
-                    if not expected_area in areas:
-                        print("No trap has expected total area. Saving labelled masks for debugging as labelled_align_trap_mask_stack.tif")
-                        io.imsave("labelled_align_trap_mask_stack.tif", labelled_align_trap_mask_stack.astype('uint8'))
-                        io.imsave("masks.tif", align_traps.astype('uint8'))
+                    if not expected_area in align_trap_areas:
+                        print("No trap has expected total area.")
                         # occasionally our microscope misses an image, resulting in no traps for a single frame. This obviously messes up image alignment here....
 
-                for trap in align_trap_props:
-                    if trap.area != expected_area:
-                        bad_align_trap_props.append(trap.label)
-                    else:
-                        good_align_trap_props.append(trap)
-
-                for label in bad_align_trap_props:
-                    labelled_align_trap_mask_stack[labelled_align_trap_mask_stack == label] = 0
-
-                align_centroids = []
-                for frame in range(trap_align_metadata['frame_count']):
-                    align_centroids.append([reg.centroid for reg in measure.regionprops(labelled_align_trap_mask_stack[frame,:,:])])
-
-                align_centroids = np.asarray(align_centroids)
-                shifts = np.mean(align_centroids - align_centroids[0,:,:], axis=1)
                 integer_shifts = np.round(shifts).astype('int16')
 
-                good_trap_bboxes_dict = {}
-                for trap in good_trap_props:
-                    good_trap_bboxes_dict[trap.label] = trap.bbox
-
-                # pprint(good_trap_bboxes_dict) # uncomment for debugging
-                bbox_shift_dict = mm3.shift_bounding_boxes(good_trap_bboxes_dict, integer_shifts, img.shape[0])
-                # pprint(bbox_shift_dict) # uncomment for debugging
-
-                trap_images_fov_dict, trap_closed_end_px_dict = mm3.crop_traps(fov_file_names, good_trap_props, good_trap_labels, bbox_shift_dict, trap_align_metadata)
-
-                for fn in fov_file_names:
+                # crop the traps and save them, in the pool if there is one
+                fov_analyzed_imgs = {fn: analyzed_imgs[fn] for fn in fov_file_names}
+                if crop_pool is not None:
+                    for window in trap_windows.values():
+                        window['images'].flush()
+                    window_bboxes = {key: {'bbox': window['bbox']} for key, window in six.iteritems(trap_windows)}
+                    del trap_windows
+                    fov_crop_results[fov_id] = crop_pool.apply_async(mm3.crop_and_save_fov_traps,
+                                                    args=(fov_id, fov_file_names, fov_analyzed_imgs,
+                                                          good_trap_bboxes_dict, integer_shifts,
+                                                          img.shape[0], trap_align_metadata),
+                                                    kwds={'trapWindows': window_bboxes,
+                                                          'buffer_dir': buffer_dir})
+                else:
+                    fov_crop_results[fov_id] = mm3.crop_and_save_fov_traps(fov_id, fov_file_names, fov_analyzed_imgs,
+                                                    good_trap_bboxes_dict, integer_shifts,
+                                                    img.shape[0], trap_align_metadata,
+                                                    trapWindows=trap_windows, buffer_dir=buffer_dir)
+                    del trap_windows
+
+            if crop_pool is not None:
+                mm3.information('Waiting for trap cropping pool to be finished.')
+                crop_pool.close() # tells the process nothing more will be added.
+                crop_pool.join() # blocks script until everything has been processed and workers exit
+
+            # get the trap ends and channel masks from the results
+            for fov_id, result in six.iteritems(fov_crop_results):
+                if crop_pool is not None:
+                    if not result.successful():
+                        try:
+                            result.get()
+                        except Exception as e:
+                            mm3.warning('Cropping traps failed for FOV %d: %s' % (fov_id, e))
+                        continue
+                    result = result.get()
+                trap_closed_end_px_dict, fov_channel_masks = result
+
+                for fn in trap_closed_end_px_dict.keys():
                     analyzed_imgs[fn]['channels'] = trap_closed_end_px_dict[fn]
 
                 if p['compile']['do_channel_masks']:
-                    fov_channel_masks = mm3.make_channel_masks_CNN(bbox_shift_dict)
                     channel_masks[fov_id] = fov_channel_masks
                     # pprint(channel_masks) # uncomment for debugging
 
-                if p['compile']['do_slicing']:
-
-                    if p['output'] == "TIFF":
-
-                        with warnings.catch_warnings():
-                            warnings.simplefilter("ignore")
-                            mm3.save_tiffs(trap_images_fov_dict, analyzed_imgs, fov_id)
+    # metadata_columns is set here for every metadata source. For both raw formats the drift
+    # is found and the metadata saved. Metadata loaded from a previous run already has both
+    if not p['compile']['do_metadata']:
+        metadata_columns = mm3.load_tiff_metadata(as_columns=True)
+        analyzed_imgs = mm3.metadata_columns_to_dict(metadata_columns)
 
-                    elif p['output'] == "HDF5":
-                        # Or write it to hdf5
-                        mm3.save_hdf5(trap_images_fov_dict, fov_file_names, analyzed_imgs, fov_id, channel_masks)
+    else:
+        # find how much each image drifted from the first image of its FOV, used for the masks and slicing
+        if p['compile']['find_channels_method'] == 'peaks' and mm3.use_drift_correction():
+            analyzed_imgs = mm3.add_drift(analyzed_imgs)
 
-        # save metadata to a .pkl and a human readable txt file
+        # save metadata as columns to an hdf5 file, and optionally a human readable txt file
         mm3.information('Saving metadata from analyzed images...')
-        with open(os.path.join(p['ana_dir'], 'TIFF_metadata.pkl'), 'wb') as tiff_metadata:
-            pickle.dump(analyzed_imgs, tiff_metadata, protocol=pickle.HIGHEST_PROTOCOL)
-        with open(os.path.join(p['ana_dir'], 'TIFF_metadata.txt'), 'w') as tiff_metadata:
-            pprint(analyzed_imgs, stream=tiff_metadata)
+        metadata_columns = mm3.save_tiff_metadata(analyzed_imgs, text_dump=metadata_text)
 
         mm3.information('Saved metadata from analyzed images.')
 
@@ -574,7 +543,7 @@ if __name__ == "__main__":
     if not p['compile']['do_time_table']:
         mm3.information('Skipping time table creation.')
     else:
-        time_table = mm3.make_time_table(analyzed_imgs)
+        time_table = mm3.make_time_table(metadata_columns)
 
     ### Make consensus channel masks and get other shared metadata #################################
     if not p['compile']['do_channel_masks'] and p['compile']['do_slicing']:
@@ -584,13 +553,16 @@ if __name__ == "__main__":
 
         if p['compile']['find_channels_method'] == 'peaks':
             # only calculate channels masks from images before t_end in case it is specified
+            mask_images = np.ones(len(metadata_columns['t']), dtype=bool)
             if t_start:
                 analyzed_imgs = {fn : i_metadata for fn, i_metadata in six.iteritems(analyzed_imgs) if i_metadata['t'] >= t_start}
+                mask_images &= metadata_columns['t'] >= t_start
             if t_end:
                 analyzed_imgs = {fn : i_metadata for fn, i_metadata in six.iteritems(analyzed_imgs) if i_metadata['t'] <= t_end}
+                mask_images &= metadata_columns['t'] <= t_end
 
-            # Uses channel mm3.information from the already processed image data
-            channel_masks = mm3.make_masks(analyzed_imgs)
+            # Uses channel mm3.information from the already processed image data, read from the columns
+            channel_masks = mm3.make_masks(mm3.filter_metadata_columns(metadata_columns, mask_images))
 
         elif p['compile']['find_channels_method'] == 'Unet':
 
@@ -607,27 +579,63 @@ if __name__ == "__main__":
 
         if p['compile']['find_channels_method'] == 'peaks':
 
-            # do it by FOV. Not set up for multiprocessing
-            for fov, peaks in six.iteritems(channel_masks):
+            # images to slice per FOV, sorted by time. FOVs which were already sliced
+            # with the same images and channel masks are skipped.
+            fov_images = {}
+            for fov in sorted(channel_masks.keys()):
 
                 # skip fov if not in the group
                 if user_spec_fovs and fov not in user_spec_fovs:
                     continue
 
-                mm3.information("Loading images for FOV %03d." % fov)
-
-                # get filenames just for this fov along with the julian date of acquistion
+                # get filenames just for this fov along with the time point
                 send_to_write = [[k, v['t']] for k, v in six.iteritems(analyzed_imgs) if v['fov'] == fov]
 
-                # sort the filenames by jdn
+                # sort the filenames by time
                 send_to_write = sorted(send_to_write, key=lambda time: time[1])
 
-                if p['output'] == 'TIFF':
-                    #This is for loading the whole raw tiff stack and then slicing through it
-                    mm3.tiff_stack_slice_and_write(send_to_write, channel_masks, analyzed_imgs)
+                if len(send_to_write) == 0:
+                    continue
+
+                if slicing_resume and mm3.check_slicing_marker(fov, send_to_write, channel_masks, analyzed_imgs):
+                    mm3.information("FOV %03d already sliced, skipping." % fov)
+                    continue
+
+                fov_images[fov] = send_to_write
 
-                elif p['output'] == 'HDF5':
-                    # Or write it to hdf5
-                    mm3.hdf5_stack_slice_and_write(send_to_write, channel_masks, analyzed_imgs)
+            # number of FOVs sliced at once, limited by the memory budget
+            n_slicers = min(slicing_processes, max(len(fov_images), 1))
+            if len(fov_images) > 0 and slicing_memory_gb:
+                fov_memory = max([mm3.estimate_slicing_memory(send_to_write, channel_masks,
+                                                              analyzed_imgs, stream_slicing)
+                                  for send_to_write in fov_images.values()])
+                n_slicers = max(1, min(n_slicers, int(slicing_memory_gb * 1e9 // fov_memory)))
+            mm3.information("Slicing %d FOVs with %d processes." % (len(fov_images), n_slicers))
+
+            if n_slicers == 1:
+                for fov, send_to_write in six.iteritems(fov_images):
+                    mm3.slice_fov(fov, send_to_write, channel_masks, analyzed_imgs, stream_slicing)
+
+            else:
+                pool = Pool(n_slicers)
+
+                slicing_results = {}
+                for fov, send_to_write in six.iteritems(fov_images):
+                    # only send the metadata of this FOV to the worker
+                    fov_imgs = {image[0] : analyzed_imgs[image[0]] for image in send_to_write}
+                    slicing_results[fov] = pool.apply_async(mm3.slice_fov,
+                                                            args=(fov, send_to_write,
+                                                                  {fov : channel_masks[fov]},
+                                                                  fov_imgs, stream_slicing))
+
+                pool.close() # tells the process nothing more will be added.
+                pool.join() # blocks script until everything has been processed and workers exit
+
+                for fov, result in six.iteritems(slicing_results):
+                    if not result.successful():
+                        try:
+                            result.get()
+                        except Exception as e:
+                            mm3.warning("Slicing failed for FOV %03d: %s. Rerun to resume." % (fov, e))
 
             mm3.information("Channel slices saved.")
@@ -12,6 +12,8 @@ import os
 import yaml
 import multiprocessing
 
+import mm3_helpers as mm3 # reading stacks through the disk cache
+
 def init_params(param_file_path):
     # load all the parameters into a global dictionary
     global params
@@ -598,7 +600,7 @@ class PhaseWidget(QWidget):
 
                 self.imgIndex = 0
                 self.phaseImgPath = self.imgPaths[self.fov_id][self.imgIndex][0]
-                self.phaseStack = io.imread(self.phaseImgPath)
+                self.phaseStack = mm3.read_stack(self.phaseImgPath)
 
                 self.frameIndex = 0
                 self.img = self.phaseStack[self.frameIndex,:,:]
@@ -650,7 +652,7 @@ class PhaseWidget(QWidget):
 
                 self.imgIndex += 1
                 self.phaseImgPath = self.imgPaths[self.fov_id][self.imgIndex][0]
-                self.phaseStack = io.imread(self.phaseImgPath)
+                self.phaseStack = mm3.read_stack(self.phaseImgPath)
 
                 self.frameIndex = 0
                 self.img = self.phaseStack[self.frameIndex,:,:]
@@ -660,7 +662,7 @@ class PhaseWidget(QWidget):
 
                 self.imgIndex -= 1
                 self.phaseImgPath = self.imgPaths[self.fov_id][self.imgIndex][0]
-                self.phaseStack = io.imread(self.phaseImgPath)
+                self.phaseStack = mm3.read_stack(self.phaseImgPath)
 
                 self.frameIndex = 0
                 self.img = self.phaseStack[self.frameIndex,:,:]
@@ -672,7 +674,7 @@ class PhaseWidget(QWidget):
 
                 self.imgIndex = 0
                 self.phaseImgPath = self.imgPaths[self.fov_id][self.imgIndex][0]
-                self.phaseStack = io.imread(self.phaseImgPath)
+                self.phaseStack = mm3.read_stack(self.phaseImgPath)
 
                 self.frameIndex = 0
                 self.img = self.phaseStack[self.frameIndex,:,:]
@@ -684,7 +686,7 @@ class PhaseWidget(QWidget):
 
                 self.imgIndex = 0
                 self.phaseImgPath = self.imgPaths[self.fov_id][self.imgIndex][0]
-                self.phaseStack = io.imread(self.phaseImgPath)
+                self.phaseStack = mm3.read_stack(self.phaseImgPath)
 
                 self.frameIndex = 0
                 self.img = self.phaseStack[self.frameIndex,:,:]
@@ -137,10 +137,30 @@ if __name__ == "__main__":
     ### Subtract ##################################################################################
     if p['subtract']['do_subtraction']:
         mm3.information("Subtracting channels for channel {}.".format(sub_plane))
+
+        # one pool for the whole run. The channels of all FOVs are queued to it, and FOVs are
+        # saved in order once done. Only enough FOVs to keep the workers busy are queued ahead,
+        # so the buffers of the waiting FOVs do not pile up.
+        pool = Pool(processes=p['num_analyzers'])
+        pending_fovs = [] # (fov_id, peak results) in order
+
         for fov_id in fov_id_list:
-            # send to function which will create empty stack for each fov.
-            subtraction_result = mm3.subtract_fov_stack(fov_id, specs,
-                                                        color=sub_plane, method=sub_method)
+            # send to function which will queue the channels of each fov.
+            subtraction_result = mm3.subtract_fov_stack(fov_id, specs, color=sub_plane,
+                                                        method=sub_method, pool=pool)
+            if subtraction_result:
+                pending_fovs.append((fov_id, subtraction_result))
+
+            while (len(pending_fovs) > 1 and
+                   sum(len(results) for _, results in pending_fovs[1:]) >= 2 * p['num_analyzers']):
+                done_fov_id, peak_results = pending_fovs.pop(0)
+                mm3.finish_fov_subtraction(done_fov_id, peak_results, color=sub_plane)
+
+        for fov_id, peak_results in pending_fovs:
+            mm3.finish_fov_subtraction(fov_id, peak_results, color=sub_plane)
+
+        pool.close() # tells the process nothing more will be added.
+        pool.join() # blocks script until everything has been processed and workers exit
         mm3.information("Finished subtraction.")
 
     # Else just end, they only wanted to do empty averaging.
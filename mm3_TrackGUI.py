@@ -360,7 +360,7 @@ class TrackItem(QGraphicsScene):
 
         # read in images
         self.labelStack = io.imread(self.labelImgPath)
-        self.phaseStack = io.imread(self.phaseImgPath)
+        self.phaseStack = mm3.read_stack(self.phaseImgPath)
 
         # time_int = params['moviemaker']['seconds_per_time_index']/60
 
@@ -524,7 +524,7 @@ class TrackItem(QGraphicsScene):
         self.labelImgPath = os.path.join(params['seg_dir'], "{}_xy{:0=3}_p{:0=4}_seg_unet.tif".format(params['experiment_name'], self.fov_id, self.peak_id))
 
         self.labelStack = io.imread(self.labelImgPath)
-        self.phaseStack = io.imread(self.phaseImgPath)
+        self.phaseStack = mm3.read_stack(self.phaseImgPath)
 
         # look for previously edited info and load it if it is found
         self.get_track_pickle()
@@ -547,7 +547,7 @@ class TrackItem(QGraphicsScene):
         self.labelImgPath = os.path.join(params['seg_dir'], "{}_xy{:0=3}_p{:0=4}_seg_unet.tif".format(params['experiment_name'], self.fov_id, self.peak_id))
 
         self.labelStack = io.imread(self.labelImgPath)
-        self.phaseStack = io.imread(self.phaseImgPath)
+        self.phaseStack = mm3.read_stack(self.phaseImgPath)
 
         # look for previously edited info and load it if it is found
         self.get_track_pickle()
@@ -572,7 +572,7 @@ class TrackItem(QGraphicsScene):
         # print(self.labelImgPath)
 
         self.labelStack = io.imread(self.labelImgPath)
-        self.phaseStack = io.imread(self.phaseImgPath)
+        self.phaseStack = mm3.read_stack(self.phaseImgPath)
 
         # look for previously edited info and load it if it is found
         self.get_track_pickle()
@@ -602,7 +602,7 @@ class TrackItem(QGraphicsScene):
         # print(self.labelImgPath)
 
         self.labelStack = io.imread(self.labelImgPath)
-        self.phaseStack = io.imread(self.phaseImgPath)
+        self.phaseStack = mm3.read_stack(self.phaseImgPath)
 
         # look for previously edited info and load it if it is found
         self.get_track_pickle()
@@ -629,7 +629,7 @@ class TrackItem(QGraphicsScene):
         self.labelImgPath = os.path.join(params['seg_dir'], "{}_xy{:0=3}_p{:0=4}_seg_unet.tif".format(params['experiment_name'], self.fov_id, self.peak_id))
 
         self.labelStack = io.imread(self.labelImgPath)
-        self.phaseStack = io.imread(self.phaseImgPath)
+        self.phaseStack = mm3.read_stack(self.phaseImgPath)
 
         # look for previously edited info and load it if it is found
         self.get_track_pickle()
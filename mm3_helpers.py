@@ -17,11 +17,13 @@ except:
     import pickle
 import numpy as np # numbers package
 import struct # for interpretting strings as binary data
+import hashlib # keys for saved results
 import re # regular expressions
 from pprint import pprint # for human readable file output
 import traceback # for error messaging
 import warnings # error messaging
 import copy # not sure this is needed
+import shutil # removing temporary buffers
 import h5py # working with HDF5 files
 import pandas as pd
 import networkx as nx
@@ -29,9 +31,12 @@ import collections
 
 # scipy and image analysis
 from scipy.signal import find_peaks_cwt # used in channel finding
+from scipy.signal import find_peaks # used in fft channel finding
 from scipy.optimize import curve_fit # fitting ring profile
 from scipy.optimize import leastsq # fitting 2d gaussian
 from scipy import ndimage as ndi # labeling and distance transform
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components # linking traps through time
 from skimage import io
 from skimage import segmentation # used in make_masks and segmentation
 from skimage.transform import rotate
@@ -58,6 +63,7 @@ from tensorflow.keras import backend as K
 # Parralelization modules
 import multiprocessing
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool # decoding TIFF pages
 
 # Plotting for debug
 import matplotlib as mpl
@@ -111,15 +117,33 @@ def init_mm3_helpers(param_file_path):
     params['cell_dir'] = os.path.join(params['ana_dir'], 'cell_data')
     params['track_dir'] = os.path.join(params['ana_dir'], 'tracking')
 
+    # raw images are either individual TIFFs or a chunked HDF5 store per FOV written by nd2ToTIFF
+    if not 'raw_format' in params.keys():
+        params['raw_format'] = 'TIFF'
+
     # use jd time in image metadata to make time table. Set to false if no jd time
     if params['TIFF_source'] == 'elements' or params['TIFF_source'] == 'nd2ToTIFF':
         params['use_jd'] = True
+    elif params['raw_format'] == 'HDF5': # the HDF5 raw store carries the nd2 metadata
+        params['use_jd'] = True
     else:
         params['use_jd'] = False
 
     if not 'save_predictions' in params['segment']['unet'].keys():
         params['segment']['unet']['save_predictions'] = False
 
+    # keep recently loaded stacks in memory, up to this many MB
+    if 'stack_cache_mb' in params.keys() and params['stack_cache_mb']:
+        set_stack_cache(params['stack_cache_mb'])
+
+    # uncompressed copies of stacks on disk, relative to the analysis directory
+    if 'disk_cache_dir' in params.keys() and params['disk_cache_dir']:
+        params['disk_cache_dir'] = os.path.join(params['ana_dir'], params['disk_cache_dir'])
+    else:
+        params['disk_cache_dir'] = None
+    if not 'disk_cache_mb' in params.keys():
+        params['disk_cache_mb'] = 10240
+
     return params
 
 def julian_day_number():
@@ -158,48 +182,211 @@ def get_time(filepath):
     else:
         return None
 
-# loads and image stack from TIFF or HDF5 using mm3 conventions
-def load_stack(fov_id, peak_id, color='c1', image_return_number=None):
-    '''
-    Loads an image stack.
+### stack cache
+# An optional LRU cache of whole stacks read by load_stack, so several analyses of one
+# channel do not decompress the same file again. Entries are keyed by the file's
+# modification time, so a rewritten stack is read again. It is off until set_stack_cache
+# is called (or stack_cache_mb is set in the parameters file). Each process has its own cache.
+# It is checked before the disk cache, and stacks memory mapped from the disk cache are
+# held here as ordinary arrays.
+stack_cache = {'max_bytes' : 0, 'n_bytes' : 0, 'stacks' : collections.OrderedDict()}
+
+# turn the stack cache on with a memory limit in MB, or off with 0
+def set_stack_cache(max_mb):
+    clear_stack_cache()
+    stack_cache['max_bytes'] = int(max_mb * 1024**2) if max_mb else 0
+
+# remove all stacks, or those of one FOV or channel, from the stack cache
+def clear_stack_cache(fov_id=None, peak_id=None):
+    for key in list(stack_cache['stacks'].keys()):
+        if fov_id is not None and key[0] != fov_id:
+            continue
+        if peak_id is not None and key[1] != peak_id:
+            continue
+        stack_cache['n_bytes'] -= stack_cache['stacks'].pop(key).nbytes
+
+# return a cached stack and mark it as most recently used, or None
+def get_cached_stack(key):
+    img_stack = stack_cache['stacks'].pop(key, None)
+    if img_stack is not None:
+        stack_cache['stacks'][key] = img_stack
+    return img_stack
+
+# add a stack to the cache, removing the least recently used ones to make room
+def add_cached_stack(key, img_stack):
+    if img_stack.nbytes > stack_cache['max_bytes']:
+        return
+
+    # a memory mapped copy from the disk cache is read into memory, so the cache
+    # only counts stacks that are really held
+    if isinstance(img_stack, np.memmap):
+        img_stack = np.array(img_stack)
+
+    # older versions of the same stack
+    for old_key in [k for k in stack_cache['stacks'] if k[:3] == key[:3]]:
+        stack_cache['n_bytes'] -= stack_cache['stacks'].pop(old_key).nbytes
+
+    while stack_cache['n_bytes'] + img_stack.nbytes > stack_cache['max_bytes']:
+        old_key, old_stack = stack_cache['stacks'].popitem(last=False)
+        stack_cache['n_bytes'] -= old_stack.nbytes
 
-    Supports reading TIFF stacks or HDF5 files.
+    stack_cache['stacks'][key] = img_stack
+    stack_cache['n_bytes'] += img_stack.nbytes
+
+# run several analyses of one channel back to back, reading each stack once
+def run_channel_analyses(fov_id, peak_id, Cells, analyses, cache_mb=4096):
+    '''
+    Uses the stack cache, turning it on for the duration if it is off. The
+    stacks of this channel are dropped from the cache afterwards.
 
     Parameters
     ----------
-    fov_id : int
-        The FOV id
-    peak_id : int
-        The peak (channel) id. Dummy None value incase color='empty'
-    color : str
-        The image stack type to return. Can be:
-        c1 : phase stack
-        cN : where n is an integer for arbitrary color channel
-        sub : subtracted images
-        seg : segmented images
-        empty : get the empty channel for this fov, slightly different
+    fov_id, peak_id : int
+    Cells : dict
+        Cells of this channel.
+    analyses : list of (function, kwargs) tuples
+        Each is called as function(fov_id, peak_id, Cells, **kwargs), e.g.
+        [(find_cell_intensities, {'channel_name' : 'sub_c2'}),
+         (foci_analysis, {}),
+         (ring_analysis, {'ring_plane' : 'sub_c2'})]
+    cache_mb : int
+        Size of the cache in MB if it has to be turned on.
 
     Returns
     -------
-    image_stack : np.ndarray
-        The image stack through time. Shape is (t, y, x)
+    results : list
+        Return value of each analysis.
     '''
 
+    cache_was_off = stack_cache['max_bytes'] == 0
+    if cache_was_off:
+        set_stack_cache(cache_mb)
+
+    try:
+        results = [function(fov_id, peak_id, Cells, **kwargs) for function, kwargs in analyses]
+    finally:
+        if cache_was_off:
+            set_stack_cache(0)
+        else:
+            clear_stack_cache(fov_id, peak_id)
+
+    return results
+
+### on-disk stack cache
+# An optional directory (disk_cache_dir in the parameters file) of uncompressed .npy copies
+# of stacks. Later reads memory map the copy instead of decompressing the TIFF or HDF5
+# again. The name of each copy holds the modification time of its source, so a rewritten
+# source is read again, and the least recently used copies are removed when the directory
+# is over params['disk_cache_mb'].
+
+# path of the cached copy of a stack
+def get_disk_cache_path(path, dataset_name=None, plane_index=None):
+    name = os.path.splitext(os.path.basename(path))[0]
+    if dataset_name is not None:
+        name += '_' + dataset_name.replace('/', '_')
+    if plane_index is not None:
+        name += '_plane%d' % plane_index
+    source_mtime = int(os.path.getmtime(path) * 1e6)
+    return os.path.join(params['disk_cache_dir'], '%s_%d.npy' % (name, source_mtime))
+
+# memory map a cached stack, or return None if it is not there
+def load_disk_cached_stack(cache_path):
+    if not os.path.isfile(cache_path):
+        return None
+
+    try:
+        # copy on write, so callers can change the array without changing the file
+        img_stack = np.load(cache_path, mmap_mode='c')
+        os.utime(cache_path, None) # mark as recently used
+    except (IOError, OSError, ValueError):
+        # removed by another process
+        return None
+
+    return img_stack
+
+# makes a directory and its parents, which other processes may be making at the same time
+def make_dirs(dir_path):
+    if not os.path.isdir(dir_path):
+        try:
+            os.makedirs(dir_path)
+        except OSError: # made by another process
+            if not os.path.isdir(dir_path):
+                raise
+
+# saves an array to a .npy file that other processes may be reading. It is written to a
+# temporary file and renamed, so a partial file is never loaded
+def save_npy_atomic(path, array):
+    make_dirs(os.path.dirname(path))
+    tmp_path = path[:-len('.npy')] + '.%d.tmp' % os.getpid()
+    with open(tmp_path, 'wb') as tmp_file:
+        np.save(tmp_file, array)
+    os.rename(tmp_path, path)
+
+# write a stack to the disk cache, removing old versions and the least recently used stacks
+def add_disk_cached_stack(cache_path, img_stack):
+    max_bytes = params['disk_cache_mb'] * 1024**2
+    if img_stack.nbytes > max_bytes:
+        return
+
+    cache_dir = os.path.dirname(cache_path)
+    make_dirs(cache_dir)
+
+    # remove copies from older versions of the source
+    stack_name = os.path.basename(cache_path).rsplit('_', 1)[0]
+    cached_files = []
+    for file_name in os.listdir(cache_dir):
+        if not file_name.endswith('.npy'):
+            continue
+        file_path = os.path.join(cache_dir, file_name)
+        try:
+            if file_name.rsplit('_', 1)[0] == stack_name:
+                os.remove(file_path)
+            else:
+                cached_files.append((os.path.getmtime(file_path), os.path.getsize(file_path), file_path))
+        except OSError: # removed by another process
+            pass
+
+    # remove the least recently used until there is room
+    cached_files.sort()
+    n_bytes = sum(size for mtime, size, file_path in cached_files)
+    while cached_files and n_bytes + img_stack.nbytes > max_bytes:
+        mtime, size, file_path = cached_files.pop(0)
+        n_bytes -= size
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
+
+    save_npy_atomic(cache_path, img_stack)
+
+# find which file (and dataset in it) holds an image stack, using mm3 conventions
+def get_stack_location(fov_id, peak_id, color='c1'):
+    '''
+    Returns
+    -------
+    path : str
+        Path to the TIFF or HDF5 file.
+    dataset_name : str or None
+        Name of the dataset in the HDF5 file, None for TIFFs.
+    plane_index : int or None
+        Index of the plane in the raw HDF5 store, None otherwise.
+    '''
+
+    # raw frames of the whole fov from the raw HDF5 store, color is 'raw_c1', 'raw_c2', etc.
+    if 'raw' in color:
+        plane_index = int(color.split('_c')[-1]) - 1
+        return get_raw_hdf5_path(fov_id), 'images', plane_index
+
     # things are slightly different for empty channels
     if 'empty' in color:
         if params['output'] == 'TIFF':
             img_filename = params['experiment_name'] + '_xy%03d_%s.tif' % (fov_id, color)
-
-            with tiff.TiffFile(os.path.join(params['empty_dir'],img_filename)) as tif:
-                img_stack = tif.asarray()
+            return os.path.join(params['empty_dir'], img_filename), None, None
 
         if params['output'] == 'HDF5':
-            with h5py.File(os.path.join(params['hdf5_dir'],'xy%03d.hdf5' % fov_id), 'r') as h5f:
-                img_stack = h5f[color][:]
-
-        return img_stack
+            return os.path.join(params['hdf5_dir'], 'xy%03d.hdf5' % fov_id), color, None
 
-    # load normal images for either TIFF or HDF5
+    # normal images for either TIFF or HDF5
     if params['output'] == 'TIFF':
         if color[0] == 'c':
             img_dir = params['chnl_dir']
@@ -211,33 +398,262 @@ def load_stack(fov_id, peak_id, color='c1', image_return_number=None):
             img_dir = params['seg_dir']
 
         img_filename = params['experiment_name'] + '_xy%03d_p%04d_%s.tif' % (fov_id, peak_id, color)
+        return os.path.join(img_dir, img_filename), None, None
+
+    if params['output'] == 'HDF5':
+        return (os.path.join(params['hdf5_dir'], 'xy%03d.hdf5' % fov_id),
+                'channel_%04d/p%04d_%s' % (peak_id, peak_id, color), None)
+
+# turn the frames argument of load_stack into indicies
+def get_frame_indices(frames, n_frames):
+    '''
+    Parameters
+    ----------
+    frames : None, int, slice or list of ints
+        None is all frames. Negative values count from the end like numpy indexing.
+    n_frames : int
+        Number of frames in the stack.
+
+    Returns
+    -------
+    indices : 1D int array
+        The frames to read, in the order asked for.
+    single : bool
+        True when frames is an int, so the time axis should be dropped.
+    '''
+
+    if frames is None:
+        return np.arange(n_frames), False
+    if isinstance(frames, (six.integer_types, np.integer)):
+        return np.arange(n_frames)[[frames]], True
+    return np.arange(n_frames)[frames], False
+
+# turn the roi argument of load_stack into a pair of slices
+def get_roi_slices(roi):
+    '''roi is None (the whole image) or a (y, x) pair of slices or (start, stop) tuples.'''
+    if roi is None:
+        return slice(None), slice(None)
+    return tuple(r if isinstance(r, slice) else slice(*r) for r in roi)
+
+# read frames and an ROI from an HDF5 dataset as a hyperslab, without reading the rest
+def read_hdf5_frames(dataset, frames=None, roi=None, plane_index=None):
+    '''
+    dataset has shape (t, y, x), or (t, plane, y, x) when plane_index is given.
+    '''
+
+    indices, single = get_frame_indices(frames, dataset.shape[0])
+    y_slice, x_slice = get_roi_slices(roi)
+    plane = () if plane_index is None else (plane_index,)
+
+    if len(indices) == 0 or np.all(np.diff(indices) == 1):
+        # a contiguous block of frames
+        t_start = indices[0] if len(indices) else 0
+        img_stack = dataset[(slice(t_start, t_start + len(indices)),) + plane + (y_slice, x_slice)]
+    else:
+        # h5py wants increasing, unique indicies
+        unique_indices, order = np.unique(indices, return_inverse=True)
+        img_stack = dataset[(unique_indices.tolist(),) + plane + (y_slice, x_slice)]
+        img_stack = img_stack[order]
+
+    if single:
+        return img_stack[0]
+    return img_stack
+
+# True if each page of the TIFF is one frame of a (t, y, x) stack
+def tiff_pages_are_frames(tif):
+    shape = tif.series[0].shape
+    n_pages = len(tif.pages)
+    if len(shape) == 3:
+        return shape[0] == n_pages
+    return len(shape) == 2 and n_pages == 1
+
+# read some pages of a TIFF stack in one thread, with its own file handle
+def read_tiff_pages(path, indices, roi=None):
+    y_slice, x_slice = get_roi_slices(roi)
+    with tiff.TiffFile(path) as tif:
+        return [tif.pages[i].asarray()[y_slice, x_slice] for i in indices]
+
+# read frames and an ROI from a TIFF stack, decoding only the pages asked for
+def read_tiff_frames(path, frames=None, roi=None, threads=None):
+    '''
+    Compressed pages are decoded in threads. Each thread opens the file itself,
+    as TIFF file handles can not be shared between threads.
 
-        with tiff.TiffFile(os.path.join(img_dir, img_filename)) as tif:
+    Parameters
+    ----------
+    path : str
+        Path to a (t, y, x) TIFF stack.
+    frames, roi : see load_stack
+    threads : int
+        Number of threads for decoding. Defaults to params['num_analyzers'],
+        or 1 inside pool workers.
+    '''
+
+    y_slice, x_slice = get_roi_slices(roi)
+
+    with tiff.TiffFile(path) as tif:
+        if not tiff_pages_are_frames(tif):
+            # not laid out as one page per frame, read it all
             img_stack = tif.asarray()
+            if img_stack.ndim == 2:
+                img_stack = img_stack[np.newaxis]
+            indices, single = get_frame_indices(frames, img_stack.shape[0])
+            img_stack = img_stack[indices][:, y_slice, x_slice]
+            return img_stack[0] if single else img_stack
+
+        indices, single = get_frame_indices(frames, len(tif.pages))
+        if len(indices) == 0:
+            series = tif.series[0]
+            return np.zeros((0,) + tuple(series.shape[-2:]), dtype=series.dtype)[:, y_slice, x_slice]
+        compressed = getattr(tif.pages[0], 'compression', None) not in (None, 1)
+
+        if threads is None:
+            threads = 1 if multiprocessing.current_process().daemon else params['num_analyzers']
+        threads = max(1, min(threads, len(indices) // 4))
+
+        if not compressed or threads == 1:
+            images = [tif.pages[i].asarray()[y_slice, x_slice] for i in indices]
+        else:
+            images = None
+
+    if images is None:
+        pool = ThreadPool(threads)
+        chunks = [indices[i::threads] for i in range(threads)]
+        chunk_images = pool.map(lambda chunk: read_tiff_pages(path, chunk, roi), chunks)
+        pool.close()
+        pool.join()
+        # put the interleaved chunks back in order
+        images = [None] * len(indices)
+        for i, chunk in enumerate(chunk_images):
+            images[i::threads] = chunk
+
+    if single:
+        return images[0]
+    return np.stack(images)
+
+# cut frames and an ROI out of a stack that is already loaded. This makes a copy.
+def cut_stack(img_stack, frames=None, roi=None):
+    indices, single = get_frame_indices(frames, img_stack.shape[0])
+    y_slice, x_slice = get_roi_slices(roi)
+    img_stack = img_stack[indices][:, y_slice, x_slice]
+    return img_stack[0] if single else img_stack
+
+# read frames of a stack from the location given by get_stack_location
+def read_stack(path, dataset_name=None, plane_index=None, frames=None, roi=None):
+    '''
+    Uses the on-disk stack cache if params['disk_cache_dir'] is set. Whole
+    stacks are then returned as copy on write memory maps of the cached copy.
+    '''
 
-    if params['output'] == 'HDF5':
-        with h5py.File(os.path.join(params['hdf5_dir'], 'xy%03d.hdf5' % fov_id), 'r') as h5f:
-            # normal naming
-            # need to use [:] to get a copy, else it references the closed hdf5 dataset
-            img_stack = h5f['channel_%04d/p%04d_%s' % (peak_id, peak_id, color)][:]
+    if params['disk_cache_dir']:
+        cache_path = get_disk_cache_path(path, dataset_name, plane_index)
+        img_stack = load_disk_cached_stack(cache_path)
+        if img_stack is None and frames is None and roi is None:
+            img_stack = read_stack_file(path, dataset_name, plane_index)
+            add_disk_cached_stack(cache_path, img_stack)
+            return img_stack
+        if img_stack is not None:
+            if frames is None and roi is None:
+                return img_stack
+            return cut_stack(img_stack, frames, roi)
+
+    return read_stack_file(path, dataset_name, plane_index, frames, roi)
+
+# read frames of a stack from the TIFF or HDF5 file itself
+def read_stack_file(path, dataset_name=None, plane_index=None, frames=None, roi=None):
+    if dataset_name is None:
+        return read_tiff_frames(path, frames, roi)
+
+    with h5py.File(path, 'r') as h5f:
+        # the hyperslab is read into memory, so it does not reference the closed hdf5 dataset
+        img_stack = read_hdf5_frames(h5f[dataset_name], frames, roi, plane_index)
 
     return img_stack
 
+# number of frames in an image stack, without reading the images
+def get_stack_length(fov_id, peak_id, color='c1'):
+    path, dataset_name, plane_index = get_stack_location(fov_id, peak_id, color)
+
+    if dataset_name is None:
+        with tiff.TiffFile(path) as tif:
+            if tiff_pages_are_frames(tif):
+                return len(tif.pages)
+            shape = tif.series[0].shape
+            return shape[0] if len(shape) > 2 else 1
+
+    with h5py.File(path, 'r') as h5f:
+        return h5f[dataset_name].shape[0]
+
+# loads and image stack from TIFF or HDF5 using mm3 conventions
+def load_stack(fov_id, peak_id, color='c1', image_return_number=None, frames=None, roi=None):
+    '''
+    Loads an image stack.
+
+    Supports reading TIFF stacks or HDF5 files. Only the frames and region asked
+    for are read from the file.
+
+    Parameters
+    ----------
+    fov_id : int
+        The FOV id
+    peak_id : int
+        The peak (channel) id. Dummy None value incase color='empty'
+    color : str
+        The image stack type to return. Can be:
+        c1 : phase stack
+        cN : where n is an integer for arbitrary color channel
+        sub : subtracted images
+        seg : segmented images
+        empty : get the empty channel for this fov, slightly different
+        raw_cN : raw frames of the fov from the raw HDF5 store, peak_id is ignored
+    frames : None, int, slice or list of ints
+        Which time points (indicies into the stack) to load. None loads all of them.
+        An int returns a single (y, x) image.
+    roi : None or (y, x) pair of slices or (start, stop) tuples
+        Region of each image to load.
+
+    Returns
+    -------
+    image_stack : np.ndarray
+        The image stack through time. Shape is (t, y, x)
+    '''
+
+    path, dataset_name, plane_index = get_stack_location(fov_id, peak_id, color)
+
+    # whole stacks are kept in the stack cache when it is on, parts are cut from them
+    if stack_cache['max_bytes'] > 0:
+        cache_key = (fov_id, peak_id, color, os.path.getmtime(path))
+        img_stack = get_cached_stack(cache_key)
+        if img_stack is None and frames is None and roi is None:
+            img_stack = read_stack(path, dataset_name, plane_index)
+            add_cached_stack(cache_key, img_stack)
+        if img_stack is not None:
+            # cutting makes a copy, so the cached stack is not changed
+            return cut_stack(img_stack, frames, roi)
+
+    return read_stack(path, dataset_name, plane_index, frames, roi)
+
 # load the time table and add it to the global params
 def load_time_table():
-    '''Add the time table dictionary to the params global dictionary.
+    '''Add the time table to the params global dictionary.
     This is so it can be used during Cell creation.
+    The table is also returned.
     '''
 
-    # try first for yaml, then for pkl
-    try:
-        with open(os.path.join(params['ana_dir'], 'time_table.yaml'), 'rb') as time_table_file:
-            params['time_table'] = yaml.safe_load(time_table_file)
-    except:
-        with open(os.path.join(params['ana_dir'], 'time_table.pkl'), 'rb') as time_table_file:
-            params['time_table'] = pickle.load(time_table_file)
+    # try first for the binary table, then the yaml or pkl of older experiments
+    npz_path = os.path.join(params['ana_dir'], 'time_table.npz')
+    if os.path.isfile(npz_path):
+        params['time_table'] = read_time_table(npz_path)
+    else:
+        try:
+            with open(os.path.join(params['ana_dir'], 'time_table.yaml'), 'rb') as time_table_file:
+                time_table = yaml.safe_load(time_table_file)
+        except:
+            with open(os.path.join(params['ana_dir'], 'time_table.pkl'), 'rb') as time_table_file:
+                time_table = pickle.load(time_table_file)
+        params['time_table'] = time_table_from_dict(time_table)
 
-    return
+    return params['time_table']
 
 # function for loading the channel masks
 def load_channel_masks():
@@ -304,20 +720,13 @@ def get_initial_tif_params(image_filename):
     '''
 
     try:
-        # open up file and get metadata
+        # open up file and get metadata. No pixel data is decoded.
         with tiff.TiffFile(os.path.join(params['TIFF_dir'],image_filename)) as tif:
-            image_data = tif.asarray()
-            #print(image_data.shape) # uncomment for debug
-            img_shape = [image_data.shape[1],image_data.shape[2]]
-            plane_list = [str(i+1) for i in range(image_data.shape[0])]
+            n_planes, img_shape = get_tif_shape(tif)
+            plane_list = [str(i+1) for i in range(n_planes)]
             #print(plane_list) # uncomment for debug
 
-            if params['TIFF_source'] == 'elements':
-                image_metadata = get_tif_metadata_elements(tif)
-            elif params['TIFF_source'] == 'nd2ToTIFF':
-                image_metadata = get_tif_metadata_nd2ToTIFF(tif)
-            else:
-                image_metadata = get_tif_metadata_filename(tif)
+            image_metadata = get_tif_metadata(tif)
 
         information('Analyzed %s' % image_filename)
 
@@ -355,40 +764,36 @@ def get_tif_params(image_filename, find_channels=True):
     'plane_names' : image_metadata['plane_names'] # list of plane names
     'channels': cp_dict, # dictionary of channel locations, in the case of Unet-based channel segmentation, it's a dictionary of channel labels
 
+    Shape and metadata come from the TIFF header. Only the phase page is decoded,
+    and only if channels are to be found.
+
     Called by
     mm3_Compile.py __main__
 
     Calls
-    mm3.extract_metadata
-    mm3.find_channels
+    mm3.get_tif_shape
+    mm3.get_tif_metadata
+    mm3.find_channel_locs
     '''
 
     try:
         # open up file and get metadata
         with tiff.TiffFile(os.path.join(params['TIFF_dir'],image_filename)) as tif:
-            image_data = tif.asarray()
-
-            if params['TIFF_source'] == 'elements':
-                image_metadata = get_tif_metadata_elements(tif)
-            elif params['TIFF_source'] == 'nd2ToTIFF':
-                image_metadata = get_tif_metadata_nd2ToTIFF(tif)
-            else:
-                image_metadata = get_tif_metadata_filename(tif)
+            # get shape of single plane
+            n_planes, img_shape = get_tif_shape(tif)
 
-        # look for channels if flagged
-        if find_channels:
-            # fix the image orientation and get the number of planes
-            image_data = fix_orientation(image_data)
+            image_metadata = get_tif_metadata(tif)
 
-            # if the image data has more than 1 plane restrict image_data to phase,
-            # which should have highest mean pixel data
-            if len(image_data.shape) > 2:
+            # look for channels if flagged
+            if find_channels:
+                # restrict image_data to phase, which is the only page decoded
                 #ph_index = np.argmax([np.mean(image_data[ci]) for ci in range(image_data.shape[0])])
-                ph_index = int(params['phase_plane'][1:]) - 1
-                image_data = image_data[ph_index]
+                ph_index = min(int(params['phase_plane'][1:]) - 1, n_planes - 1)
+                image_data = read_tif_plane(tif, ph_index, n_planes)
 
-            # get shape of single plane
-            img_shape = [image_data.shape[0], image_data.shape[1]]
+        if find_channels:
+            # fix the image orientation
+            image_data = fix_orientation(image_data)
 
             # find channels on the processed image
             chnl_loc_dict = find_channel_locs(image_data)
@@ -396,16 +801,21 @@ def get_tif_params(image_filename, find_channels=True):
         information('Analyzed %s' % image_filename)
 
         # return the file name, the data for the channels in that image, and the metadata
-        return {'filepath': os.path.join(params['TIFF_dir'], image_filename),
-                'fov' : image_metadata['fov'], # fov id
-                't' : image_metadata['t'], # time point
-                'jd' : image_metadata['jd'], # absolute julian time
-                'x' : image_metadata['x'], # x position on stage [um]
-                'y' : image_metadata['y'], # y position on stage [um]
-                'planes' : image_metadata['planes'], # list of plane names
-                'shape' : img_shape, # image shape x y in pixels
-                # 'channels' : {1 : {'A' : 1, 'B' : 2}, 2 : {'C' : 3, 'D' : 4}}}
-                'channels' : chnl_loc_dict} # dictionary of channel locations
+        image_params = {'filepath': os.path.join(params['TIFF_dir'], image_filename),
+                        'fov' : image_metadata['fov'], # fov id
+                        't' : image_metadata['t'], # time point
+                        'jd' : image_metadata['jd'], # absolute julian time
+                        'x' : image_metadata['x'], # x position on stage [um]
+                        'y' : image_metadata['y'], # y position on stage [um]
+                        'planes' : image_metadata['planes'], # list of plane names
+                        'shape' : img_shape} # image shape x y in pixels
+
+        # images where channels were not looked for have no 'channels' entry
+        if find_channels:
+            # 'channels' : {1 : {'A' : 1, 'B' : 2}, 2 : {'C' : 3, 'D' : 4}}}
+            image_params['channels'] = chnl_loc_dict # dictionary of channel locations
+
+        return image_params
 
     except:
         warning('Failed get_params for ' + image_filename.split("/")[-1])
@@ -414,6 +824,48 @@ def get_tif_params(image_filename, find_channels=True):
         print(traceback.print_tb(sys.exc_info()[2]))
         return {'filepath': os.path.join(params['TIFF_dir'],image_filename), 'analyze_success': False}
 
+# reads the number of planes and the plane shape from the TIFF header
+def get_tif_shape(tif):
+    '''Returns the number of planes and the [rows, cols] shape of one plane of an opened
+    TIFF without decoding any pixel data.
+    '''
+
+    tif_shape = tif.series[0].shape
+    n_planes = int(np.prod(tif_shape[:-2])) # 1 for a flat image
+    img_shape = [tif_shape[-2], tif_shape[-1]]
+
+    return n_planes, img_shape
+
+# decodes a single plane of an opened TIFF
+def read_tif_plane(tif, plane_index, n_planes=None):
+    '''Decodes only the page of the given plane. Falls back to decoding the whole
+    image if the planes are not stored as separate pages.
+    '''
+
+    if n_planes is None:
+        n_planes, _ = get_tif_shape(tif)
+
+    if n_planes == 1:
+        return tif.asarray()
+
+    if len(tif.pages) == n_planes:
+        return tif.asarray(key=plane_index)
+
+    return tif.asarray()[plane_index]
+
+# picks the metadata reader based on where the TIFFs came from
+def get_tif_metadata(tif):
+    '''Returns the metadata dictionary of an opened TIFF using the reader for
+    params['TIFF_source']. Only the TIFF header is read.
+    '''
+
+    if params['TIFF_source'] == 'elements':
+        return get_tif_metadata_elements(tif)
+    elif params['TIFF_source'] == 'nd2ToTIFF':
+        return get_tif_metadata_nd2ToTIFF(tif)
+    else:
+        return get_tif_metadata_filename(tif)
+
 # finds metdata in a tiff image which has been expoted with Nikon Elements.
 def get_tif_metadata_elements(tif):
     '''This function pulls out the metadata from a tif file and returns it as a dictionary.
@@ -581,121 +1033,761 @@ def get_tif_metadata_filename(tif):
 
     return idata
 
-# make a lookup time table for converting nominal time to elapsed time in seconds
-def make_time_table(analyzed_imgs):
-    '''
-    Loops through the analyzed images and uses the jd time in the metadata to find the elapsed
-    time in seconds that each picture was taken. This is later used for more accurate elongation
-    rate calculation.
+### functions for the raw image manifest
+# The manifest lists every raw TIFF in the image directory with its fov, time point,
+# number of planes, size and modification time. It is saved in the analysis directory
+# and only new or changed files are looked at when it is updated.
+# Entries are sorted by fov and then time so ranges can be found by binary search.
 
-    Parametrs
-    ---------
-    analyzed_imgs : dict
-        The output of get_tif_params.
-    params['use_jd'] : boolean
-        If set to True, 'jd' time will be used from the image metadata to use to create time table. Otherwise the 't' index will be used, and the parameter 'seconds_per_time_index' will be used from the parameters.yaml file to convert to seconds.
+# fov and time point from raw TIFF names, e.g. 20190121_t0001xy01.tif or _t0001xy01_1.tif
+raw_tiff_name_re = re.compile(r't(\d+)xy(\d+)\w*\.tif$')
+
+# path to the saved manifest
+def get_raw_manifest_path():
+    return os.path.join(params['ana_dir'], 'raw_manifest.npz')
+
+# number of planes of a raw TIFF from its header
+def count_tif_planes(filepath):
+    try:
+        with tiff.TiffFile(filepath) as tif:
+            n_planes, _ = get_tif_shape(tif)
+        return n_planes
+    except:
+        return -1 # unreadable file
+
+# builds or updates the manifest of the raw TIFFs
+def update_raw_manifest(num_analyzers=1):
+    '''Lists the raw TIFFs in params['TIFF_dir'] and updates the saved manifest.
+    Files whose size and modification time are unchanged keep their entry, only the headers
+    of new or changed files are read. Files which are gone are dropped.
+
+    Parameters
+    num_analyzers : int
+        Number of processes used to read the headers of new files.
 
     Returns
-    -------
-    time_table : dict
-        Look up dictionary with keys for the FOV and then the time point.
-    '''
-    information('Making time table...')
+    manifest : dict of np.ndarray
+        Columns 'filename', 'fov', 't', 'planes', 'size' and 'mtime', sorted by fov and t.
 
-    # initialize
-    time_table = {}
+    Called by
+    mm3_Compile.py, mm3_MovieMaker.py
+    '''
 
-    first_time = float('inf')
+    # load the old manifest, keyed by file name
+    manifest_path = get_raw_manifest_path()
+    old_entries = {}
+    if os.path.isfile(manifest_path):
+        with np.load(manifest_path) as old_manifest:
+            for i, filename in enumerate(old_manifest['filename']):
+                old_entries[filename] = (old_manifest['planes'][i],
+                                         old_manifest['size'][i],
+                                         old_manifest['mtime'][i])
+
+    # one pass over the directory, stat information comes with the listing
+    filenames, fovs, times, planes, sizes, mtimes = [], [], [], [], [], []
+    new_indices = [] # entries which need their header read
+    for entry in os.scandir(params['TIFF_dir']):
+        match = raw_tiff_name_re.search(entry.name)
+        if match is None or not entry.is_file():
+            continue
 
-    # need to go through the data once to find the first time
-    for iname, idata in six.iteritems(analyzed_imgs):
-        if params['use_jd']:
-            if idata['jd'] < first_time:
-                first_time = idata['jd']
+        stat = entry.stat()
+        old_entry = old_entries.get(entry.name)
+        if old_entry is not None and old_entry[1] == stat.st_size and old_entry[2] == stat.st_mtime:
+            planes.append(old_entry[0])
         else:
-            if idata['t'] < first_time:
-                first_time = idata['t']
+            planes.append(-1)
+            new_indices.append(len(filenames))
+
+        filenames.append(entry.name)
+        times.append(int(match.group(1)))
+        fovs.append(int(match.group(2)))
+        sizes.append(stat.st_size)
+        mtimes.append(stat.st_mtime)
+
+    # read the headers of the new files
+    if new_indices:
+        information('Adding %d files to the raw image manifest.' % len(new_indices))
+        new_paths = [os.path.join(params['TIFF_dir'], filenames[i]) for i in new_indices]
+        if num_analyzers > 1:
+            pool = Pool(num_analyzers)
+            new_planes = pool.map(count_tif_planes, new_paths, chunksize=100)
+            pool.close()
+            pool.join()
+        else:
+            new_planes = [count_tif_planes(new_path) for new_path in new_paths]
+
+        for i, n_planes in zip(new_indices, new_planes):
+            planes[i] = n_planes
+
+    manifest = {'filename' : np.array(filenames, dtype=np.str_),
+                'fov' : np.array(fovs, dtype=np.int32),
+                't' : np.array(times, dtype=np.int32),
+                'planes' : np.array(planes, dtype=np.int32),
+                'size' : np.array(sizes, dtype=np.int64),
+                'mtime' : np.array(mtimes, dtype=np.float64)}
+
+    # sort by fov, then time, then name
+    order = np.lexsort((manifest['filename'], manifest['t'], manifest['fov']))
+    for key in manifest:
+        manifest[key] = manifest[key][order]
+
+    # only write when something changed
+    if new_indices or len(old_entries) != len(filenames):
+        if not os.path.exists(params['ana_dir']):
+            os.makedirs(params['ana_dir'])
+        np.savez(manifest_path, **manifest)
+
+    return manifest
+
+# finds entries of the manifest in a range of fovs and time points
+def query_raw_manifest(manifest, fovs=None, t_start=None, t_end=None):
+    '''Returns the indices of the manifest entries for the given fovs with
+    t_start <= t < t_end, in fov and time order. None or an empty list for fovs means all
+    fovs, None for t_start or t_end means no limit.
+    '''
 
-        # init dictionary for specific times per FOV
-        if idata['fov'] not in time_table:
-            time_table[idata['fov']] = {}
+    if fovs is None or len(fovs) == 0:
+        fovs = np.unique(manifest['fov'])
 
-    for iname, idata in six.iteritems(analyzed_imgs):
-        if params['use_jd']:
-            # convert jd time to elapsed time in seconds
-            t_in_seconds = np.around((idata['jd'] - first_time) * 24*60*60, decimals=0).astype('uint32')
+    indices = []
+    for fov in sorted(fovs):
+        # block of this fov
+        lo = np.searchsorted(manifest['fov'], fov, side='left')
+        hi = np.searchsorted(manifest['fov'], fov, side='right')
+
+        # time range within the block
+        fov_times = manifest['t'][lo:hi]
+        if t_start is not None:
+            lo_t = lo + np.searchsorted(fov_times, t_start, side='left')
+        else:
+            lo_t = lo
+        if t_end is not None:
+            hi_t = lo + np.searchsorted(fov_times, t_end, side='left')
         else:
-            t_in_seconds = np.around((idata['t'] - first_time) * params['moviemaker']['seconds_per_time_index'], decimals=0).astype('uint32')
+            hi_t = hi
 
-        time_table[int(idata['fov'])][int(idata['t'])] = int(t_in_seconds)
+        indices.append(np.arange(lo_t, hi_t))
 
-    # save to .pkl. This pkl will be loaded into the params
-    # with open(os.path.join(params['ana_dir'], 'time_table.pkl'), 'wb') as time_table_file:
-    #     pickle.dump(time_table, time_table_file, protocol=pickle.HIGHEST_PROTOCOL)
-    # with open(os.path.join(params['ana_dir'], 'time_table.txt'), 'w') as time_table_file:
-    #     pprint(time_table, stream=time_table_file)
-    with open(os.path.join(params['ana_dir'], 'time_table.yaml'), 'w') as time_table_file:
-        yaml.dump(data=time_table, stream=time_table_file, default_flow_style=False, tags=None)
-    information('Time table saved.')
+    if len(indices) == 0:
+        return np.array([], dtype=np.int64)
 
-    return time_table
+    return np.concatenate(indices)
 
-# saves traps sliced via Unet
-def save_tiffs(imgDict, analyzed_imgs, fov_id):
+### functions for the raw image HDF5 store
+# The raw store is one HDF5 file per FOV in the image directory, written directly from the
+# .nd2 by mm3_nd2ToTIFF.py when raw_format is 'HDF5'. Frames are in the dataset 'images' with
+# shape (t, plane, y, x) and chunked by single planes, so one plane can be read on its own.
+# The per frame metadata is kept in the datasets 't', 'jd', 'x' and 'y'.
 
-    savePath = os.path.join(params['experiment_directory'],
-                            params['analysis_directory'],
-                            params['chnl_dir'])
-    img_names = [key for key in analyzed_imgs.keys()]
-    image_params = analyzed_imgs[img_names[0]]
+# path to the raw store of an FOV
+def get_raw_hdf5_path(fov_id):
+    return os.path.join(params['TIFF_dir'], 'xy%03d_raw.hdf5' % fov_id)
 
-    for peak,img in six.iteritems(imgDict):
+# adds one frame to an opened raw store
+def write_raw_hdf5_frame(h5f, image_data, metadata_t):
+    '''Writes one time point of an FOV into the raw HDF5 store.
+    Datasets are created with the first frame and grown by one frame at a time.
+    If the time point is already in the store it is overwritten, so rerunning an extraction
+    does not duplicate frames.
 
-        img = img.astype('uint16')
-        if not os.path.isdir(savePath):
-            os.mkdir(savePath)
+    Parameters
+    h5f : h5py.File
+        Raw store opened for writing.
+    image_data : np.ndarray
+        Image with shape (plane, y, x) or (y, x).
+    metadata_t : dict
+        Metadata with the keys 'fov', 't', 'jd', 'x', 'y' and 'planes'.
 
-        for planeNumber in image_params['planes']:
+    Called by
+    mm3_nd2ToTIFF.py
+    '''
 
-            channel_filename = os.path.join(savePath, params['experiment_name'] + '_xy{0:0=3}_p{1:0=4}_c{2}.tif'.format(fov_id, peak, planeNumber))
-            io.imsave(channel_filename, img[:,:,:,int(planeNumber)-1])
+    if len(image_data.shape) == 2:
+        image_data = np.expand_dims(image_data, 0)
 
-# slice_and_write cuts up the image files one at a time and writes them out to tiff stacks
-def tiff_stack_slice_and_write(images_to_write, channel_masks, analyzed_imgs):
-    '''Writes out 4D stacks of TIFF images per channel.
-    Loads all tiffs from and FOV into memory and then slices all time points at once.
+    # create the datasets with the first frame
+    if 'images' not in h5f:
+        n_planes, rows, cols = image_data.shape
+        h5f.create_dataset(u'images', shape=(0, n_planes, rows, cols), dtype=image_data.dtype,
+                           chunks=(1, 1, rows, cols), maxshape=(None, n_planes, rows, cols),
+                           compression="gzip", shuffle=True, fletcher32=True)
+        h5f.create_dataset(u't', shape=(0,), dtype='int32', chunks=True, maxshape=(None,))
+        for key in ('jd', 'x', 'y'):
+            h5f.create_dataset(key, shape=(0,), dtype='float64', chunks=True, maxshape=(None,))
+
+        h5f.attrs.create('fov_id', metadata_t['fov'])
+        # encoding is because HDF5 has problems with numpy unicode
+        h5f.attrs.create('planes', [plane.encode('utf8') for plane in metadata_t['planes']])
+
+    # find where this time point goes
+    times = h5f['t'][:]
+    frame_index = np.where(times == metadata_t['t'])[0]
+    if len(frame_index) > 0:
+        frame_index = frame_index[0]
+    else:
+        frame_index = len(times)
+        for key in ('images', 't', 'jd', 'x', 'y'):
+            h5f[key].resize(frame_index + 1, axis=0)
+
+    h5f['images'][frame_index] = image_data
+    for key in ('t', 'jd', 'x', 'y'):
+        h5f[key][frame_index] = metadata_t[key]
+
+    return
+
+# get params for all frames of an fov from the raw store
+def get_hdf5_raw_params(fov_id, find_channels=True):
+    '''Equivalent of get_tif_params for the raw HDF5 store. Returns the image metadata
+    for every frame of an FOV, and finds the channels if flagged. Only the phase plane
+    is read from the store for channel finding, and only for the frames is_mask_frame
+    picks, as only those are used for the channel masks.
+
+    The keys of the returned dictionary take the place of the TIFF file names.
+    Each value has the same entries as the output of get_tif_params, plus 'raw_index', the
+    index of the frame in the store.
 
     Called by
-    __main__
+    mm3_Compile.py __main__
+
+    Calls
+    mm3.find_channel_locs
     '''
 
-    # make an array of images and then concatenate them into one big stack
-    image_fov_stack = []
+    raw_path = get_raw_hdf5_path(fov_id)
+    analyzed_imgs = {}
 
-    # go through list of images and get the file path
-    for n, image in enumerate(images_to_write):
-        # analyzed_imgs dictionary will be found in main scope. [0] is the key, [1] is jd
-        image_params = analyzed_imgs[image[0]]
+    try:
+        with h5py.File(raw_path, 'r') as h5f:
+            times = h5f['t'][:]
+            jds = h5f['jd'][:]
+            xs = h5f['x'][:]
+            ys = h5f['y'][:]
+            planes = [plane.decode('utf8') for plane in h5f.attrs['planes']]
+            n_frames, n_planes, rows, cols = h5f['images'].shape
+            ph_index = min(int(params['phase_plane'][1:]) - 1, n_planes - 1)
+
+            for frame_index in range(n_frames):
+                image_name = 'xy%03d_raw_t%04d' % (fov_id, times[frame_index])
+                image_params = {'filepath': raw_path,
+                                'raw_index': frame_index, # index of the frame in the store
+                                'fov' : fov_id, # fov id
+                                't' : int(times[frame_index]), # time point
+                                'jd' : float(jds[frame_index]), # absolute julian time
+                                'x' : float(xs[frame_index]), # x position on stage [um]
+                                'y' : float(ys[frame_index]), # y position on stage [um]
+                                'planes' : planes, # list of plane names
+                                'shape' : [rows, cols]} # image shape x y in pixels
+
+                # look for channels if flagged
+                if find_channels and is_mask_frame(times[frame_index]):
+                    image_data = h5f['images'][frame_index, ph_index]
+                    image_data = fix_orientation(image_data)
+                    image_params['channels'] = find_channel_locs(image_data)
+
+                analyzed_imgs[image_name] = image_params
+
+        information('Analyzed %d frames of %s' % (len(analyzed_imgs), raw_path.split('/')[-1]))
 
-        information("Loading %s." % image_params['filepath'].split('/')[-1])
+    except:
+        warning('Failed get_hdf5_raw_params for ' + raw_path.split("/")[-1])
+        print(sys.exc_info()[0])
+        print(sys.exc_info()[1])
+        print(traceback.print_tb(sys.exc_info()[2]))
 
-        if n == 1:
-            # declare identification variables for saving using first image
-            fov_id = image_params['fov']
+    return analyzed_imgs
+
+# loads the pixel data of one raw image
+def load_raw_image(image_params):
+    '''Loads one raw image, either from its TIFF or from the raw HDF5 store.
+    Images with more than one plane are returned as (plane, y, x), single plane images as (y, x),
+    the same way TIFFs are read.
+
+    Parameters
+    image_params : dict
+        Entry of analyzed_imgs for the image, from get_tif_params or get_hdf5_raw_params.
+    '''
+
+    if 'raw_index' in image_params:
+        with h5py.File(image_params['filepath'], 'r') as h5f:
+            image_data = h5f['images'][image_params['raw_index']]
 
-        # load the tif and store it in array
+        if image_data.shape[0] == 1:
+            image_data = image_data[0]
+
+    else:
         with tiff.TiffFile(image_params['filepath']) as tif:
             image_data = tif.asarray()
 
-        # channel finding was also done on images after orientation was fixed
-        image_data = fix_orientation(image_data)
+    return image_data
 
-        # add additional axis if the image is flat
-        if len(image_data.shape) == 2:
-            image_data = np.expand_dims(image_data, 0)
+### columnar image metadata
+# The image metadata (analyzed_imgs) is kept on disk as columns in TIFF_metadata.hdf5, one row
+# per image sorted by fov and time, instead of a pickled dictionary. The channel positions of
+# all images are flattened into one table with the offset of each image's channels.
+# The columns are a dictionary of arrays, which make_time_table and make_masks use directly.
 
-        # change axis so it goes Y, X, Plane
-        image_data = np.rollaxis(image_data, 0, 3)
+# path of the columnar metadata file
+def get_tiff_metadata_path():
+    return os.path.join(params['ana_dir'], 'TIFF_metadata.hdf5')
+
+# checks if metadata is already in columns
+def is_metadata_columns(metadata):
+    return isinstance(metadata, dict) and isinstance(metadata.get('image_names', None), np.ndarray)
+
+def get_metadata_columns(analyzed_imgs):
+    '''Converts analyzed_imgs into columns. Columns are returned as they are.
+
+    Parameters
+    analyzed_imgs : dict
+        Image metadata from get_tif_params or get_hdf5_raw_params, by image name.
+
+    Returns
+    columns : dict of np.ndarray
+        'image_names', 'filepath', 'fov', 't', 'jd', 'x', 'y', 'shape', 'planes' (joined with
+        commas), 'raw_index' (-1 for TIFFs), 'drift', 'has_drift', 'has_channels', one row
+        per image sorted by fov and t. 'channel_offsets' gives for image i the rows
+        channel_offsets[i]:channel_offsets[i+1] of 'channel_peaks', 'channel_closed_end_px'
+        and 'channel_open_end_px'. Images which failed are in 'failed_names' and
+        'failed_filepaths'.
+    '''
+
+    if is_metadata_columns(analyzed_imgs):
+        return analyzed_imgs
+
+    image_names = []
+    failed_names = []
+    failed_filepaths = []
+    for image_name, image_params in six.iteritems(analyzed_imgs):
+        if image_params and 'fov' in image_params:
+            image_names.append(image_name)
+        else:
+            failed_names.append(image_name)
+            failed_filepaths.append(image_params['filepath'] if image_params else '')
+
+    # sort by fov and then time
+    image_names.sort(key=lambda image_name: (analyzed_imgs[image_name]['fov'], analyzed_imgs[image_name]['t']))
+    images = [analyzed_imgs[image_name] for image_name in image_names]
+    n_images = len(images)
+
+    columns = {'image_names' : np.array(image_names, dtype=str),
+               'filepath' : np.array([image['filepath'] for image in images], dtype=str),
+               'fov' : np.array([image['fov'] for image in images], dtype='int64'),
+               't' : np.array([image['t'] for image in images], dtype='int64'),
+               'jd' : np.array([image['jd'] for image in images], dtype='float64'),
+               'x' : np.array([image['x'] for image in images], dtype='float64'),
+               'y' : np.array([image['y'] for image in images], dtype='float64'),
+               'shape' : np.array([image['shape'] for image in images], dtype='int64').reshape(n_images, 2),
+               'planes' : np.array([','.join(image['planes']) for image in images], dtype=str),
+               'raw_index' : np.array([image.get('raw_index', -1) for image in images], dtype='int64'),
+               'drift' : np.array([image.get('drift', [0, 0]) for image in images], dtype='int64').reshape(n_images, 2),
+               'has_drift' : np.array(['drift' in image for image in images], dtype=bool),
+               'has_channels' : np.array(['channels' in image for image in images], dtype=bool),
+               'failed_names' : np.array(failed_names, dtype=str),
+               'failed_filepaths' : np.array(failed_filepaths, dtype=str)}
+
+    # channels of all images in one table
+    channel_counts = np.array([len(image.get('channels', {})) for image in images], dtype='int64')
+    columns['channel_offsets'] = np.concatenate(([0], np.cumsum(channel_counts))).astype('int64')
+    peaks, closed_ends, open_ends = [], [], []
+    for image in images:
+        channels = image.get('channels', {})
+        for peak in sorted(channels.keys()):
+            peaks.append(peak)
+            closed_ends.append(channels[peak]['closed_end_px'])
+            open_ends.append(channels[peak]['open_end_px'])
+    columns['channel_peaks'] = np.array(peaks, dtype='int64')
+    columns['channel_closed_end_px'] = np.array(closed_ends, dtype='int64')
+    columns['channel_open_end_px'] = np.array(open_ends, dtype='int64')
+
+    return columns
+
+# keeps the rows of the columns where keep is True
+def filter_metadata_columns(columns, keep):
+    filtered = {key : columns[key][keep] for key in columns
+                if not key.startswith('channel_') and not key.startswith('failed_')}
+
+    # channel rows of the images which are kept
+    offsets = columns['channel_offsets']
+    channel_keep = np.repeat(keep, np.diff(offsets))
+    channel_counts = np.diff(offsets)[keep]
+    filtered['channel_offsets'] = np.concatenate(([0], np.cumsum(channel_counts))).astype('int64')
+    for key in ['channel_peaks', 'channel_closed_end_px', 'channel_open_end_px']:
+        filtered[key] = columns[key][channel_keep]
+    for key in ['failed_names', 'failed_filepaths']:
+        filtered[key] = columns[key]
+
+    return filtered
+
+def metadata_columns_to_dict(columns):
+    '''Converts columns back into the analyzed_imgs dictionary by image name.'''
+
+    analyzed_imgs = {}
+    offsets = columns['channel_offsets']
+    for i, image_name in enumerate(columns['image_names']):
+        image_params = {'filepath' : str(columns['filepath'][i]),
+                        'fov' : int(columns['fov'][i]),
+                        't' : int(columns['t'][i]),
+                        'jd' : float(columns['jd'][i]),
+                        'x' : float(columns['x'][i]),
+                        'y' : float(columns['y'][i]),
+                        'planes' : str(columns['planes'][i]).split(',') if columns['planes'][i] else [],
+                        'shape' : [int(v) for v in columns['shape'][i]]}
+        if columns['raw_index'][i] >= 0:
+            image_params['raw_index'] = int(columns['raw_index'][i])
+        if columns['has_drift'][i]:
+            image_params['drift'] = [int(v) for v in columns['drift'][i]]
+        if columns['has_channels'][i]:
+            rows = slice(offsets[i], offsets[i+1])
+            image_params['channels'] = {int(peak) : {'closed_end_px' : int(closed_end),
+                                                     'open_end_px' : int(open_end)}
+                                        for peak, closed_end, open_end
+                                        in zip(columns['channel_peaks'][rows],
+                                               columns['channel_closed_end_px'][rows],
+                                               columns['channel_open_end_px'][rows])}
+        analyzed_imgs[str(image_name)] = image_params
+
+    for image_name, filepath in zip(columns['failed_names'], columns['failed_filepaths']):
+        analyzed_imgs[str(image_name)] = {'filepath' : str(filepath), 'analyze_success' : False}
+
+    return analyzed_imgs
+
+def save_tiff_metadata(analyzed_imgs, text_dump=False):
+    '''Saves the image metadata as columns to TIFF_metadata.hdf5, and optionally as a human
+    readable TIFF_metadata.txt, which is slow for many images.
+
+    Returns
+    columns : dict of np.ndarray
+        The saved columns, see get_metadata_columns.
+
+    Called by
+    mm3_Compile.py
+    '''
+
+    columns = get_metadata_columns(analyzed_imgs)
+
+    with h5py.File(get_tiff_metadata_path(), 'w') as h5f:
+        for key, column in six.iteritems(columns):
+            # strings are saved as utf8 bytes
+            if column.dtype.kind == 'U':
+                column = np.char.encode(column, 'utf8')
+                if column.dtype.itemsize == 0:
+                    column = column.astype('S1')
+            h5f.create_dataset(key, data=column)
+
+        # first row of each fov for reading single fovs
+        fovs, fov_starts = np.unique(columns['fov'], return_index=True)
+        h5f.create_dataset('fov_ids', data=fovs.astype('int64'))
+        h5f.create_dataset('fov_offsets', data=np.append(fov_starts, len(columns['fov'])).astype('int64'))
+
+    if text_dump:
+        with open(os.path.join(params['ana_dir'], 'TIFF_metadata.txt'), 'w') as tiff_metadata:
+            pprint(analyzed_imgs if not is_metadata_columns(analyzed_imgs)
+                   else metadata_columns_to_dict(columns), stream=tiff_metadata)
+
+    return columns
+
+def load_tiff_metadata(fovs=None, as_columns=False):
+    '''Loads the image metadata saved by save_tiff_metadata. Only the rows of the given fovs
+    are read if fovs is given. Falls back to TIFF_metadata.pkl from older runs.
+
+    Parameters
+    fovs : list of int
+        FOVs to load, or None for all of them.
+    as_columns : bool
+        Return the columns instead of the analyzed_imgs dictionary.
+
+    Called by
+    mm3_Compile.py
+    '''
+
+    if not os.path.isfile(get_tiff_metadata_path()):
+        with open(os.path.join(params['ana_dir'], 'TIFF_metadata.pkl'), 'rb') as tiff_metadata:
+            analyzed_imgs = pickle.load(tiff_metadata)
+        if fovs is not None:
+            analyzed_imgs = {image_name : image_params for image_name, image_params in six.iteritems(analyzed_imgs)
+                             if image_params and image_params.get('fov', None) in fovs}
+        return get_metadata_columns(analyzed_imgs) if as_columns else analyzed_imgs
+
+    columns = {}
+    with h5py.File(get_tiff_metadata_path(), 'r') as h5f:
+        offsets = h5f['channel_offsets'][:]
+
+        # ranges of rows to read, the rows of each fov are together
+        if fovs is None:
+            image_ranges = [(0, len(offsets) - 1)]
+        else:
+            fov_ids = h5f['fov_ids'][:]
+            fov_offsets = h5f['fov_offsets'][:]
+            image_ranges = []
+            for fov in sorted(fovs):
+                i = np.searchsorted(fov_ids, fov)
+                if i < len(fov_ids) and fov_ids[i] == fov:
+                    image_ranges.append((fov_offsets[i], fov_offsets[i+1]))
+
+        for key in h5f.keys():
+            if key in ['fov_ids', 'fov_offsets', 'channel_offsets']:
+                continue
+            elif key.startswith('failed_'):
+                parts = [h5f[key][:]]
+            elif key.startswith('channel_'):
+                parts = [h5f[key][offsets[start]:offsets[stop]] for start, stop in image_ranges]
+            else:
+                parts = [h5f[key][start:stop] for start, stop in image_ranges]
+            column = np.concatenate(parts) if parts else h5f[key][:0]
+            if column.dtype.kind == 'S':
+                column = np.char.decode(column, 'utf8')
+            columns[key] = column
+
+        counts = [np.diff(offsets[start:stop+1]) for start, stop in image_ranges]
+        counts = np.concatenate(counts) if counts else np.zeros(0, dtype='int64')
+        columns['channel_offsets'] = np.concatenate(([0], np.cumsum(counts))).astype('int64')
+
+    if as_columns:
+        return columns
+    return metadata_columns_to_dict(columns)
+
+### time table
+# The time table maps the nominal time index of each image to elapsed seconds. It is
+# stored as one array per FOV indexed by t - first t, which is saved to time_table.npz.
+# Missing time points hold -1. The TimeTable can still be used like the old nested
+# dictionary (time_table[fov][t]), but lookup and first_t should be used where speed matters.
+class TimeTable():
+    '''
+    Elapsed time in seconds for each FOV and time point.
+
+    Attributes
+    ----------
+    fov_ids : 1D int array
+        The FOVs in the table, sorted.
+    t_first, t_last : 1D int arrays
+        First and last time index of each FOV.
+    offsets : 1D int array
+        Where each FOV starts in seconds, one longer than fov_ids.
+    seconds : 1D int array
+        Elapsed seconds for all FOVs, concatenated. -1 where there is no image.
+    '''
+
+    def __init__(self, fov_ids, t_first, offsets, seconds):
+        self.fov_ids = np.asarray(fov_ids, dtype='int64')
+        self.t_first = np.asarray(t_first, dtype='int64')
+        self.offsets = np.asarray(offsets, dtype='int64')
+        self.seconds = np.asarray(seconds, dtype='int64')
+        self.t_last = self.t_first + np.diff(self.offsets) - 1
+        self.fov_index = {fov: i for i, fov in enumerate(self.fov_ids.tolist())}
+        self.fov_dicts = {} # filled when used as a dictionary
+
+    def fov_slice(self, fov):
+        '''Return the index of the FOV and its seconds array.'''
+        i = self.fov_index[int(fov)]
+        return i, self.seconds[self.offsets[i]:self.offsets[i+1]]
+
+    def lookup(self, fov, t):
+        '''
+        Elapsed seconds of time index t (an int or an array of them) for one FOV.
+        Raises a KeyError if a time point is not in the table.
+        '''
+        i, fov_seconds = self.fov_slice(fov)
+        t_index = np.asarray(t, dtype='int64') - self.t_first[i]
+        if np.any((t_index < 0) | (t_index >= len(fov_seconds))):
+            raise KeyError('Time index %s not in time table for FOV %d.' % (t, fov))
+        seconds = fov_seconds[t_index]
+        if np.any(seconds < 0):
+            raise KeyError('Time index %s not in time table for FOV %d.' % (t, fov))
+        if seconds.ndim == 0:
+            return int(seconds)
+        return seconds
+
+    def times(self, fov):
+        '''Sorted time indicies present for one FOV.'''
+        i, fov_seconds = self.fov_slice(fov)
+        return np.flatnonzero(fov_seconds >= 0) + self.t_first[i]
+
+    def first_t(self, fov=None):
+        '''First time index of one FOV, or of the whole experiment if fov is None.'''
+        if fov is None:
+            return int(np.amin(self.t_first)) if len(self.t_first) else None
+        return int(self.t_first[self.fov_index[int(fov)]])
+
+    def last_t(self, fov=None):
+        '''Last time index of one FOV, or of the whole experiment if fov is None.'''
+        if fov is None:
+            return int(np.amax(self.t_last)) if len(self.t_last) else None
+        return int(self.t_last[self.fov_index[int(fov)]])
+
+    # dictionary interface, so older code and the yaml export still work
+    def __getitem__(self, fov):
+        fov = int(fov)
+        if fov not in self.fov_dicts:
+            ts = self.times(fov)
+            self.fov_dicts[fov] = dict(zip(ts.tolist(), self.lookup(fov, ts).tolist()))
+        return self.fov_dicts[fov]
+
+    def __contains__(self, fov):
+        return fov in self.fov_index
+
+    def __iter__(self):
+        return iter(self.fov_ids.tolist())
+
+    def __len__(self):
+        return len(self.fov_ids)
+
+    def keys(self):
+        return self.fov_ids.tolist()
+
+    def items(self):
+        return [(fov, self[fov]) for fov in self.fov_ids.tolist()]
+
+    def to_dict(self):
+        '''Nested dictionary {fov: {t: seconds}} of the table.'''
+        return dict(self.items())
+
+    def save(self, path):
+        '''Save the arrays to a .npz file.'''
+        np.savez(path, fov_ids=self.fov_ids, t_first=self.t_first,
+                 offsets=self.offsets, seconds=self.seconds)
+
+# make a TimeTable from flat arrays of fov, time index and seconds, one entry per image
+def make_time_table_arrays(fovs, ts, seconds):
+    fovs = np.asarray(fovs, dtype='int64')
+    ts = np.asarray(ts, dtype='int64')
+    seconds = np.asarray(seconds, dtype='int64')
+
+    fov_ids, fov_rows = np.unique(fovs, return_inverse=True)
+    t_first = np.full(len(fov_ids), np.iinfo('int64').max, dtype='int64')
+    t_last = np.full(len(fov_ids), np.iinfo('int64').min, dtype='int64')
+    np.minimum.at(t_first, fov_rows, ts)
+    np.maximum.at(t_last, fov_rows, ts)
+    offsets = np.concatenate(([0], np.cumsum(t_last - t_first + 1))).astype('int64')
+
+    table = np.full(offsets[-1], -1, dtype='int64')
+    table[offsets[fov_rows] + ts - t_first[fov_rows]] = seconds
+
+    return TimeTable(fov_ids, t_first, offsets, table)
+
+# load a TimeTable saved with TimeTable.save
+def read_time_table(path):
+    with np.load(path) as data:
+        return TimeTable(data['fov_ids'], data['t_first'], data['offsets'], data['seconds'])
+
+# convert a nested {fov: {t: seconds}} dictionary from an older time table
+def time_table_from_dict(time_table_dict):
+    fovs, ts, seconds = [], [], []
+    for fov, times in time_table_dict.items():
+        for t, s in times.items():
+            fovs.append(fov)
+            ts.append(t)
+            seconds.append(s)
+    return make_time_table_arrays(fovs, ts, seconds)
+
+# make a lookup time table for converting nominal time to elapsed time in seconds
+def make_time_table(analyzed_imgs, yaml_export=True):
+    '''
+    Loops through the analyzed images and uses the jd time in the metadata to find the elapsed
+    time in seconds that each picture was taken. This is later used for more accurate elongation
+    rate calculation.
+
+    Parametrs
+    ---------
+    analyzed_imgs : dict
+        The output of get_tif_params, or the same as columns from get_metadata_columns.
+    params['use_jd'] : boolean
+        If set to True, 'jd' time will be used from the image metadata to use to create time table. Otherwise the 't' index will be used, and the parameter 'seconds_per_time_index' will be used from the parameters.yaml file to convert to seconds.
+    yaml_export : boolean
+        Also write the table as time_table.yaml for reading.
+
+    Returns
+    -------
+    time_table : TimeTable
+        Look up table by FOV and then the time point. Saved as time_table.npz.
+    '''
+    information('Making time table...')
+
+    # the time of each image from the columns
+    columns = get_metadata_columns(analyzed_imgs)
+    fovs = columns['fov']
+    if params['use_jd']:
+        times = columns['jd']
+        first_time = np.amin(times) if len(times) else 0
+        # convert jd time to elapsed time in seconds
+        t_in_seconds = np.around((times - first_time) * 24*60*60, decimals=0).astype('uint32')
+    else:
+        times = columns['t']
+        first_time = np.amin(times) if len(times) else 0
+        t_in_seconds = np.around((times - first_time) * params['moviemaker']['seconds_per_time_index'], decimals=0).astype('uint32')
+
+    # arrays of seconds per FOV indexed by time
+    time_table = make_time_table_arrays(fovs, columns['t'], t_in_seconds)
+
+    # save the binary table, which is what load_time_table reads. The yaml is only an export.
+    time_table.save(os.path.join(params['ana_dir'], 'time_table.npz'))
+    if yaml_export:
+        with open(os.path.join(params['ana_dir'], 'time_table.yaml'), 'w') as time_table_file:
+            yaml.dump(data=time_table.to_dict(), stream=time_table_file, default_flow_style=False, tags=None)
+    information('Time table saved.')
+
+    return time_table
+
+# saves traps sliced via Unet
+def save_tiffs(imgDict, analyzed_imgs, fov_id):
+
+    savePath = os.path.join(params['experiment_directory'],
+                            params['analysis_directory'],
+                            params['chnl_dir'])
+    img_names = [key for key in analyzed_imgs.keys()]
+    image_params = analyzed_imgs[img_names[0]]
+
+    thumbnails = {} # first and last phase image and kymograph of each channel for ChannelPicker
+    for peak,img in six.iteritems(imgDict):
+
+        img = img.astype('uint16', copy=False)
+        if not os.path.isdir(savePath):
+            os.mkdir(savePath)
+
+        for planeNumber in image_params['planes']:
+
+            channel_filename = os.path.join(savePath, params['experiment_name'] + '_xy{0:0=3}_p{1:0=4}_c{2}.tif'.format(fov_id, peak, planeNumber))
+            io.imsave(channel_filename, img[:,:,:,int(planeNumber)-1])
+
+        thumbnails[peak] = get_channel_thumbnail(img[:,:,:,get_phase_plane_index(img.shape[3])])
+
+    save_channel_thumbnails(fov_id, thumbnails)
+
+# slice_and_write cuts up the image files one at a time and writes them out to tiff stacks
+def tiff_stack_slice_and_write(images_to_write, channel_masks, analyzed_imgs):
+    '''Writes out 4D stacks of TIFF images per channel.
+    Loads all tiffs from and FOV into memory and then slices all time points at once.
+
+    Called by
+    __main__
+    '''
+
+    # make an array of images and then concatenate them into one big stack
+    image_fov_stack = []
+
+    # go through list of images and get the file path
+    for n, image in enumerate(images_to_write):
+        # analyzed_imgs dictionary will be found in main scope. [0] is the key, [1] is jd
+        image_params = analyzed_imgs[image[0]]
+
+        information("Loading %s." % image_params['filepath'].split('/')[-1])
+
+        if n == 1:
+            # declare identification variables for saving using first image
+            fov_id = image_params['fov']
+
+        # load the image, from TIFF or the raw HDF5 store
+        image_data = load_raw_image(image_params)
+
+        # channel finding was also done on images after orientation was fixed
+        image_data = fix_orientation(image_data)
+
+        # add additional axis if the image is flat
+        if len(image_data.shape) == 2:
+            image_data = np.expand_dims(image_data, 0)
+
+        # change axis so it goes Y, X, Plane
+        image_data = np.rollaxis(image_data, 0, 3)
 
         # add it to list. The images should be in time order
         image_fov_stack.append(image_data)
@@ -703,7 +1795,12 @@ def tiff_stack_slice_and_write(images_to_write, channel_masks, analyzed_imgs):
     # concatenate the list into one big ass stack
     image_fov_stack = np.stack(image_fov_stack, axis=0)
 
+    # drift of each time point, if it is corrected
+    fov_drift = [get_image_drift(analyzed_imgs[image[0]]) for image in images_to_write]
+    fov_drift = np.array(fov_drift) if fov_drift[0] is not None else None
+
     # cut out the channels as per channel masks for this fov
+    thumbnails = {} # first and last phase image and kymograph of each channel for ChannelPicker
     for peak, channel_loc in six.iteritems(channel_masks[fov_id]):
         #information('Slicing and saving channel peak %s.' % channel_filename.split('/')[-1])
         information('Slicing and saving channel peak %d.' % peak)
@@ -715,7 +1812,7 @@ def tiff_stack_slice_and_write(images_to_write, channel_masks, analyzed_imgs):
 
         # slice out channel.
         # The function should recognize the shape length as 4 and cut all time points
-        channel_stack = cut_slice(image_fov_stack, channel_loc)
+        channel_stack = cut_slice(image_fov_stack, channel_loc, shift=fov_drift)
 
         # save a different time stack for all colors
         for color_index in range(channel_stack.shape[3]):
@@ -725,6 +1822,10 @@ def tiff_stack_slice_and_write(images_to_write, channel_masks, analyzed_imgs):
             # save stack
             tiff.imsave(channel_filename, channel_stack[:,:,:,color_index], compress=4)
 
+        thumbnails[peak] = get_channel_thumbnail(channel_stack[:,:,:,get_phase_plane_index(channel_stack.shape[3])])
+
+    save_channel_thumbnails(fov_id, thumbnails)
+
     return
 
 # saves traps sliced via Unet to an hdf5 file
@@ -783,9 +1884,11 @@ def save_hdf5(imgDict, img_names, analyzed_imgs, fov_id, channel_masks):
                                   compression="gzip", shuffle=True, fletcher32=True)
 
         # cut out the channels as per channel masks for this fov
+        thumbnails = {} # first and last phase image and kymograph of each channel for ChannelPicker
         for peak,channel_stack in six.iteritems(imgDict):
 
-            channel_stack = channel_stack.astype('uint16')
+            channel_stack = channel_stack.astype('uint16', copy=False)
+            thumbnails[peak] = get_channel_thumbnail(channel_stack[:,:,:,get_phase_plane_index(channel_stack.shape[3])])
             # create group for this trap
             h5g = h5f.create_group('channel_%04d' % peak)
 
@@ -810,6 +1913,8 @@ def save_hdf5(imgDict, img_names, analyzed_imgs, fov_id, channel_masks):
                 # write the data even though we have more to write (free up memory)
                 h5f.flush()
 
+    save_channel_thumbnails(fov_id, thumbnails)
+
     return
 
 # same thing as tiff_stack_slice_and_write but do it for hdf5
@@ -850,9 +1955,8 @@ def hdf5_stack_slice_and_write(images_to_write, channel_masks, analyzed_imgs):
             image_shape = image_params['shape']
             image_planes = image_params['planes']
 
-        # load the tif and store it in array
-        with tiff.TiffFile(image_params['filepath']) as tif:
-            image_data = tif.asarray()
+        # load the image, from TIFF or the raw HDF5 store
+        image_data = load_raw_image(image_params)
 
         # channel finding was also done on images after orientation was fixed
         image_data = fix_orientation(image_data)
@@ -870,6 +1974,10 @@ def hdf5_stack_slice_and_write(images_to_write, channel_masks, analyzed_imgs):
     # concatenate the list into one big ass stack
     image_fov_stack = np.stack(image_fov_stack, axis=0)
 
+    # drift of each time point, if it is corrected
+    fov_drift = [get_image_drift(analyzed_imgs[image[0]]) for image in images_to_write]
+    fov_drift = np.array(fov_drift) if fov_drift[0] is not None else None
+
     # create the HDF5 file for the FOV, first time this is being done.
     with h5py.File(os.path.join(params['hdf5_dir'],'xy%03d.hdf5' % fov_id), 'w', libver='earliest') as h5f:
 
@@ -895,6 +2003,7 @@ def hdf5_stack_slice_and_write(images_to_write, channel_masks, analyzed_imgs):
                                   compression="gzip", shuffle=True, fletcher32=True)
 
         # cut out the channels as per channel masks for this fov
+        thumbnails = {} # first and last phase image and kymograph of each channel for ChannelPicker
         for peak, channel_loc in six.iteritems(channel_masks[fov_id]):
             #information('Slicing and saving channel peak %s.' % channel_filename.split('/')[-1])
             information('Slicing and saving channel peak %d.' % peak)
@@ -913,7 +2022,8 @@ def hdf5_stack_slice_and_write(images_to_write, channel_masks, analyzed_imgs):
 
             # slice out channel.
             # The function should recognize the shape length as 4 and cut all time points
-            channel_stack = cut_slice(image_fov_stack, channel_loc)
+            channel_stack = cut_slice(image_fov_stack, channel_loc, shift=fov_drift)
+            thumbnails[peak] = get_channel_thumbnail(channel_stack[:,:,:,get_phase_plane_index(channel_stack.shape[3])])
 
             # save a different dataset for all colors
             for color_index in range(channel_stack.shape[3]):
@@ -930,15 +2040,334 @@ def hdf5_stack_slice_and_write(images_to_write, channel_masks, analyzed_imgs):
                 # write the data even though we have more to write (free up memory)
                 h5f.flush()
 
+    save_channel_thumbnails(fov_id, thumbnails)
+
     return
 
-def tileImage(img, subImageNumber):
-    divisor = int(np.sqrt(subImageNumber))
-    M = img.shape[0]//divisor
-    N = img.shape[0]//divisor
-    #print(img.shape, M, N, divisor, subImageNumber)
-    tiles = np.asarray([img[x:x+M,y:y+N] for x in range(0,img.shape[0],M) for y in range(0,img.shape[1],N)])
-    return(tiles)
+# loads one raw image ready for slicing
+def load_slicing_frame(image_params):
+    '''Loads a raw image, fixes the orientation and returns it as Y, X, Plane,
+    the form used by cut_slice.
+    '''
+
+    # load the image, from TIFF or the raw HDF5 store
+    image_data = load_raw_image(image_params)
+
+    # channel finding was also done on images after orientation was fixed
+    image_data = fix_orientation(image_data)
+
+    # add additional axis if the image is flat
+    if len(image_data.shape) == 2:
+        image_data = np.expand_dims(image_data, 0)
+
+    # change axis so it goes Y, X, Plane
+    return np.rollaxis(image_data, 0, 3)
+
+# streaming version of tiff_stack_slice_and_write
+def tiff_stream_slice_and_write(images_to_write, channel_masks, analyzed_imgs, frames_per_write=16):
+    '''Writes out stacks of TIFF images per channel and color, like tiff_stack_slice_and_write,
+    but only one raw frame is in memory at a time. The channel slices of each frame go into
+    a temporary memory mapped file per channel, which is then written out as the TIFF stacks.
+
+    Parameters
+    images_to_write : list
+        [image name, t] pairs for one FOV, in time order.
+    frames_per_write : int
+        Number of slices buffered per channel before they are written to the memory map.
+
+    Called by
+    mm3_Compile.py __main__
+    '''
+
+    n_frames = len(images_to_write)
+    fov_id = analyzed_imgs[images_to_write[0][0]]['fov']
+    fov_channel_masks = channel_masks[fov_id]
+    peaks = sorted(fov_channel_masks.keys())
+
+    mmaps = {} # per peak, memory mapped stack in the form [c, t, y, x]
+    buffers = {} # per peak, the last frames_per_write slices in the form [t, y, x, c]
+    n_buffered = 0
+    n_written = 0
+
+    for n, image in enumerate(images_to_write):
+        image_params = analyzed_imgs[image[0]]
+        information("Loading %s." % image_params['filepath'].split('/')[-1])
+
+        image_data = load_slicing_frame(image_params)
+
+        # make the buffers and memory maps once the number of planes is known
+        if n == 0:
+            for peak in peaks:
+                channel_loc = fov_channel_masks[peak]
+                slice_shape = (channel_loc[0][1] - channel_loc[0][0],
+                               channel_loc[1][1] - channel_loc[1][0],
+                               image_data.shape[2])
+                buffers[peak] = np.empty((frames_per_write,) + slice_shape, dtype=image_data.dtype)
+                mmaps[peak] = np.memmap(os.path.join(params['chnl_dir'], 'xy%03d_p%04d.tmp' % (fov_id, peak)),
+                                        dtype=image_data.dtype, mode='w+',
+                                        shape=(slice_shape[2], n_frames, slice_shape[0], slice_shape[1]))
+
+        # slice out the channels of this frame
+        drift = get_image_drift(image_params)
+        for peak in peaks:
+            if drift is None:
+                buffers[peak][n_buffered] = cut_slice(image_data[np.newaxis], fov_channel_masks[peak])[0]
+            else:
+                buffers[peak][n_buffered] = cut_slice(image_data, fov_channel_masks[peak], shift=drift)
+        n_buffered += 1
+
+        # move full buffers to the memory maps
+        if n_buffered == frames_per_write or n == n_frames - 1:
+            for peak in peaks:
+                mmaps[peak][:, n_written:n_written+n_buffered] = np.moveaxis(buffers[peak][:n_buffered], 3, 0)
+            n_written += n_buffered
+            n_buffered = 0
+
+    # save a different time stack for all colors
+    thumbnails = {} # first and last phase image and kymograph of each channel for ChannelPicker
+    for peak in peaks:
+        information('Saving channel peak %d.' % peak)
+        for color_index in range(mmaps[peak].shape[0]):
+            # this is the filename for the channel
+            channel_filename = os.path.join(params['chnl_dir'], params['experiment_name'] + '_xy%03d_p%04d_c%1d.tif' % (fov_id, peak, color_index+1))
+            tiff.imsave(channel_filename, mmaps[peak][color_index], compress=4)
+
+        thumbnails[peak] = get_channel_thumbnail(mmaps[peak][get_phase_plane_index(mmaps[peak].shape[0])])
+
+        # remove the temporary file
+        mmap_filename = mmaps[peak].filename
+        del mmaps[peak]
+        os.remove(mmap_filename)
+
+    save_channel_thumbnails(fov_id, thumbnails)
+
+    return
+
+# streaming version of hdf5_stack_slice_and_write
+def hdf5_stream_slice_and_write(images_to_write, channel_masks, analyzed_imgs, frames_per_write=16):
+    '''Writes out stacks of images per channel and color to an HDF5 file, like
+    hdf5_stack_slice_and_write, but only one raw frame is in memory at a time.
+    The datasets are preallocated for all frames and the channel slices are written in
+    blocks of frames_per_write frames. The output file has the same layout.
+
+    Called by
+    mm3_Compile.py __main__
+    '''
+
+    n_frames = len(images_to_write)
+    image_names = [image[0] for image in images_to_write]
+
+    # declare identification variables for saving using first image
+    first_params = analyzed_imgs[image_names[0]]
+    fov_id = first_params['fov']
+    fov_channel_masks = channel_masks[fov_id]
+    peaks = sorted(fov_channel_masks.keys())
+
+    # create the HDF5 file for the FOV, first time this is being done.
+    with h5py.File(os.path.join(params['hdf5_dir'],'xy%03d.hdf5' % fov_id), 'w', libver='earliest') as h5f:
+
+        # add in metadata for this FOV
+        # these attributes should be common for all channel
+        h5f.attrs.create('fov_id', fov_id)
+        h5f.attrs.create('stage_x_loc', first_params['x'])
+        h5f.attrs.create('stage_y_loc', first_params['y'])
+        h5f.attrs.create('image_shape', first_params['shape'])
+        # encoding is because HDF5 has problems with numpy unicode
+        h5f.attrs.create('planes', [plane.encode('utf8') for plane in first_params['planes']])
+        h5f.attrs.create('peaks', peaks)
+
+        # this is for things that change across time, for these create a dataset
+        image_times = [analyzed_imgs[image_name]['t'] for image_name in image_names]
+        image_jds = [analyzed_imgs[image_name]['jd'] for image_name in image_names]
+        h5ds = h5f.create_dataset(u'filenames', data=np.expand_dims(image_names, 1).astype('S100'),
+                                  chunks=True, maxshape=(None, 1), dtype='S100',
+                                  compression="gzip", shuffle=True, fletcher32=True)
+        h5ds = h5f.create_dataset(u'times', data=np.expand_dims(image_times, 1),
+                                  chunks=True, maxshape=(None, 1),
+                                  compression="gzip", shuffle=True, fletcher32=True)
+        h5ds = h5f.create_dataset(u'times_jd', data=np.expand_dims(image_jds, 1),
+                                  chunks=True, maxshape=(None, 1),
+                                  compression="gzip", shuffle=True, fletcher32=True)
+
+        buffers = {} # per peak, the last frames_per_write slices in the form [t, y, x, c]
+        kymographs = {} # per peak, centre column of the phase plane in the form [t, y]
+        n_buffered = 0
+        n_written = 0
+
+        for n, image_name in enumerate(image_names):
+            image_params = analyzed_imgs[image_name]
+            information("Loading %s." % image_params['filepath'].split('/')[-1])
+
+            image_data = load_slicing_frame(image_params)
+
+            # create the groups and datasets once the number of planes is known
+            if n == 0:
+                for peak in peaks:
+                    channel_loc = fov_channel_masks[peak]
+
+                    # create group for this channel
+                    h5g = h5f.create_group('channel_%04d' % peak)
+
+                    # add attribute for peak_id, channel location
+                    h5g.attrs.create('peak_id', peak)
+                    h5g.attrs.create('channel_loc', channel_loc)
+
+                    slice_shape = (channel_loc[0][1] - channel_loc[0][0],
+                                   channel_loc[1][1] - channel_loc[1][0])
+                    buffers[peak] = np.empty((frames_per_write,) + slice_shape + (image_data.shape[2],),
+                                             dtype=image_data.dtype)
+                    kymographs[peak] = np.empty((n_frames, slice_shape[0]), dtype=image_data.dtype)
+
+                    # preallocate a dataset for all colors
+                    for color_index in range(image_data.shape[2]):
+                        h5ds = h5g.create_dataset(u'p%04d_c%1d' % (peak, color_index+1),
+                                        shape=(n_frames,) + slice_shape, dtype=image_data.dtype,
+                                        chunks=(1,) + slice_shape,
+                                        maxshape=(None,) + slice_shape,
+                                        compression="gzip", shuffle=True, fletcher32=True)
+
+            # slice out the channels of this frame
+            drift = get_image_drift(image_params)
+            for peak in peaks:
+                if drift is None:
+                    buffers[peak][n_buffered] = cut_slice(image_data[np.newaxis], fov_channel_masks[peak])[0]
+                else:
+                    buffers[peak][n_buffered] = cut_slice(image_data, fov_channel_masks[peak], shift=drift)
+            n_buffered += 1
+
+            # write full buffers to the datasets
+            if n_buffered == frames_per_write or n == n_frames - 1:
+                for peak in peaks:
+                    h5g = h5f['channel_%04d' % peak]
+                    for color_index in range(buffers[peak].shape[3]):
+                        h5g[u'p%04d_c%1d' % (peak, color_index+1)][n_written:n_written+n_buffered] = \
+                            buffers[peak][:n_buffered, :, :, color_index]
+                    kymographs[peak][n_written:n_written+n_buffered] = \
+                        buffers[peak][:n_buffered, :, buffers[peak].shape[2] // 2,
+                                      get_phase_plane_index(buffers[peak].shape[3])]
+                n_written += n_buffered
+                n_buffered = 0
+
+                # write the data even though we have more to write (free up memory)
+                h5f.flush()
+
+        # first and last phase image of each channel for ChannelPicker, read back from the file.
+        # The kymographs were kept while writing.
+        thumbnails = {}
+        for peak in peaks:
+            h5g = h5f['channel_%04d' % peak]
+            phase_index = get_phase_plane_index(len(h5g.keys()))
+            thumbnails[peak] = get_channel_thumbnail(h5g[u'p%04d_c%1d' % (peak, phase_index+1)],
+                                                     kymographs[peak])
+
+    save_channel_thumbnails(fov_id, thumbnails)
+
+    return
+
+# channel masks in a form which can be saved as json and compared
+def jsonable_channel_masks(fov_channel_masks):
+    return {str(peak) : [[int(v) for v in pair] for pair in channel_loc]
+            for peak, channel_loc in six.iteritems(fov_channel_masks)}
+
+# path of the file which marks an fov as sliced
+def get_slicing_marker_path(fov_id):
+    if params['output'] == 'HDF5':
+        return os.path.join(params['hdf5_dir'], 'xy%03d_sliced.json' % fov_id)
+    else:
+        return os.path.join(params['chnl_dir'], 'xy%03d_sliced.json' % fov_id)
+
+# make the contents of the slicing marker
+def make_slicing_marker(fov_id, images_to_write, channel_masks, analyzed_imgs=None):
+    marker = {'fov' : fov_id,
+              'output' : params['output'],
+              'n_frames' : len(images_to_write),
+              'images' : [image[0] for image in images_to_write],
+              'channel_masks' : jsonable_channel_masks(channel_masks[fov_id])}
+
+    # slices depend on the drift too if it is corrected
+    if analyzed_imgs is not None and use_drift_correction():
+        marker['drift'] = [[int(d) for d in analyzed_imgs[image[0]].get('drift', [0, 0])]
+                           for image in images_to_write]
+
+    return marker
+
+# checks if an fov was already sliced with the same images and channel masks
+def check_slicing_marker(fov_id, images_to_write, channel_masks, analyzed_imgs=None):
+    '''Returns True if the marker of a finished slicing exists for the fov and it was made
+    from the same images and channel masks, so the fov does not need to be sliced again.
+    '''
+
+    marker_path = get_slicing_marker_path(fov_id)
+    if not os.path.isfile(marker_path):
+        return False
+
+    try:
+        with open(marker_path, 'r') as marker_file:
+            marker = json.load(marker_file)
+    except:
+        return False
+
+    return marker == make_slicing_marker(fov_id, images_to_write, channel_masks, analyzed_imgs)
+
+# estimated peak memory of slicing one fov, in bytes
+def estimate_slicing_memory(images_to_write, channel_masks, analyzed_imgs, stream_slicing,
+                            frames_per_write=16):
+    '''Rough estimate of the memory needed to slice one fov, assuming 16 bit images.
+    The streaming slicers hold one frame plus the write buffers. The stack slicers hold all
+    frames twice (the list and the stack) while stacking.
+    '''
+
+    image_params = analyzed_imgs[images_to_write[0][0]]
+    n_planes = max(len(image_params['planes']), 1)
+    frame_bytes = image_params['shape'][0] * image_params['shape'][1] * n_planes * 2
+
+    if stream_slicing:
+        slice_bytes = 0
+        for channel_loc in channel_masks[image_params['fov']].values():
+            slice_bytes += ((channel_loc[0][1] - channel_loc[0][0]) *
+                            (channel_loc[1][1] - channel_loc[1][0]) * n_planes * 2)
+        return 2 * frame_bytes + frames_per_write * slice_bytes
+    else:
+        return 2 * len(images_to_write) * frame_bytes
+
+# worker function for slicing an fov
+def slice_fov(fov_id, images_to_write, channel_masks, analyzed_imgs, stream_slicing=True):
+    '''Slices all channels of one fov with the slicer for params['output'] and then writes
+    the completion marker. The marker is removed first, so an fov which fails half way
+    is sliced again when Compile is rerun.
+
+    Called by
+    mm3_Compile.py __main__
+    '''
+
+    marker_path = get_slicing_marker_path(fov_id)
+    if os.path.isfile(marker_path):
+        os.remove(marker_path)
+
+    information("Slicing FOV %03d." % fov_id)
+
+    if params['output'] == 'TIFF' and stream_slicing:
+        # load one frame at a time and write the channel slices as they are cut
+        tiff_stream_slice_and_write(images_to_write, channel_masks, analyzed_imgs)
+
+    elif params['output'] == 'TIFF':
+        #This is for loading the whole raw tiff stack and then slicing through it
+        tiff_stack_slice_and_write(images_to_write, channel_masks, analyzed_imgs)
+
+    elif params['output'] == 'HDF5' and stream_slicing:
+        # Or write it to hdf5 one frame at a time
+        hdf5_stream_slice_and_write(images_to_write, channel_masks, analyzed_imgs)
+
+    elif params['output'] == 'HDF5':
+        # Or write it to hdf5
+        hdf5_stack_slice_and_write(images_to_write, channel_masks, analyzed_imgs)
+
+    with open(marker_path, 'w') as marker_file:
+        json.dump(make_slicing_marker(fov_id, images_to_write, channel_masks, analyzed_imgs), marker_file)
+
+    information("Finished slicing FOV %03d." % fov_id)
+
+    return fov_id
 
 def get_weights(img, subImageNumber):
     divisor = int(np.sqrt(subImageNumber))
@@ -961,81 +2390,386 @@ def permute_image(img, trap_align_metadata):
 
     return(img)
 
-def imageConcatenatorFeatures(imgStack, subImageNumber = 64):
+### channel thumbnails
+# Small first and last phase images and the centre column kymograph of every channel,
+# saved per FOV while slicing in Compile, so ChannelPicker can show and classify a FOV
+# without opening each channel stack.
+
+# index of the phase plane in a stack with n_planes planes
+def get_phase_plane_index(n_planes):
+    return min(int(params['phase_plane'][1:]) - 1, n_planes - 1)
+
+# path of the thumbnail file for a FOV
+def get_thumbnail_path(fov_id):
+    return os.path.join(params['ana_dir'], 'thumbnails', 'xy%03d_thumbnails.hdf5' % fov_id)
+
+# the time indicies shown for each channel by ChannelPicker
+def get_thumbnail_frames():
+    if 'channel_picker' in params and params['channel_picker'] and 'first_image' in params['channel_picker']:
+        return int(params['channel_picker']['first_image']), int(params['channel_picker']['last_image'])
+    return 0, -1
+
+# average blocks of factor by factor pixels, on the last two axes
+def downsample_images(images, factor=2):
+    images = np.asarray(images)
+    y_size = images.shape[-2] // factor
+    x_size = images.shape[-1] // factor
+    blocks = images[..., :y_size*factor, :x_size*factor].reshape(
+                images.shape[:-2] + (y_size, factor, x_size, factor))
+    return blocks.mean(axis=(-3, -1)).astype(images.dtype)
+
+# the first and last images of a phase stack, reading only those two frames, and its kymograph
+def get_channel_thumbnail(phase_stack, kymograph=None):
+    '''
+    Parameters
+    ----------
+    phase_stack : array, memory map or HDF5 dataset
+        Phase stack of shape (t, y, x).
+    kymograph : 2D array
+        The centre column through time, (t, y), if it was already taken while
+        slicing. Otherwise it is taken from phase_stack.
 
-    rowNumPerImage = int(np.sqrt(subImageNumber)) # here I'm assuming our large images are square, with equal number of crops in each dimension
-    #print(rowNumPerImage)
-    imageNum = int(imgStack.shape[0]/subImageNumber) # total number of sub-images divided by the number of sub-images in each original large image
-    iterNum = int(imageNum*rowNumPerImage)
-    imageDims = int(np.sqrt(imgStack.shape[1]*imgStack.shape[2]*subImageNumber))
-    featureNum = int(imgStack.shape[3])
-    bigImg = np.zeros(shape=(imageNum, imageDims, imageDims, featureNum), dtype='float32') # create array to store reconstructed images
+    Returns
+    -------
+    first_img, last_img : 2D arrays
+    kymograph : 2D array
+    '''
+    n_frames = phase_stack.shape[0]
+    frames = np.clip(get_thumbnail_frames(), -n_frames, n_frames - 1)
+    first_index, last_index = np.arange(n_frames)[frames]
+    if kymograph is None:
+        kymograph = np.asarray(phase_stack[:, :, phase_stack.shape[2] // 2])
+    return np.asarray(phase_stack[int(first_index)]), np.asarray(phase_stack[int(last_index)]), kymograph
+
+# save the thumbnails of all channels in a FOV, made with get_channel_thumbnail
+def save_channel_thumbnails(fov_id, thumbnails, factor=2):
+    '''
+    Parameters
+    ----------
+    fov_id : int
+    thumbnails : dict
+        (first_img, last_img, kymograph) per peak.
+    factor : int
+        Images are shrunk by this factor. Kymographs are saved at full size.
+    '''
+
+    peaks = sorted(thumbnails.keys())
+    if not peaks:
+        return
+
+    # channels are padded to the biggest one
+    shapes = np.array([[dim // factor for dim in thumbnails[peak][0].shape] for peak in peaks])
+    images = np.zeros((len(peaks), 2) + tuple(shapes.max(axis=0)), dtype=thumbnails[peaks[0]][0].dtype)
+    for i, peak in enumerate(peaks):
+        images[i, :, :shapes[i, 0], :shapes[i, 1]] = downsample_images(thumbnails[peak][:2], factor)
+
+    # kymographs are padded the same way
+    kymograph_shapes = np.array([thumbnails[peak][2].shape for peak in peaks])
+    kymographs = np.zeros((len(peaks),) + tuple(kymograph_shapes.max(axis=0)), dtype=thumbnails[peaks[0]][2].dtype)
+    for i, peak in enumerate(peaks):
+        kymographs[i, :kymograph_shapes[i, 0], :kymograph_shapes[i, 1]] = thumbnails[peak][2]
+
+    thumbnail_path = get_thumbnail_path(fov_id)
+    make_dirs(os.path.dirname(thumbnail_path))
+
+    with h5py.File(thumbnail_path, 'w') as h5f:
+        h5f.attrs.create('frames', get_thumbnail_frames())
+        h5f.attrs.create('factor', factor)
+        h5f.create_dataset('peaks', data=np.array(peaks, dtype='int64'))
+        h5f.create_dataset('shapes', data=shapes)
+        h5f.create_dataset('first', data=images[:, 0])
+        h5f.create_dataset('last', data=images[:, 1])
+        h5f.create_dataset('kymograph_shapes', data=kymograph_shapes)
+        h5f.create_dataset('kymographs', data=kymographs, chunks=(1,) + kymographs.shape[1:],
+                           compression="gzip", shuffle=True)
+
+# load the thumbnails of a FOV
+def load_channel_thumbnails(fov_id):
+    '''
+    Returns
+    -------
+    thumbnails : dict or None
+        {peak : {'first' : img, 'last' : img}}, the form used by ChannelPicker.
+        None if there are no thumbnails, or they are of other frames than
+        the ones in params['channel_picker'].
+    '''
+
+    thumbnail_path = get_thumbnail_path(fov_id)
+    if not os.path.isfile(thumbnail_path):
+        return None
 
-    featureRowDicts = []
+    with h5py.File(thumbnail_path, 'r') as h5f:
+        if tuple(h5f.attrs['frames']) != get_thumbnail_frames():
+            return None
+        peaks = h5f['peaks'][:]
+        shapes = h5f['shapes'][:]
+        first_imgs = h5f['first'][:]
+        last_imgs = h5f['last'][:]
 
-    for j in range(featureNum):
+    return {int(peak) : {'first' : first_imgs[i, :shapes[i, 0], :shapes[i, 1]],
+                         'last' : last_imgs[i, :shapes[i, 0], :shapes[i, 1]]}
+            for i, peak in enumerate(peaks)}
+
+# load the centre column kymographs of all channels in a FOV
+def load_channel_kymographs(fov_id):
+    '''
+    Returns
+    -------
+    kymographs : dict or None
+        (t, y) kymograph of the phase plane per peak. None if they were not saved.
+    '''
 
-        rowDict = {}
+    thumbnail_path = get_thumbnail_path(fov_id)
+    if not os.path.isfile(thumbnail_path):
+        return None
 
-        for i in range(iterNum):
-            baseNum = int(i*iterNum/imageNum)
-            # concatenate columns of 256x256 images to build each 256x2048 row
-            rowDict[i] = np.column_stack((imgStack[baseNum,:,:,j],imgStack[baseNum+1,:,:,j],
-                                          imgStack[baseNum+2,:,:,j], imgStack[baseNum+3,:,:,j]))#,
-                                          #imgStack[baseNum+4,:,:,j],imgStack[baseNum+5,:,:,j],
-                                          #imgStack[baseNum+6,:,:,j],imgStack[baseNum+7,:,:,j]))
-        featureRowDicts.append(rowDict)
+    with h5py.File(thumbnail_path, 'r') as h5f:
+        if not 'kymographs' in h5f:
+            return None
+        peaks = h5f['peaks'][:]
+        shapes = h5f['kymograph_shapes'][:]
+        kymographs = h5f['kymographs'][:]
 
-    for j in range(featureNum):
+    return {int(peak) : kymographs[i, :shapes[i, 0], :shapes[i, 1]] for i, peak in enumerate(peaks)}
 
-        for i in range(imageNum):
-            baseNum = int(i*rowNumPerImage)
-            # concatenate appropriate 256x2048 rows to build a 2048x2048 image and place it into bigImg
-            bigImg[i,:,:,j] = np.row_stack((featureRowDicts[j][baseNum],featureRowDicts[j][baseNum+1],
-                                            featureRowDicts[j][baseNum+2],featureRowDicts[j][baseNum+3]))#,
-                                            #featureRowDicts[j][baseNum+4],featureRowDicts[j][baseNum+5],
-                                            #featureRowDicts[j][baseNum+6],featureRowDicts[j][baseNum+7]))
+# make the kymograph of one channel from its stack, for when they were not saved by Compile
+def make_channel_kymograph(fov_id, peak_id):
+    return get_channel_thumbnail(load_stack(fov_id, peak_id, color=params['phase_plane']))[2]
 
-    return(bigImg)
+# put kymographs into one array for the channel classifier
+def make_kymograph_batch(kymographs, dim):
+    '''
+    Kymographs are cut or padded with zeros to dim[0] time points, like
+    TrapKymographPredictionDataGenerator does.
 
-def imageConcatenatorFeatures2(imgStack, subImageNumber = 81):
+    Parameters
+    ----------
+    kymographs : list of 2D arrays (t, y)
+    dim : tuple
+        (time points, y) the model takes.
+
+    Returns
+    -------
+    X : 4D float array (n, dim[0], dim[1], 1)
+    '''
+
+    X = np.zeros((len(kymographs), dim[0], dim[1], 1))
+    for i, kymograph in enumerate(kymographs):
+        t_end = min(kymograph.shape[0], dim[0])
+        X[i, :t_end, :, 0] = kymograph[:t_end]
+    return X
+
+# put channel images side by side in one image, to show a whole FOV at once
+def make_channel_montage(images, gap=2):
+    '''
+    Each image is rescaled to 0-1 by its own minimum and maximum, like
+    skimage.exposure.rescale_intensity.
+
+    Parameters
+    ----------
+    images : list of 2D arrays
+    gap : int
+        Pixels between images.
+
+    Returns
+    -------
+    montage : 2D float array
+        Gaps and the space below shorter images are nan.
+    x_ranges : 2D int array
+        (start, stop) columns of each image in the montage.
+    '''
+
+    widths = np.array([img.shape[1] for img in images], dtype='int64')
+    x_starts = np.cumsum(widths + gap) - (widths + gap)
+    x_ranges = np.stack((x_starts, x_starts + widths), axis=1)
+
+    height = max(img.shape[0] for img in images) if images else 0
+    width = x_ranges[-1, 1] if images else 0
+    montage = np.full((height, width), np.nan)
+    for img, (x_start, x_stop) in zip(images, x_ranges):
+        img = img.astype('float64')
+        img_min, img_max = np.amin(img), np.amax(img)
+        montage[:img.shape[0], x_start:x_stop] = (img - img_min) / max(img_max - img_min, 1e-12)
+
+    return montage, x_ranges
+
+### tiling engine for running models on full frames
+# Images are cut into tiles of any size with an overlap between neighbours, and the model
+# outputs for the tiles are stitched back together. Cutting uses a strided view and
+# stitching without overlap is a reshape, so there is no concatenating in Python loops.
+
+# puts tiles in row major order back together into one image
+def untile_image(tiles, n_rows, n_cols):
+    '''Inverse of tileImage for tiles of shape (n_rows * n_cols, y, x, ...).
+    Done with a reshape and transpose rather than stacking the tiles one at a time.
+    '''
+
+    tile_rows, tile_cols = tiles.shape[1], tiles.shape[2]
+    extra_shape = tiles.shape[3:]
+    tiles = tiles.reshape((n_rows, n_cols, tile_rows, tile_cols) + extra_shape)
+    tiles = np.swapaxes(tiles, 1, 2) # rows, tile rows, cols, tile cols
+    return tiles.reshape((n_rows * tile_rows, n_cols * tile_cols) + extra_shape)
+
+# makes overlap an (y, x) pair
+def get_overlap_pair(overlap):
+    if np.isscalar(overlap):
+        return (int(overlap), int(overlap))
+    return (int(overlap[0]), int(overlap[1]))
+
+# number of tiles and padded size along one axis
+def get_tile_count(length, tile_length, overlap):
+    step = tile_length - overlap
+    n_tiles = max(int(np.ceil(float(length - overlap) / step)), 1)
+    return n_tiles, (n_tiles - 1) * step + tile_length
+
+def tile_image(img, tile_shape, overlap=0):
+    '''Cuts an image into tiles in row major order.
+
+    Parameters
+    img : np.ndarray
+        Image of shape (y, x, ...). Extra axes, such as features, are kept in the tiles.
+    tile_shape : (int, int)
+        Rows and columns of a tile.
+    overlap : int or (int, int)
+        Pixels shared by neighbouring tiles. Must be smaller than the tile.
+
+    Returns
+    tiles : np.ndarray
+        Shape (n_rows * n_cols, tile rows, tile cols, ...). The image is padded with zeros
+        at the bottom and right so the tiles cover it.
+    layout : (int, int)
+        Number of tile rows and columns, needed by stitch_tiles.
+    '''
+
+    overlap = get_overlap_pair(overlap)
+    n_rows, padded_rows = get_tile_count(img.shape[0], tile_shape[0], overlap[0])
+    n_cols, padded_cols = get_tile_count(img.shape[1], tile_shape[1], overlap[1])
+
+    # pad at the far edges if the tiles do not fit exactly
+    if padded_rows != img.shape[0] or padded_cols != img.shape[1]:
+        pad_width = [(0, padded_rows - img.shape[0]), (0, padded_cols - img.shape[1])]
+        pad_width += [(0, 0)] * (len(img.shape) - 2)
+        img = np.pad(img, pad_width, mode='constant')
+    img = np.ascontiguousarray(img)
+
+    # strided view of all tiles, (n_rows, n_cols, tile rows, tile cols, ...)
+    step = (tile_shape[0] - overlap[0], tile_shape[1] - overlap[1])
+    view_shape = (n_rows, n_cols, tile_shape[0], tile_shape[1]) + img.shape[2:]
+    view_strides = (img.strides[0] * step[0], img.strides[1] * step[1]) + img.strides
+    tiles = np.lib.stride_tricks.as_strided(img, shape=view_shape, strides=view_strides,
+                                            writeable=False)
+
+    return tiles.reshape((n_rows * n_cols,) + view_shape[2:]), (n_rows, n_cols)
+
+# weights of a tile for linear blending
+def get_tile_blend_weights(tile_shape, overlap):
+    weights_1d = []
+    for tile_length, overlap_length in zip(tile_shape, overlap):
+        ramp = np.ones(tile_length, dtype='float32')
+        if overlap_length > 0:
+            edge = np.arange(1, overlap_length + 1, dtype='float32') / (overlap_length + 1)
+            ramp[:overlap_length] = edge
+            ramp[-overlap_length:] = np.minimum(ramp[-overlap_length:], edge[::-1])
+        weights_1d.append(ramp)
+    return np.outer(weights_1d[0], weights_1d[1])
+
+def stitch_tiles(tiles, layout, image_shape, overlap=0, blend='linear'):
+    '''Puts tiles from tile_image, or model outputs for them, back into one image.
+
+    Parameters
+    tiles : np.ndarray
+        Shape (n_rows * n_cols, tile rows, tile cols, ...) in row major order.
+    layout : (int, int)
+        Number of tile rows and columns, from tile_image.
+    image_shape : (int, int)
+        Rows and columns of the original image. The padding is cropped off.
+    overlap : int or (int, int)
+        Overlap used by tile_image.
+    blend : str
+        How overlapping pixels are combined. 'linear' is a weighted mean with weights
+        falling off linearly inside the overlap, so tile edges have the least say.
+        'crop' keeps the central part of each tile, split at the middle of the overlap.
+        Any other value raises ValueError.
+
+    Returns
+    image : np.ndarray
+        Shape (image rows, image cols, ...).
+    '''
+
+    if blend not in ('linear', 'crop'):
+        raise ValueError("blend must be 'linear' or 'crop', not %r" % (blend,))
+
+    overlap = get_overlap_pair(overlap)
+    n_rows, n_cols = layout
+    tile_rows, tile_cols = tiles.shape[1], tiles.shape[2]
+    extra_shape = tiles.shape[3:]
+
+    # without overlap the tiles just sit next to each other
+    if overlap == (0, 0):
+        image = untile_image(tiles, n_rows, n_cols)
+        return image[:image_shape[0], :image_shape[1]]
+
+    step = (tile_rows - overlap[0], tile_cols - overlap[1])
+    padded_shape = ((n_rows - 1) * step[0] + tile_rows, (n_cols - 1) * step[1] + tile_cols)
+
+    if blend == 'crop':
+        # each tile keeps its part up to the middle of the overlap, edge tiles keep the edges
+        image = np.zeros(padded_shape + extra_shape, dtype=tiles.dtype)
+        lo = (overlap[0] // 2, overlap[1] // 2)
+        hi = (overlap[0] - lo[0], overlap[1] - lo[1])
+        for tile_index in range(n_rows * n_cols):
+            row, col = tile_index // n_cols, tile_index % n_cols
+            y0 = 0 if row == 0 else lo[0]
+            y1 = tile_rows if row == n_rows - 1 else tile_rows - hi[0]
+            x0 = 0 if col == 0 else lo[1]
+            x1 = tile_cols if col == n_cols - 1 else tile_cols - hi[1]
+            y, x = row * step[0], col * step[1]
+            image[y+y0:y+y1, x+x0:x+x1] = tiles[tile_index, y0:y1, x0:x1]
+
+        return image[:image_shape[0], :image_shape[1]]
+
+    # weighted accumulation of the tiles
+    weights = get_tile_blend_weights((tile_rows, tile_cols), overlap)
+    weights = weights.reshape(weights.shape + (1,) * len(extra_shape))
+    image = np.zeros(padded_shape + extra_shape, dtype='float32')
+    weight_sum = np.zeros(padded_shape + (1,) * len(extra_shape), dtype='float32')
+
+    for tile_index in range(n_rows * n_cols):
+        y = (tile_index // n_cols) * step[0]
+        x = (tile_index % n_cols) * step[1]
+        image[y:y+tile_rows, x:x+tile_cols] += tiles[tile_index] * weights
+        weight_sum[y:y+tile_rows, x:x+tile_cols] += weights
+
+    image /= weight_sum
+
+    return image[:image_shape[0], :image_shape[1]]
+
+def tileImage(img, subImageNumber):
+    '''Cuts a square image into subImageNumber equal tiles, in row major order.'''
+    divisor = int(np.sqrt(subImageNumber))
+    M = img.shape[0]//divisor
+    tiles, layout = tile_image(img, (M, M))
+    return(tiles)
+
+def imageConcatenatorFeatures(imgStack, subImageNumber = 64):
+    '''Puts the tiles of tileImage back together into square images, for stacks of tiles
+    from several images of shape (images * subImageNumber, y, x, features).
+    '''
 
     rowNumPerImage = int(np.sqrt(subImageNumber)) # here I'm assuming our large images are square, with equal number of crops in each dimension
     imageNum = int(imgStack.shape[0]/subImageNumber) # total number of sub-images divided by the number of sub-images in each original large image
-    iterNum = int(imageNum*rowNumPerImage)
-    imageDims = int(np.sqrt(imgStack.shape[1]*imgStack.shape[2]*subImageNumber))
-    featureNum = int(imgStack.shape[3])
-    bigImg = np.zeros(shape=(imageNum, imageDims, imageDims, featureNum), dtype='float32') # create array to store reconstructed images
-
-    featureRowDicts = []
-
-    for j in range(featureNum):
-
-        rowDict = {}
-
-        for i in range(iterNum):
-            baseNum = int(i*iterNum/imageNum)
-            # concatenate columns of 256x256 images to build each 256x2048 row
-            rowDict[i] = np.column_stack((imgStack[baseNum,:,:,j],imgStack[baseNum+1,:,:,j],
-                                          imgStack[baseNum+2,:,:,j], imgStack[baseNum+3,:,:,j],
-                                          imgStack[baseNum+4,:,:,j]))#,imgStack[baseNum+5,:,:,j],
-                                          #imgStack[baseNum+6,:,:,j],imgStack[baseNum+7,:,:,j],
-                                         #imgStack[baseNum+8,:,:,j]))
-        featureRowDicts.append(rowDict)
-
-    for j in range(featureNum):
-
-        for i in range(imageNum):
-            baseNum = int(i*rowNumPerImage)
-            # concatenate appropriate 256x2048 rows to build a 2048x2048 image and place it into bigImg
-            bigImg[i,:,:,j] = np.row_stack((featureRowDicts[j][baseNum],featureRowDicts[j][baseNum+1],
-                                            featureRowDicts[j][baseNum+2],featureRowDicts[j][baseNum+3],
-                                            featureRowDicts[j][baseNum+4]))#,featureRowDicts[j][baseNum+5],
-                                            #featureRowDicts[j][baseNum+6],featureRowDicts[j][baseNum+7],
-                                            #featureRowDicts[j][baseNum+8]))
+    imageDims = rowNumPerImage * imgStack.shape[1]
+
+    bigImg = np.zeros(shape=(imageNum, imageDims, imageDims, imgStack.shape[3]), dtype='float32')
+    for i in range(imageNum):
+        bigImg[i] = untile_image(imgStack[i*subImageNumber:(i+1)*subImageNumber], rowNumPerImage, rowNumPerImage)
 
     return(bigImg)
 
+def imageConcatenatorFeatures2(imgStack, subImageNumber = 81):
+    '''Same as imageConcatenatorFeatures, kept for the expanded crop sets.'''
+    return(imageConcatenatorFeatures(imgStack, subImageNumber=subImageNumber))
+
 def get_weights_array(arr=np.zeros((2048,2048)), shiftDistance=128, subImageNumber=64, padSubImageNumber=81):
 
     originalImageWeights = get_weights(arr, subImageNumber=subImageNumber)
@@ -1056,6 +2790,10 @@ def get_weights_array(arr=np.zeros((2048,2048)), shiftDistance=128, subImageNumb
 
 # predicts locations of channels in an image using deep learning model
 def get_frame_predictions(img,model,stackWeights, shiftDistance=256, subImageNumber=16, padSubImageNumber=25, debug=False):
+    '''Weighted average of the six Unet predictions of predict_first_image_channels.
+    stackWeights can be the output of get_weights_array for one image, with the weights
+    repeated for every feature, or just the (y, x, 6) weights.
+    '''
 
     pred = predict_first_image_channels(img, model, shiftDistance=shiftDistance,
                                      subImageNumber=subImageNumber, padSubImageNumber=padSubImageNumber, debug=debug)[0,...]
@@ -1063,8 +2801,14 @@ def get_frame_predictions(img,model,stackWeights, shiftDistance=256, subImageNum
     if debug:
         print(pred.shape)
 
+    # the weights are the same for every feature
+    if len(stackWeights.shape) == 4:
+        stackWeights = stackWeights[:,:,0,:]
+    stackWeights = stackWeights.astype('float32')
 
-    compositePrediction = np.average(pred, axis=3, weights=stackWeights)
+    # weighted mean over the six predictions, same as np.average along the last axis
+    compositePrediction = np.einsum('ijfk,ijk->ijf', pred, stackWeights)
+    compositePrediction /= np.sum(stackWeights, axis=-1)[:,:,np.newaxis]
     # print(compositePrediction.shape)
 
     padSize = (compositePrediction.shape[0]-img.shape[0])//2
@@ -1090,182 +2834,631 @@ def apply_median_filter_normalize(imgs):
     return(imgs)
 
 
+# moves an image by a number of pixels, filling in with zeros
+def shift_image(img, shift_y, shift_x):
+    '''Shifts the first two axes of an array. Positive shifts move the content down and right,
+    so shifted[i, j] = img[i - shift_y, j - shift_x]. Pixels moved in from outside are 0.
+    '''
+
+    shifted = np.zeros_like(img)
+    rows, cols = img.shape[0], img.shape[1]
+    if abs(shift_y) >= rows or abs(shift_x) >= cols:
+        return shifted
+
+    shifted[max(shift_y,0):rows+min(shift_y,0), max(shift_x,0):cols+min(shift_x,0)] = \
+        img[max(-shift_y,0):rows+min(-shift_y,0), max(-shift_x,0):cols+min(-shift_x,0)]
+
+    return shifted
+
 def predict_first_image_channels(img, model,
                               subImageNumber=16, padSubImageNumber=25,
                               shiftDistance=128, batchSize=1,
                               debug=False):
+    '''Predicts the traps in an image with the Unet, on six sets of crops: the image, the image
+    padded by shiftDistance on all sides, and the image shifted up, down, left and right by
+    shiftDistance. This helps fill in low confidence regions where the crop boundaries were
+    for the original image.
+
+    All crop sets go through the model in one predict call, with the batches prepared on
+    threads. The predictions are put back together with reshapes and shifted back into place.
+
+    Returns
+    allPredictions : np.ndarray
+        Shape (1, y, x, features, 6), in the order original, expanded, up, down, left, right.
+    '''
+
     imgSize = img.shape[0]
     padSize = (2048-imgSize)//2 # how much to pad on each side to get up to 2048x2048?
     imgStack = np.pad(img, pad_width=((padSize,padSize),(padSize,padSize)),
                       mode='constant', constant_values=((0,0),(0,0))) # pad the images to make them 2048x2048
-    # pad the stack by 128 pixels on each side to get complemetary crops that I can run the network on. This
-    #    should help me fill in low-confidence regions where the crop boundaries were for the original image
+    # pad the stack by shiftDistance pixels on each side to get complemetary crops that I can run the network on.
     imgStackExpand = np.pad(imgStack, pad_width=((shiftDistance,shiftDistance),(shiftDistance,shiftDistance)),
                             mode='constant', constant_values=((0,0),(0,0)))
-    imgStackShiftRight = np.pad(imgStack, pad_width=((0,0),(0,shiftDistance)),
-                                mode='constant', constant_values=((0,0),(0,0)))[:,shiftDistance:]
-    imgStackShiftLeft = np.pad(imgStack, pad_width=((0,0),(shiftDistance,0)),
-                                mode='constant', constant_values=((0,0),(0,0)))[:,:-shiftDistance]
-    imgStackShiftDown = np.pad(imgStack, pad_width=((0,shiftDistance),(0,0)),
-                               mode='constant', constant_values=((0,0),(0,0)))[shiftDistance:,:]
-    imgStackShiftUp = np.pad(imgStack, pad_width=((shiftDistance,0),(0,0)),
-                               mode='constant', constant_values=((0,0),(0,0)))[:-shiftDistance,:]
-    #print(imgStackShiftUp.shape)
-
-    crops = tileImage(imgStack, subImageNumber=subImageNumber)
-    crops = np.expand_dims(crops, -1)
+
+    # the shifted images, named as before for the crop sets they make
+    crop_sets = [(imgStack, subImageNumber),
+                 (imgStackExpand, padSubImageNumber),
+                 (shift_image(imgStack, shiftDistance, 0), subImageNumber), # up
+                 (shift_image(imgStack, -shiftDistance, 0), subImageNumber), # down
+                 (shift_image(imgStack, 0, shiftDistance), subImageNumber), # left
+                 (shift_image(imgStack, 0, -shiftDistance), subImageNumber)] # right
+
+    # square tiles, set_number of them per image
+    crops = []
+    layouts = []
+    for set_img, set_number in crop_sets:
+        tile_length = set_img.shape[0] // int(np.sqrt(set_number))
+        set_crops, set_layout = tile_image(set_img, (tile_length, tile_length))
+        crops.append(np.expand_dims(set_crops, -1))
+        layouts.append(set_layout)
 
     data_gen_args = {'batch_size':params['compile']['channel_prediction_batch_size'],
                          'n_channels':1,
                          'normalize_to_one':True,
                          'shuffle':False}
+    # threads prepare the batches while the model runs, no worker processes are started
     predict_gen_args = {'verbose':1,
-                        'use_multiprocessing':True,
+                        'use_multiprocessing':False,
                         'workers':params['num_analyzers']}
 
-    img_generator = TrapSegmentationDataGenerator(crops, **data_gen_args)
-    predictions = model.predict_generator(img_generator, **predict_gen_args)
-    prediction = imageConcatenatorFeatures(predictions, subImageNumber=subImageNumber)
-    #print(prediction.shape)
-
-    cropsExpand = tileImage(imgStackExpand, subImageNumber=padSubImageNumber)
-    cropsExpand = np.expand_dims(cropsExpand, -1)
-    img_generator = TrapSegmentationDataGenerator(cropsExpand, **data_gen_args)
-    predictions = model.predict_generator(img_generator, **predict_gen_args)
-    predictionExpand = imageConcatenatorFeatures2(predictions, subImageNumber=padSubImageNumber)
-    predictionExpand = util.crop(predictionExpand, ((0,0),(shiftDistance,shiftDistance),(shiftDistance,shiftDistance),(0,0)))
-    #print(predictionExpand.shape)
-
-    cropsShiftLeft = tileImage(imgStackShiftLeft, subImageNumber=subImageNumber)
-    cropsShiftLeft = np.expand_dims(cropsShiftLeft, -1)
-    img_generator = TrapSegmentationDataGenerator(cropsShiftLeft, **data_gen_args)
-    predictions = model.predict_generator(img_generator, **predict_gen_args)
-    predictionLeft = imageConcatenatorFeatures(predictions, subImageNumber=subImageNumber)
-    predictionLeft = np.pad(predictionLeft, pad_width=((0,0),(0,0),(0,shiftDistance),(0,0)),
-                      mode='constant', constant_values=((0,0),(0,0),(0,0),(0,0)))[:,:,shiftDistance:,:]
-    #print(predictionLeft.shape)
-
-    cropsShiftRight = tileImage(imgStackShiftRight, subImageNumber=subImageNumber)
-    cropsShiftRight = np.expand_dims(cropsShiftRight, -1)
-    img_generator = TrapSegmentationDataGenerator(cropsShiftRight, **data_gen_args)
-    predictions = model.predict_generator(img_generator, **predict_gen_args)
-    predictionRight = imageConcatenatorFeatures(predictions, subImageNumber=subImageNumber)
-    predictionRight = np.pad(predictionRight, pad_width=((0,0),(0,0),(shiftDistance,0),(0,0)),
-                      mode='constant', constant_values=((0,0),(0,0),(0,0),(0,0)))[:,:,:(-1*shiftDistance),:]
-    #print(predictionRight.shape)
-
-    cropsShiftUp = tileImage(imgStackShiftUp, subImageNumber=subImageNumber)
-    #print(cropsShiftUp.shape)
-    cropsShiftUp = np.expand_dims(cropsShiftUp, -1)
-    img_generator = TrapSegmentationDataGenerator(cropsShiftUp, **data_gen_args)
-    predictions = model.predict_generator(img_generator, **predict_gen_args)
-    predictionUp = imageConcatenatorFeatures(predictions, subImageNumber=subImageNumber)
-    predictionUp = np.pad(predictionUp, pad_width=((0,0),(0,shiftDistance),(0,0),(0,0)),
-                      mode='constant', constant_values=((0,0),(0,0),(0,0),(0,0)))[:,shiftDistance:,:,:]
-    #print(predictionUp.shape)
-
-    cropsShiftDown = tileImage(imgStackShiftDown, subImageNumber=subImageNumber)
-    cropsShiftDown = np.expand_dims(cropsShiftDown, -1)
-    img_generator = TrapSegmentationDataGenerator(cropsShiftDown, **data_gen_args)
-    predictions = model.predict_generator(img_generator, **predict_gen_args)
-    predictionDown = imageConcatenatorFeatures(predictions, subImageNumber=subImageNumber)
-    predictionDown = np.pad(predictionDown, pad_width=((0,0),(shiftDistance,0),(0,0),(0,0)),
-                      mode='constant', constant_values=((0,0),(0,0),(0,0),(0,0)))[:,:(-1*shiftDistance),:,:]
-    #print(predictionDown.shape)
+    # one model pass for all the crops if they are the same size
+    if all([set_crops.shape[1:] == crops[0].shape[1:] for set_crops in crops]):
+        img_generator = TrapSegmentationDataGenerator(np.concatenate(crops, axis=0), **data_gen_args)
+        predictions = model.predict_generator(img_generator, **predict_gen_args)
+        split_indices = np.cumsum([len(set_crops) for set_crops in crops])[:-1]
+        set_predictions = np.split(predictions, split_indices, axis=0)
+    else:
+        set_predictions = []
+        for set_crops in crops:
+            img_generator = TrapSegmentationDataGenerator(set_crops, **data_gen_args)
+            set_predictions.append(model.predict_generator(img_generator, **predict_gen_args))
+
+    # put the crops back together
+    untiled = []
+    for (set_img, set_number), set_layout, set_prediction in zip(crop_sets, layouts, set_predictions):
+        untiled.append(stitch_tiles(set_prediction, set_layout, set_img.shape[:2]).astype('float32'))
+
+    prediction = untiled[0]
+    predictionExpand = untiled[1][shiftDistance:-shiftDistance, shiftDistance:-shiftDistance]
+    # shift predictions of the shifted images back
+    predictionUp = shift_image(untiled[2], -shiftDistance, 0)
+    predictionDown = shift_image(untiled[3], shiftDistance, 0)
+    predictionLeft = shift_image(untiled[4], 0, -shiftDistance)
+    predictionRight = shift_image(untiled[5], 0, shiftDistance)
 
     allPredictions = np.stack((prediction, predictionExpand,
                                predictionUp, predictionDown,
                                predictionLeft, predictionRight), axis=-1)
 
-    return(allPredictions)
+    return(allPredictions[np.newaxis])
 
 # takes initial U-net centroids for trap locations, and creats bounding boxes for each trap at the defined height and width
-def get_frame_trap_bounding_boxes(trapLabels, trapProps, trapAreaThreshold=2000, trapWidth=27, trapHeight=256):
+### vectorized trap alignment
+# Label statistics are computed for all labels at once with bincount and ndimage, and labels
+# are removed or kept with lookup tables indexed by the label value.
+
+# area of each label, indexed by the label
+def get_label_areas(labels):
+    return np.bincount(labels.ravel())
+
+# sets labels smaller than min_area to 0
+def filter_labels_by_area(labels, min_area):
+    '''Returns a copy of labels with the regions smaller than min_area set to 0. Uses a
+    lookup table over the label values instead of zeroing the regions one at a time.
+    '''
 
-    badTrapLabels = [reg.label for reg in trapProps if reg.area < trapAreaThreshold] # filter out small "trap" regions
-    goodTraps = trapLabels.copy()
+    areas = get_label_areas(labels)
+    lookup = np.arange(len(areas), dtype=labels.dtype)
+    lookup[areas < min_area] = 0
+    lookup[0] = 0
 
-    for label in badTrapLabels:
-        goodTraps[goodTraps == label] = 0 # re-label bad traps as background (0)
+    return lookup[labels]
 
-    goodTrapProps = measure.regionprops(goodTraps)
-    trapCentroids = [(int(np.round(reg.centroid[0])),int(np.round(reg.centroid[1]))) for reg in goodTrapProps] # get centroids as integers
-    trapBboxes = []
+# (row, column) centroids of labels
+def get_label_centroids(labels, index=None):
+    '''Centroids of the labels in index, or of all labels in increasing order if index is
+    None, as an array of shape (labels, labels.ndim). This is the same order as regionprops.
+    '''
 
-    for centroid in trapCentroids:
-        rowIndex = centroid[0]
-        colIndex = centroid[1]
+    if index is None:
+        index = np.nonzero(get_label_areas(labels))[0]
+        index = index[index > 0]
+    if len(index) == 0:
+        return np.zeros((0, labels.ndim))
 
-        minRow = rowIndex-trapHeight//2
-        maxRow = rowIndex+trapHeight//2
-        minCol = colIndex-trapWidth//2
-        maxCol = colIndex+trapWidth//2
-        if trapWidth % 2 != 0:
-            maxCol += 1
+    centroids = ndi.center_of_mass(labels > 0, labels, index)
+    return np.asarray(centroids, dtype='float64').reshape(len(index), labels.ndim)
 
-        coordArray = np.array([minRow,maxRow,minCol,maxCol])
+def get_frame_trap_bounding_boxes(trapLabels, trapProps=None, trapAreaThreshold=2000, trapWidth=27, trapHeight=256):
+    '''Boxes of trapHeight by trapWidth centered on the labeled traps with an area of at least
+    trapAreaThreshold. Boxes that go past the edge of the image are left out.
+    trapProps is not used anymore, the areas and centroids come from trapLabels directly.
 
-        # remove any traps at edges of image
-        if np.any(coordArray > goodTraps.shape[0]):
-            continue
-        if np.any(coordArray < 0):
-            continue
+    Returns
+    trapBboxes : list of tuples
+        (min row, min column, max row, max column) in order of label.
+    '''
+
+    goodTraps = filter_labels_by_area(trapLabels, trapAreaThreshold) # filter out small "trap" regions
+    trapCentroids = np.round(get_label_centroids(goodTraps)).astype('int64') # get centroids as integers
 
-        trapBboxes.append((minRow,minCol,maxRow,maxCol))
+    minRows = trapCentroids[:,0] - trapHeight//2
+    maxRows = trapCentroids[:,0] + trapHeight//2
+    minCols = trapCentroids[:,1] - trapWidth//2
+    maxCols = trapCentroids[:,1] + trapWidth//2 + trapWidth % 2
+
+    # remove any traps at edges of image
+    inside = ((minRows >= 0) & (minCols >= 0) &
+              (maxRows <= goodTraps.shape[0]) & (maxCols <= goodTraps.shape[1]))
+
+    trapBboxes = [(int(minRow), int(minCol), int(maxRow), int(maxCol)) for minRow, minCol, maxRow, maxCol
+                  in zip(minRows[inside], minCols[inside], maxRows[inside], maxCols[inside])]
 
     return(trapBboxes)
 
+# mask of the filtered, correctly-shaped trap bounding boxes in one frame
+def make_frame_trap_mask(frame_traps, trapAreaThreshold=2000, trapWidth=27, trapHeight=256):
+    frame_trap_labels = measure.label(frame_traps)
+
+    trap_bboxes = get_frame_trap_bounding_boxes(frame_trap_labels,
+                                                trapAreaThreshold=trapAreaThreshold,
+                                                trapWidth=trapWidth,
+                                                trapHeight=trapHeight)
+
+    trap_mask = np.zeros(frame_traps.shape, dtype=bool)
+    for bbox in trap_bboxes:
+        trap_mask[bbox[0]:bbox[2],bbox[1]:bbox[3]] = True
+
+    return trap_mask
+
+# pairs of labels in two consecutive frames that touch, including diagonally
+def get_touching_label_pairs(prev_labels, labels):
+    '''Returns an array of (previous label, label) pairs for regions that would be connected
+    if the two frames were labeled together as a 3D stack with full connectivity.
+    '''
+
+    rows, cols = labels.shape
+    pairs = []
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            labels_view = labels[max(dy,0):rows+min(dy,0), max(dx,0):cols+min(dx,0)]
+            prev_view = prev_labels[max(-dy,0):rows+min(-dy,0), max(-dx,0):cols+min(-dx,0)]
+            touching = (labels_view > 0) & (prev_view > 0)
+            if np.any(touching):
+                pairs.append(np.stack((prev_view[touching], labels_view[touching]), axis=1))
+
+    if not pairs:
+        return np.zeros((0, 2), dtype='int64')
+    return np.unique(np.concatenate(pairs, axis=0), axis=0)
+
+# finds how much the traps move through time using Unet predictions on a (512,512) region
+def get_alignment_shifts(fov_file_names, centroid, model, trap_align_metadata, block_size=60,
+                         trap_windows=None):
+    '''Predicts the traps in a region of every frame of an FOV and returns the mean
+    movement of the traps relative to the first frame.
+
+    Frames are loaded and predicted block_size at a time. Only the per frame trap masks of
+    the current block are kept, and traps are followed through time by linking touching
+    regions in consecutive frames. This gives the same regions as labeling the whole
+    (frames, y, x) stack at once, without holding the stack or the class probabilities.
+
+    Traps are only used for alignment if they have the expected size in every frame. If a
+    frame has no traps at all the masks of the previous frame are used, or of the next
+    frame for the first frame.
+
+    If trap_windows is given, the windows around the traps are filled in from the same
+    frames, so crop_traps does not have to read the images again.
+
+    Parameters
+    fov_file_names : list of str
+        Image file names for the FOV, sorted by time.
+    centroid : (int, int)
+        Center of the (512,512) region used for alignment.
+    model : Keras model
+        Unet for traps.
+    trap_align_metadata : dict
+    block_size : int
+        Number of frames predicted at once.
+    trap_windows : dict
+        From make_trap_windows, filled in place.
+
+    Returns
+    shifts : np.ndarray
+        Shape (frames, 2), the mean (row, column) movement of the traps from the first frame.
+    areas : np.ndarray
+        Total area of each trap region through time, for debugging.
+
+    Called by
+    mm3_Compile.py
+    '''
+
+    frame_count = len(fov_file_names)
+    region_half = 256 # the region is (512,512)
+    trap_width = trap_align_metadata['trap_width']
+    trap_height = trap_align_metadata['trap_height']
+    expected_area = trap_width * trap_height * frame_count
+
+    data_gen_args = {'batch_size':params['compile']['channel_prediction_batch_size'],
+                     'n_channels':1,
+                     'normalize_to_one':True,
+                     'shuffle':False}
+    predict_gen_args = {'verbose':1,
+                        'use_multiprocessing':True,
+                        'workers':params['num_analyzers']}
+
+    # stats of each trap region in each frame. Labels are unique through the whole FOV
+    region_frames = []
+    region_labels = []
+    region_areas = []
+    region_row_sums = []
+    region_col_sums = []
+    label_links = [] # pairs of labels touching between frames
+    next_label = 1
+    prev_labels = None
+    first_frame_empty = False
+
+    # row and column of every pixel, for summing centroids
+    rows, cols = np.indices((2*region_half, 2*region_half))
+    rows = rows.ravel()
+    cols = cols.ravel()
+
+    for block_start in range(0, frame_count, block_size):
+        block_file_names = fov_file_names[block_start:block_start+block_size]
+
+        # get the (frames in block,512,512,1)-sized stack for image aligment
+        align_region_stack = np.zeros((len(block_file_names),2*region_half,2*region_half,1), dtype='uint16')
+        for i, fn in enumerate(block_file_names):
+            frame_img = read_trap_frame(fn)
+            # keep only the phase image for the alignment region
+            phase_index = trap_align_metadata['phase_plane_index'] if frame_img.shape[2] > 1 else 0
+            align_region_stack[i,:,:,0] = frame_img[centroid[0]-region_half:centroid[0]+region_half,
+                                                    centroid[1]-region_half:centroid[1]+region_half,
+                                                    phase_index]
+            # and the windows around the traps for cropping later
+            if trap_windows:
+                fill_trap_windows(trap_windows, block_start + i, frame_img)
+
+        img_generator = TrapSegmentationDataGenerator(align_region_stack, **data_gen_args)
+        align_region_predictions = model.predict_generator(img_generator, **predict_gen_args)
+        # 0=trap, 1=central trough, 2=background. Keep just the traps as booleans
+        align_traps = np.argmax(align_region_predictions, axis=3) == 0
+        del align_region_predictions
+
+        for i in range(align_traps.shape[0]):
+            frame = block_start + i
+            trap_mask = make_frame_trap_mask(align_traps[i],
+                                             trapAreaThreshold=params['compile']['trap_area_threshold'],
+                                             trapWidth=trap_width,
+                                             trapHeight=trap_height)
+
+            if np.any(trap_mask):
+                labels, label_count = ndi.label(trap_mask, structure=np.ones((3,3)))
+                labels[labels > 0] += next_label - 1
+                next_label += label_count
+                if prev_labels is not None:
+                    label_links.append(get_touching_label_pairs(prev_labels, labels))
+            else:
+                # if no traps were detected for this frame. This usually occurs due to a bug in our imaging system,
+                # which can cause it to miss the occasional frame. Should be fine to snag labels from prior frame.
+                information("Frame at index {} has no detected traps. Borrowing labels from an adjacent frame.".format(frame))
+                if frame > 0:
+                    labels = prev_labels
+                else:
+                    first_frame_empty = True
+                    labels = np.zeros(trap_mask.shape, dtype='int32')
+
+            # area and coordinate sums of each region in this frame
+            flat_labels = labels.ravel()
+            frame_areas = np.bincount(flat_labels)
+            frame_labels = np.nonzero(frame_areas)[0]
+            frame_labels = frame_labels[frame_labels > 0]
+            region_frames.append(np.full(len(frame_labels), frame))
+            region_labels.append(frame_labels)
+            region_areas.append(frame_areas[frame_labels])
+            region_row_sums.append(np.bincount(flat_labels, weights=rows)[frame_labels])
+            region_col_sums.append(np.bincount(flat_labels, weights=cols)[frame_labels])
+
+            # the first frame borrows from the second one
+            if frame == 1 and first_frame_empty:
+                region_frames[0] = np.zeros(len(frame_labels), dtype='int64')
+                region_labels[0] = frame_labels
+                region_areas[0] = region_areas[-1]
+                region_row_sums[0] = region_row_sums[-1]
+                region_col_sums[0] = region_col_sums[-1]
+
+            prev_labels = labels
+
+    region_frames = np.concatenate(region_frames).astype('int64')
+    region_labels = np.concatenate(region_labels).astype('int64')
+    region_areas = np.concatenate(region_areas).astype('float64')
+    region_row_sums = np.concatenate(region_row_sums)
+    region_col_sums = np.concatenate(region_col_sums)
+
+    # join labels linked through time into trap regions
+    if label_links:
+        label_links = np.concatenate(label_links, axis=0)
+    else:
+        label_links = np.zeros((0, 2), dtype='int64')
+    link_graph = sparse.coo_matrix((np.ones(len(label_links)), (label_links[:,0], label_links[:,1])),
+                                   shape=(next_label, next_label))
+    _, label_regions = connected_components(link_graph, directed=False)
+    region_ids = label_regions[region_labels]
+
+    # only keep trap regions with the expected area, i.e. found in every frame
+    found_regions = np.unique(region_ids)
+    areas = np.bincount(region_ids, weights=region_areas, minlength=next_label)[found_regions]
+    good_regions = found_regions[areas == expected_area]
+
+    # centroid of each good trap region in each frame
+    good_index = np.searchsorted(good_regions, region_ids)
+    is_good = np.isin(region_ids, good_regions)
+    area_sums = np.zeros((frame_count, len(good_regions)))
+    row_sums = np.zeros((frame_count, len(good_regions)))
+    col_sums = np.zeros((frame_count, len(good_regions)))
+    np.add.at(area_sums, (region_frames[is_good], good_index[is_good]), region_areas[is_good])
+    np.add.at(row_sums, (region_frames[is_good], good_index[is_good]), region_row_sums[is_good])
+    np.add.at(col_sums, (region_frames[is_good], good_index[is_good]), region_col_sums[is_good])
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        align_centroids = np.stack((row_sums / area_sums, col_sums / area_sums), axis=-1)
+    align_centroids[area_sums == 0] = np.nan
+
+    # mean movement of the traps from the first frame
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore', category=RuntimeWarning)
+        shifts = np.nanmean(align_centroids - align_centroids[0:1], axis=1)
+    if np.any(np.isnan(shifts)):
+        warning('No traps found for alignment in some frames, they will not be shifted.')
+        shifts[np.isnan(shifts)] = 0
+
+    return shifts, areas
+
+# loads a full frame for trap cropping as (y, x, planes)
+def read_trap_frame(fn):
+    imgPath = os.path.join(params['experiment_directory'],params['image_directory'],fn)
+    fullFrameImg = io.imread(imgPath)
+    if len(fullFrameImg.shape) == 2:
+        fullFrameImg = fullFrameImg[:,:,np.newaxis]
+    elif fullFrameImg.shape[0] < 3: # for tifs with less than three imaging channels, the first dimension separates channels
+        fullFrameImg = np.transpose(fullFrameImg, (1,2,0))
+
+    return(fullFrameImg)
+
+# uint16 array for trap images, in memory or memory mapped in buffer_dir
+def make_trap_buffer(shape, buffer_dir=None, name='buffer'):
+    if buffer_dir is None:
+        return np.zeros(shape, dtype='uint16')
+    return np.lib.format.open_memmap(os.path.join(buffer_dir, name + '.npy'), mode='w+',
+                                     dtype='uint16', shape=shape)
+
+def make_trap_windows(bboxesDict, margin, img_shape, trap_align_metadata, buffer_dir=None):
+    '''Makes buffers for windows around the traps in the first frame, larger than the traps by
+    margin pixels on every side. The windows are filled in while the frames are read for
+    alignment, and crop_traps takes the shifted traps out of them so the frames are only
+    read once.
+
+    Parameters
+    bboxesDict : dict
+        Bounding box of each trap in the first frame.
+    margin : int
+        How far the traps may move and still be cropped from the windows.
+    img_shape : tuple
+        Rows and columns of the full frames.
+    trap_align_metadata : dict
+    buffer_dir : str
+        Directory for memory mapped buffers. None keeps them in memory.
+
+    Returns
+    trap_windows : dict
+        For each trap, 'bbox' is the window in the frame and 'images' the uint16 buffer
+        of shape (frames, window rows, window columns, planes).
+    '''
+
+    trap_windows = {}
+    for key, bbox in six.iteritems(bboxesDict):
+        window = (max(bbox[0]-margin, 0), max(bbox[1]-margin, 0),
+                  min(bbox[2]+margin, img_shape[0]), min(bbox[3]+margin, img_shape[1]))
+        shape = (trap_align_metadata['frame_count'], window[2]-window[0], window[3]-window[1],
+                 trap_align_metadata['plane_number'])
+        trap_windows[key] = {'bbox': window,
+                             'images': make_trap_buffer(shape, buffer_dir, 'window_%04d' % key)}
+
+    return(trap_windows)
+
+# copies the trap windows out of one full frame
+def fill_trap_windows(trap_windows, frame, fullFrameImg):
+    for key, window in six.iteritems(trap_windows):
+        bbox = window['bbox']
+        window['images'][frame] = fullFrameImg[bbox[0]:bbox[2],bbox[1]:bbox[3],:]
+
+# opens memory mapped trap windows written by make_trap_windows in buffer_dir
+def open_trap_windows(trap_windows, buffer_dir):
+    for key, window in six.iteritems(trap_windows):
+        if 'images' not in window:
+            window['images'] = np.load(os.path.join(buffer_dir, 'window_%04d.npy' % key), mmap_mode='r')
+
+    return(trap_windows)
+
+# whether a trap should be flipped so its closed end, where the median profile of its first
+# frame is brightest, is at the top
+def get_trap_flip(trapImg, trap_height):
+    medianProfile = np.median(trapImg[:,:,0],axis=1) # get intensity of middle column of trap
+    maxIntensityRow = np.argmax(medianProfile)
+    return maxIntensityRow <= trap_height//2
+
+# puts the crop of one trap in one frame in its buffer, and records its closed and open ends
+def put_trap_image(trapImages, trapClosedEndPx, frame, bbox, trapImg, flipImage):
+    if flipImage:
+        trapImages[frame,:,:,:] = trapImg[::-1,:,:]
+        trapClosedEndPx['closed_end_px'] = bbox[0]
+        trapClosedEndPx['open_end_px'] = bbox[2]
+    else:
+        trapImages[frame,:,:,:] = trapImg
+        trapClosedEndPx['closed_end_px'] = bbox[2]
+        trapClosedEndPx['open_end_px'] = bbox[0]
+
 # this function performs image alignment as defined by the shifts passed as an argument
-def crop_traps(fileNames, trapProps, labelledTraps, bboxesDict, trap_align_metadata):
+def crop_traps(fileNames, trapProps, labelledTraps, bboxesDict, trap_align_metadata,
+               trapWindows=None, buffer_dir=None):
+    '''Crops the traps out of every frame at their shifted bounding boxes, and flips them so
+    the closed end is at the top. The crops are uint16, and memory mapped in buffer_dir if
+    it is given.
+
+    With trapWindows the traps are cropped one at a time from their windows, and each
+    window is freed (and its file in buffer_dir removed) as soon as its trap is done, so
+    the windows and all crops are never held together. A frame is only read from disk for
+    a trap that moved further than its window. Without trapWindows every frame is read,
+    once, and all traps are cropped straight into their buffers.
+
+    Returns
+    trapImagesDict : dict
+        For each trap, images of shape (frames, trap height, trap width, planes).
+    trapClosedEndPxDict : dict
+        Closed and open end pixels of each trap for each file name.
+    '''
 
     frameNum = trap_align_metadata['frame_count']
     channelNum = trap_align_metadata['plane_number']
-    trapImagesDict = {key:np.zeros((frameNum,
-                                       trap_align_metadata['trap_height'],
-                                       trap_align_metadata['trap_width'],
-                                       channelNum)) for key in bboxesDict}
-    trapClosedEndPxDict = {}
-    flipImageDict = {}
-    trapMask = labelledTraps
+    trapImagesDict = {}
+    trapClosedEndPxDict = {fileNames[frame]:{key:{} for key in bboxesDict.keys()}
+                           for frame in range(frameNum)}
+    reread_count = 0
+
+    trapShape = (frameNum, trap_align_metadata['trap_height'], trap_align_metadata['trap_width'],
+                 channelNum)
+
+    if not trapWindows:
+        flipImageDict = {}
+        for key in bboxesDict.keys():
+            trapImagesDict[key] = make_trap_buffer(trapShape, buffer_dir, 'trap_%04d' % key)
+
+        for frame in range(frameNum):
+            if (frame+1) % 20 == 0:
+                print("Cropping trap regions for frame number {} of {}.".format(frame+1, frameNum))
+
+            fullFrameImg = read_trap_frame(fileNames[frame])
+            for key in trapImagesDict.keys():
+                bbox = bboxesDict[key][frame]
+                trapImg = fullFrameImg[bbox[0]:bbox[2],bbox[1]:bbox[3],:]
+                if frame == 0:
+                    flipImageDict[key] = get_trap_flip(trapImg, trap_align_metadata['trap_height'])
+                put_trap_image(trapImagesDict[key], trapClosedEndPxDict[fileNames[frame]][key],
+                               frame, bbox, trapImg, flipImageDict[key])
+
+        return(trapImagesDict, trapClosedEndPxDict)
+
+    # the last frame read again, as the next trap may also need it
+    rereadFrame = None
+    rereadImg = None
+
+    for n, key in enumerate(sorted(bboxesDict.keys())):
+        if (n+1) % 20 == 0:
+            information("Cropping trap {} of {}.".format(n+1, len(bboxesDict)))
+
+        trapImagesDict[key] = make_trap_buffer(trapShape, buffer_dir, 'trap_%04d' % key)
+        window = trapWindows.get(key)
+        for frame in range(frameNum):
+            bbox = bboxesDict[key][frame]
+            if (window is not None and
+                    bbox[0] >= window['bbox'][0] and bbox[1] >= window['bbox'][1] and
+                    bbox[2] <= window['bbox'][2] and bbox[3] <= window['bbox'][3]):
+                trapImg = window['images'][frame,
+                                           bbox[0]-window['bbox'][0]:bbox[2]-window['bbox'][0],
+                                           bbox[1]-window['bbox'][1]:bbox[3]-window['bbox'][1],:]
+            else:
+                if rereadFrame != frame:
+                    rereadImg = read_trap_frame(fileNames[frame])
+                    rereadFrame = frame
+                    reread_count += 1
+                trapImg = rereadImg[bbox[0]:bbox[2],bbox[1]:bbox[3],:]
 
-    for frame in range(frameNum):
+            if frame == 0:
+                flipImage = get_trap_flip(trapImg, trap_align_metadata['trap_height'])
+            put_trap_image(trapImagesDict[key], trapClosedEndPxDict[fileNames[frame]][key],
+                           frame, bbox, trapImg, flipImage)
+
+        # this window is not needed anymore
+        if window is not None:
+            del window['images']
+            if buffer_dir is not None:
+                window_path = os.path.join(buffer_dir, 'window_%04d.npy' % key)
+                if os.path.exists(window_path):
+                    os.remove(window_path)
+
+    if reread_count > 0:
+        information("Traps moved outside their windows, {} frames were read again.".format(reread_count))
+
+    return(trapImagesDict, trapClosedEndPxDict)
+
+# crops and saves the traps of one FOV once the shifts are known
+def crop_and_save_fov_traps(fov_id, fov_file_names, fov_analyzed_imgs, bboxesDict, shifts, imgSize,
+                            trap_align_metadata, trapWindows=None, buffer_dir=None):
+    '''Does everything for an FOV in the Unet path of Compile that does not need the model.
+    The traps are cropped at their shifted bounding boxes and saved as per the output
+    parameter. This is run in a pool so FOVs are cropped and written while the model
+    works on the next FOV.
+
+    Parameters
+    fov_id : int
+    fov_file_names : list of str
+        Image file names of the FOV, sorted by time.
+    fov_analyzed_imgs : dict
+        Image metadata for the files of this FOV.
+    bboxesDict : dict
+        Bounding boxes of the traps in the first frame.
+    shifts : np.ndarray
+        Integer (row, column) shifts of each frame.
+    imgSize : int
+        Size of the frames.
+    trap_align_metadata : dict
+    trapWindows : dict
+        Windows from make_trap_windows. If buffer_dir is given, windows without images
+        are opened from the memory mapped files there.
+    buffer_dir : str
+        Directory of the memory mapped buffers, removed when done or on failure.
+
+    Returns
+    trap_closed_end_px_dict : dict
+        Closed and open end pixels of each trap for each file name.
+    fov_channel_masks : dict
+        Channel masks of the FOV.
 
-        if (frame+1) % 20 == 0:
-            print("Cropping trap regions for frame number {} of {}.".format(frame+1, frameNum))
+    Called by
+    mm3_Compile.py
+    '''
 
-        imgPath = os.path.join(params['experiment_directory'],params['image_directory'],fileNames[frame])
-        fullFrameImg = io.imread(imgPath)
-        if len(fullFrameImg.shape) == 3:
-            if fullFrameImg.shape[0] < 3: # for tifs with less than three imaging channels, the first dimension separates channels
-                fullFrameImg = np.transpose(fullFrameImg, (1,2,0))
-        trapClosedEndPxDict[fileNames[frame]] = {key:{} for key in bboxesDict.keys()}
+    # the memory mapped buffers are removed even if cropping or saving fails
+    try:
+        bbox_shift_dict = shift_bounding_boxes(bboxesDict, shifts, imgSize)
 
-        for key in trapImagesDict.keys():
+        if trapWindows is not None and buffer_dir is not None:
+            trapWindows = open_trap_windows(trapWindows, buffer_dir)
 
-            bbox = bboxesDict[key][frame]
-            trapImagesDict[key][frame,:,:,:] = fullFrameImg[bbox[0]:bbox[2],bbox[1]:bbox[3],:]
+        trap_images_fov_dict, trap_closed_end_px_dict = crop_traps(fov_file_names, None, None,
+                                                                   bbox_shift_dict, trap_align_metadata,
+                                                                   trapWindows=trapWindows,
+                                                                   buffer_dir=buffer_dir)
+        del trapWindows
 
-            #tmpImg = np.reshape(fullFrameImg[trapMask==key], (trapHeight,trapWidth,channelNum))
+        fov_channel_masks = make_channel_masks_CNN(bbox_shift_dict)
 
-            if frame == 0:
-                medianProfile = np.median(trapImagesDict[key][frame,:,:,0],axis=1) # get intensity of middle column of trap
-                maxIntensityRow = np.argmax(medianProfile)
+        if params['compile']['do_slicing']:
+            if params['output'] == "TIFF":
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    save_tiffs(trap_images_fov_dict, fov_analyzed_imgs, fov_id)
 
-                if maxIntensityRow > trap_align_metadata['trap_height']//2:
-                    flipImageDict[key] = 0
-                else:
-                    flipImageDict[key] = 1
+            elif params['output'] == "HDF5":
+                # Or write it to hdf5
+                save_hdf5(trap_images_fov_dict, fov_file_names, fov_analyzed_imgs, fov_id,
+                          {fov_id: fov_channel_masks})
 
-            if flipImageDict[key] == 1:
-                trapImagesDict[key][frame,:,:,:] = trapImagesDict[key][frame,::-1,:,:]
-                trapClosedEndPxDict[fileNames[frame]][key]['closed_end_px'] = bbox[0]
-                trapClosedEndPxDict[fileNames[frame]][key]['open_end_px'] = bbox[2]
-            else:
-                trapClosedEndPxDict[fileNames[frame]][key]['closed_end_px'] = bbox[2]
-                trapClosedEndPxDict[fileNames[frame]][key]['open_end_px'] = bbox[0]
-                continue
+        del trap_images_fov_dict
+    finally:
+        if buffer_dir is not None:
+            shutil.rmtree(buffer_dir, ignore_errors=True)
 
-    return(trapImagesDict, trapClosedEndPxDict)
+    return(trap_closed_end_px_dict, fov_channel_masks)
 
 # gets shifted bounding boxes to crop traps through time
 def shift_bounding_boxes(bboxesDict, shifts, imgSize):
@@ -1319,11 +3512,19 @@ def find_channel_locs(image_data):
 
     # Detect peaks in the x projection (i.e. find the channels)
     projection_x = image_data.sum(axis=0).astype(np.int32)
-    # find_peaks_cwt is a function which attempts to find the peaks in a 1-D array by
-    # convolving it with a wave. here the wave is the default Mexican hat wave
-    # but the minimum signal to noise ratio is specified
-    # *** The range here should be a parameter or changed to a fraction.
-    peaks = find_peaks_cwt(projection_x, np.arange(chan_w-5,chan_w+5), min_snr=chan_snr)
+    if 'channel_detection_method' in params['compile'] and \
+        params['compile']['channel_detection_method'] == 'fft':
+        # channel period from the spectrum and a matched filter, much faster than cwt
+        peaks = find_channel_peaks_fft(projection_x, chan_w, chan_sep, chan_snr)
+    else:
+        # find_peaks_cwt is a function which attempts to find the peaks in a 1-D array by
+        # convolving it with a wave. here the wave is the default Mexican hat wave
+        # but the minimum signal to noise ratio is specified
+        # *** The range here should be a parameter or changed to a fraction.
+        peaks = find_peaks_cwt(projection_x, np.arange(chan_w-5,chan_w+5), min_snr=chan_snr)
+
+    if len(peaks) == 0:
+        return {}
 
     # If the left-most peak position is within half of a channel separation,
     # discard the channel from the list.
@@ -1331,7 +3532,7 @@ def find_channel_locs(image_data):
         peaks = peaks[1:]
     # If the diference between the right-most peak position and the right edge
     # of the image is less than half of a channel separation, discard the channel.
-    if image_data.shape[1] - peaks[-1] < (chan_sep / 2):
+    if len(peaks) > 0 and image_data.shape[1] - peaks[-1] < (chan_sep / 2):
         peaks = peaks[:-1]
 
     # Find the average channel ends for the y-projected image
@@ -1378,7 +3579,246 @@ def find_channel_locs(image_data):
 
     return chnl_loc_dict
 
+# estimates the spacing of the channels from the x projection
+def find_channel_period(projection_x, chan_sep):
+    '''Finds the channel period in pixels as the strongest frequency of the x projection
+    within 25% of the expected channel_separation. The peak of the spectrum is refined by
+    parabolic interpolation. Returns chan_sep if no clear period is found.
+    '''
+
+    n = len(projection_x)
+    signal = projection_x.astype(np.float64)
+    signal -= signal.mean()
+    spectrum = np.abs(np.fft.rfft(signal))
+
+    # frequency bins which are allowed
+    k_lo = max(int(np.floor(n / (chan_sep * 1.25))), 1)
+    k_hi = min(int(np.ceil(n / (chan_sep * 0.75))), len(spectrum) - 2)
+    if k_hi <= k_lo:
+        return float(chan_sep)
+
+    k = k_lo + np.argmax(spectrum[k_lo:k_hi+1])
+
+    # parabolic interpolation around the peak bin
+    a, b, c = spectrum[k-1], spectrum[k], spectrum[k+1]
+    denominator = a - 2 * b + c
+    if denominator != 0:
+        k = k + 0.5 * (a - c) / denominator
+
+    period = n / k
+    if abs(period - chan_sep) > 0.25 * chan_sep:
+        return float(chan_sep)
+
+    return period
+
+# alternative to find_peaks_cwt for finding the channels in the x projection
+def find_channel_peaks_fft(projection_x, chan_w, chan_sep, chan_snr):
+    '''Finds the channel positions in the x projection of a phase image using the known
+    channel geometry. The projection is filtered with a matched filter for a bright ridge
+    of the channel width (negative Laplacian of Gaussian with sigma of half the width),
+    and peaks are taken at least 0.7 channel periods apart, with the period measured from
+    the spectrum of the projection.
+
+    A peak is kept if its prominence is more than chan_snr times the pixel noise of the
+    projection and at least a quarter of the median prominence, which removes ripples
+    outside the channel array.
+
+    Returns
+    peaks : np.ndarray of int
+        Channel positions in pixels, sorted.
+
+    Called by
+    mm3.find_channel_locs
+    '''
+
+    signal = projection_x.astype(np.float64)
+    period = find_channel_period(signal, chan_sep)
+
+    # matched filter, bright ridges of width chan_w give maxima at the channel centers
+    sigma = max(chan_w / 2.0, 1.0)
+    response = -ndi.gaussian_laplace(signal, sigma=sigma)
+
+    # noise of the projection from the pixel to pixel differences, carried through the filter
+    noise = 1.4826 * np.median(np.abs(np.diff(signal) - np.median(np.diff(signal)))) / np.sqrt(2)
+    impulse = np.zeros(int(8 * sigma) + 1)
+    impulse[len(impulse) // 2] = 1
+    noise *= np.sqrt(np.sum(ndi.gaussian_laplace(impulse, sigma=sigma)**2))
+
+    peaks, peak_props = find_peaks(response, distance=max(int(0.7 * period), 1),
+                                   prominence=max(chan_snr * noise, 1e-9))
+    if len(peaks) == 0:
+        return peaks
+
+    prominences = peak_props['prominences']
+    peaks = peaks[prominences >= 0.25 * np.median(prominences)]
+
+    return peaks
+
+### drift correction for channels found with peaks
+# The drift of each frame is found by phase correlation of the row and column projections of
+# its phase image with those of the first frame of the FOV. Channel locations are moved into
+# the coordinates of the first frame before making masks, and slicing moves the masks back.
+
+# checks the drift_correction parameter
+def use_drift_correction():
+    return 'drift_correction' in params['compile'] and bool(params['compile']['drift_correction'])
+
+# drift of an image to use for slicing, or None
+def get_image_drift(image_params):
+    if use_drift_correction() and 'drift' in image_params:
+        return image_params['drift']
+    return None
+
+# loads just the phase plane of a raw image, with the orientation fixed
+def load_phase_plane(image_params):
+    if 'raw_index' in image_params:
+        with h5py.File(image_params['filepath'], 'r') as h5f:
+            n_planes = h5f['images'].shape[1]
+            ph_index = min(int(params['phase_plane'][1:]) - 1, n_planes - 1)
+            image_data = h5f['images'][image_params['raw_index'], ph_index]
+    else:
+        with tiff.TiffFile(image_params['filepath']) as tif:
+            n_planes, _ = get_tif_shape(tif)
+            ph_index = min(int(params['phase_plane'][1:]) - 1, n_planes - 1)
+            image_data = read_tif_plane(tif, ph_index, n_planes)
+
+    return fix_orientation(image_data)
+
+# window which is flat in the middle and tapers at the ends, so it barely moves the peak
+def tapered_window(length, taper=0.1):
+    window = np.ones(length)
+    taper_length = int(length * taper)
+    if taper_length > 0:
+        ramp = 0.5 * (1 - np.cos(np.pi * np.arange(taper_length) / taper_length))
+        window[:taper_length] = ramp
+        window[-taper_length:] = ramp[::-1]
+    return window
+
+# shift of a 1D signal relative to a reference by phase correlation
+def phase_correlate_1d(reference_fft, signal, window, center=0, max_shift=None):
+    '''Returns the integer shift s for which signal[i] best matches reference[i - s].
+    reference_fft is the rfft of the mean subtracted, windowed reference. If max_shift is
+    given, only shifts within max_shift of center are considered.
+    '''
+
+    signal_fft = np.fft.rfft((signal - np.mean(signal)) * window)
+    cross_power = signal_fft * np.conj(reference_fft)
+    # partly whitened, which is less sensitive to noise than pure phase correlation
+    cross_power /= np.sqrt(np.abs(cross_power)) + 1e-12
+    correlation = np.fft.irfft(cross_power, n=len(signal))
+
+    # shifts as signed numbers, in the order of the correlation
+    shifts = np.arange(len(signal))
+    shifts[shifts > len(signal) // 2] -= len(signal)
+    if max_shift is not None:
+        correlation[np.abs(shifts - center) > max_shift] = -np.inf
+
+    return int(shifts[np.argmax(correlation)])
+
+def find_fov_drift(fov_images):
+    '''Finds the drift of each image of an FOV relative to its first image.
+    Only the phase plane of each image is read, and it is reduced to its row and column
+    projections. The shift along each axis is found by phase correlation of the projections,
+    which is much cheaper than correlating whole images.
+
+    Channels repeat every channel_separation pixels, so the x shift is only looked for within
+    half of that of the shift of the previous image. The y shift is limited the same way.
+
+    Parameters
+    fov_images : list
+        (image name, image_params) pairs of one FOV, in time order.
+
+    Returns
+    fov_drift : dict
+        (y, x) drift in pixels for each image name. Positive is down and right.
+
+    Called by
+    mm3.add_drift
+    '''
+
+    fov_drift = {}
+    max_shift = max(int(params['compile']['channel_separation']) // 2 - 1, 1)
+    previous_drift = [0, 0]
+
+    for n, (image_name, image_params) in enumerate(fov_images):
+        image_data = load_phase_plane(image_params).astype('float64')
+        projection_y = np.mean(image_data, axis=1)
+        projection_x = np.mean(image_data, axis=0)
+
+        # the first image is the reference
+        if n == 0:
+            window_y = tapered_window(len(projection_y))
+            window_x = tapered_window(len(projection_x))
+            reference_y = np.fft.rfft((projection_y - np.mean(projection_y)) * window_y)
+            reference_x = np.fft.rfft((projection_x - np.mean(projection_x)) * window_x)
+            fov_drift[image_name] = [0, 0]
+            continue
+
+        fov_drift[image_name] = [phase_correlate_1d(reference_y, projection_y, window_y,
+                                                    previous_drift[0], max_shift),
+                                 phase_correlate_1d(reference_x, projection_x, window_x,
+                                                    previous_drift[1], max_shift)]
+        previous_drift = fov_drift[image_name]
+
+    information('Found drift for FOV %d.' % fov_images[0][1]['fov'])
+
+    return fov_drift
+
+# adds the drift of every image to analyzed_imgs
+def add_drift(analyzed_imgs):
+    '''Finds the drift of all images with find_fov_drift, FOVs in parallel, and puts it under
+    'drift' in the image metadata.
+
+    Called by
+    mm3_Compile.py
+    '''
+
+    information("Finding drift of images...")
+
+    # images of each fov in time order
+    fov_images = {}
+    for image_name, image_params in six.iteritems(analyzed_imgs):
+        if not image_params or 'fov' not in image_params:
+            continue
+        fov_images.setdefault(image_params['fov'], []).append((image_name, image_params))
+    for fov_id in fov_images:
+        fov_images[fov_id].sort(key=lambda image: image[1]['t'])
+
+    if params['num_analyzers'] > 1 and len(fov_images) > 1:
+        pool = Pool(min(params['num_analyzers'], len(fov_images)))
+        fov_results = {}
+        for fov_id, images in six.iteritems(fov_images):
+            fov_results[fov_id] = pool.apply_async(find_fov_drift, args=(images,))
+        pool.close()
+        pool.join()
+
+        for fov_id, result in six.iteritems(fov_results):
+            if result.successful():
+                fov_drift = result.get()
+            else:
+                warning('Finding drift failed for FOV %d, it will not be corrected.' % fov_id)
+                fov_drift = {image_name: [0, 0] for image_name, _ in fov_images[fov_id]}
+            for image_name, drift in six.iteritems(fov_drift):
+                analyzed_imgs[image_name]['drift'] = drift
+    else:
+        for fov_id, images in six.iteritems(fov_images):
+            for image_name, drift in six.iteritems(find_fov_drift(images)):
+                analyzed_imgs[image_name]['drift'] = drift
+
+    return analyzed_imgs
+
 # make masks from initial set of images (same images as clusters)
+# checks the mask_frame_sampling parameter
+def get_mask_frame_sampling():
+    if 'mask_frame_sampling' in params['compile'] and params['compile']['mask_frame_sampling']:
+        return int(params['compile']['mask_frame_sampling'])
+    return 1
+
+# whether images at time points t are used for the channel masks. With mask_frame_sampling N,
+# these are t = 1, N+1, 2N+1, ..., for all FOVs and whatever time range is analyzed
+def is_mask_frame(t):
+    return (np.asarray(t) - 1) % get_mask_frame_sampling() == 0
+
 def make_masks(analyzed_imgs):
     '''
     Make masks goes through the channel locations in the image metadata and builds a consensus
@@ -1390,9 +3830,13 @@ def make_masks(analyzed_imgs):
     One important consequence of these function is that the channel ids and the size of the
     channel slices are decided now. Updates to mask must coordinate with these values.
 
+    The consensus of each fov is made by make_fov_consensus_mask, and fovs are done in parallel.
+    params['compile']['mask_frame_sampling'] can be set to N to only use every Nth time point,
+    see is_mask_frame.
+
     Parameters
     analyzed_imgs : dict
-        image information created by get_params
+        image information created by get_params, or the same as columns from get_metadata_columns
 
     Returns
     channel_masks : dict
@@ -1402,6 +3846,7 @@ def make_masks(analyzed_imgs):
     mm3_Compile.py
 
     Calls
+    mm3.make_fov_channel_masks
     '''
     information("Determining initial channel masks...")
 
@@ -1412,19 +3857,36 @@ def make_masks(analyzed_imgs):
     #intiaize dictionary
     channel_masks = {}
 
+    # the metadata as columns
+    columns = get_metadata_columns(analyzed_imgs)
+
     # get the size of the images (hope they are the same)
-    for img_k in analyzed_imgs.keys():
-        img_v = analyzed_imgs[img_k]
-        image_rows = img_v['shape'][0] # x pixels
-        image_cols = img_v['shape'][1] # y pixels
-        break # just need one. using iteritems mean the whole dict doesn't load
-
-    # get the fov ids
-    fovs = []
-    for img_k in analyzed_imgs.keys():
-        img_v = analyzed_imgs[img_k]
-        if img_v['fov'] not in fovs:
-            fovs.append(img_v['fov'])
+    image_rows = int(columns['shape'][0][0]) # x pixels
+    image_cols = int(columns['shape'][0][1]) # y pixels
+
+    # images to use. Compile only looks for channels on these, but metadata from an earlier
+    # run may have channels for every image
+    use_image = columns['has_channels'] & is_mask_frame(columns['t'])
+
+    # channels of drifting images are put where they would be in the first image
+    peaks = columns['channel_peaks']
+    closed_ends = columns['channel_closed_end_px']
+    open_ends = columns['channel_open_end_px']
+    if use_drift_correction():
+        channel_drift = np.repeat(columns['drift'] * columns['has_drift'][:,np.newaxis],
+                                  np.diff(columns['channel_offsets']), axis=0)
+        peaks = peaks - channel_drift[:,1]
+        closed_ends = closed_ends - channel_drift[:,0]
+        open_ends = open_ends - channel_drift[:,0]
+
+    # get the channel locations of each image by fov, as arrays sorted by peak
+    fov_channels = {}
+    offsets = columns['channel_offsets']
+    for i in np.nonzero(use_image)[0]:
+        rows = slice(offsets[i], offsets[i+1])
+        fov_channels.setdefault(int(columns['fov'][i]), []).append((peaks[rows],
+                                                                    closed_ends[rows],
+                                                                    open_ends[rows]))
 
     # max width and length across all fovs. channels will get expanded by these values
     # this important for later updates to the masks, which should be the same
@@ -1432,79 +3894,30 @@ def make_masks(analyzed_imgs):
     max_chnl_mask_wid = 0
 
     # for each fov make a channel_mask dictionary from consensus mask
-    for fov in fovs:
-        # initialize a the dict and consensus mask
-        channel_masks_1fov = {} # dict which holds channel masks {peak : [[y1, y2],[x1,x2]],...}
-        consensus_mask = np.zeros([image_rows, image_cols]) # mask for labeling
-
-        # bring up information for each image
-        for img_k in analyzed_imgs.keys():
-            img_v = analyzed_imgs[img_k]
-            # skip this one if it is not of the current fov
-            if img_v['fov'] != fov:
-                continue
-
-            # for each channel in each image make a single mask
-            img_chnl_mask = np.zeros([image_rows, image_cols])
-
-            # and add the channel mask to it
-            for chnl_peak, peak_ends in six.iteritems(img_v['channels']):
-                # pull out the peak location and top and bottom location
-                # and expand by padding (more padding done later for width)
-                x1 = max(chnl_peak - crop_wp, 0)
-                x2 = min(chnl_peak + crop_wp, image_cols)
-                y1 = max(peak_ends['closed_end_px'] - chan_lp, 0)
-                y2 = min(peak_ends['open_end_px'] + chan_lp, image_rows)
-
-                # add it to the mask for this image
-                img_chnl_mask[y1:y2, x1:x2] = 1
-
-            # add it to the consensus mask
-            consensus_mask += img_chnl_mask
-
-        # Normalize concensus mask between 0 and 1.
-        consensus_mask = consensus_mask.astype('float32') / float(np.amax(consensus_mask))
-
-        # threshhold and homogenize each channel mask within the mask, label them
-        # label when value is above 0.1 (so 90% occupancy), transpose.
-        # the [0] is for the array ([1] is the number of regions)
-        # It transposes and then transposes again so regions are labeled left to right
-        # clear border it to make sure the channels are off the edge
-        consensus_mask = segmentation.clear_border(consensus_mask.T > 0.1)
-        consensus_mask = ndi.label(consensus_mask)[0].T
-
-        # go through each label
-        for label in np.unique(consensus_mask):
-            if label == 0: # label zero is the background
-                continue
-            binary_core = consensus_mask == label
-
-            # clean up the rough edges
-            poscols = np.any(binary_core, axis = 0) # column positions where true (any)
-            posrows = np.any(binary_core, axis = 1) # row positions where true (any)
-
-            # channel_id givin by horizontal position
-            # this is important. later updates to the positions will have to check
-            # if their channels contain this median value to match up
-            channel_id = int(np.median(np.where(poscols)[0]))
-
-            # store the edge locations of the channel mask in the dictionary. Will be ints
-            min_row = np.min(np.where(posrows)[0])
-            max_row = np.max(np.where(posrows)[0])
-            min_col = np.min(np.where(poscols)[0])
-            max_col = np.max(np.where(poscols)[0])
+    if params['num_analyzers'] > 1 and len(fov_channels) > 1:
+        pool = Pool(min(params['num_analyzers'], len(fov_channels)))
+        fov_results = {}
+        for fov, channels_list in six.iteritems(fov_channels):
+            fov_results[fov] = pool.apply_async(make_fov_channel_masks,
+                                                args=(channels_list, image_rows, image_cols,
+                                                      crop_wp, chan_lp))
+        pool.close()
+        pool.join()
+        fov_results = {fov : result.get() for fov, result in six.iteritems(fov_results)}
+    else:
+        fov_results = {fov : make_fov_channel_masks(channels_list, image_rows, image_cols,
+                                                    crop_wp, chan_lp)
+                       for fov, channels_list in six.iteritems(fov_channels)}
 
-            # if the min/max cols are within the image bounds,
-            # add the mask, as 4 points, to the dictionary
-            if min_col > 0 and max_col < image_cols:
-                channel_masks_1fov[channel_id] = [[min_row, max_row], [min_col, max_col]]
+    for fov in fov_channels.keys():
+        channel_masks_1fov, fov_mask_len, fov_mask_wid = fov_results[fov]
 
-                # find the largest channel width and height while you go round
-                max_chnl_mask_len = int(max(max_chnl_mask_len, max_row - min_row))
-                max_chnl_mask_wid = int(max(max_chnl_mask_wid, max_col - min_col))
+        # find the largest channel width and height
+        max_chnl_mask_len = int(max(max_chnl_mask_len, fov_mask_len))
+        max_chnl_mask_wid = int(max(max_chnl_mask_wid, fov_mask_wid))
 
-        # add channel_mask dictionary to the fov dictionary, use copy to play it safe
-        channel_masks[fov] = channel_masks_1fov.copy()
+        # add channel_mask dictionary to the fov dictionary
+        channel_masks[fov] = channel_masks_1fov
 
     # update all channel masks to be the max size
     cm_copy = channel_masks.copy()
@@ -1550,6 +3963,139 @@ def make_masks(analyzed_imgs):
 
     return cm_copy
 
+# counts for each pixel how many images have a channel there
+def make_fov_consensus_mask(channels_list, image_rows, image_cols, crop_wp, chan_lp):
+    '''Builds the consensus mask of one fov, the number of images in which each pixel is
+    inside a channel. Rather than painting a mask per image, the corners of every channel
+    rectangle are added to a difference array, which is integrated once with cumulative sums.
+    An image whose padded channels overlap is painted on its own so overlapping pixels
+    are only counted once for it, as when painting.
+
+    Parameters
+    channels_list : list
+        The 'channels' entry of the image metadata for each image of the fov, or for each
+        image a tuple of arrays (peaks, closed ends, open ends) sorted by peak.
+
+    Returns
+    consensus_mask : np.ndarray of int32
+    '''
+
+    # one extra row and column for the far edges of the rectangles
+    difference = np.zeros((image_rows + 1, image_cols + 1), dtype=np.int32)
+    consensus_mask = np.zeros((image_rows, image_cols), dtype=np.int32)
+
+    y1s, y2s, x1s, x2s = [], [], [], []
+    for channels in channels_list:
+        if len(channels) == 0:
+            continue
+
+        # pull out the peak location and top and bottom location
+        if isinstance(channels, dict):
+            peaks = np.array(sorted(channels.keys()), dtype=np.int64)
+            closed_ends = np.array([channels[peak]['closed_end_px'] for peak in peaks], dtype=np.int64)
+            open_ends = np.array([channels[peak]['open_end_px'] for peak in peaks], dtype=np.int64)
+        else:
+            peaks, closed_ends, open_ends = channels
+
+        # and expand by padding (more padding done later for width)
+        x1 = np.maximum(peaks - crop_wp, 0)
+        x2 = np.minimum(peaks + crop_wp, image_cols)
+        y1 = np.maximum(closed_ends - chan_lp, 0)
+        y2 = np.minimum(open_ends + chan_lp, image_rows)
+
+        # empty rectangles do not paint anything
+        keep = (x2 > x1) & (y2 > y1)
+        x1, x2, y1, y2 = x1[keep], x2[keep], y1[keep], y2[keep]
+
+        # channels in an image overlapping means the union has to be painted
+        if np.any(x1[1:] < x2[:-1]):
+            img_chnl_mask = np.zeros((image_rows, image_cols), dtype=bool)
+            for i in range(len(x1)):
+                img_chnl_mask[y1[i]:y2[i], x1[i]:x2[i]] = True
+            consensus_mask += img_chnl_mask
+            continue
+
+        y1s.append(y1)
+        y2s.append(y2)
+        x1s.append(x1)
+        x2s.append(x2)
+
+    if len(y1s) > 0:
+        y1s, y2s = np.concatenate(y1s), np.concatenate(y2s)
+        x1s, x2s = np.concatenate(x1s), np.concatenate(x2s)
+
+        # corners of the rectangles
+        np.add.at(difference, (y1s, x1s), 1)
+        np.add.at(difference, (y1s, x2s), -1)
+        np.add.at(difference, (y2s, x1s), -1)
+        np.add.at(difference, (y2s, x2s), 1)
+
+        consensus_mask += np.cumsum(np.cumsum(difference, axis=0), axis=1)[:image_rows, :image_cols]
+
+    return consensus_mask
+
+# makes the channel masks for one fov
+def make_fov_channel_masks(channels_list, image_rows, image_cols, crop_wp, chan_lp):
+    '''Makes the consensus channel masks of one fov, before they are resized to the
+    largest channel of all fovs.
+
+    Returns
+    channel_masks_1fov : dict
+        {peak : [[y1, y2],[x1,x2]],...}
+    max_chnl_mask_len, max_chnl_mask_wid : int
+        Largest channel length and width in this fov.
+
+    Called by
+    mm3.make_masks
+    '''
+
+    channel_masks_1fov = {} # dict which holds channel masks {peak : [[y1, y2],[x1,x2]],...}
+    max_chnl_mask_len = 0
+    max_chnl_mask_wid = 0
+
+    consensus_mask = make_fov_consensus_mask(channels_list, image_rows, image_cols, crop_wp, chan_lp)
+    if np.amax(consensus_mask) == 0:
+        return channel_masks_1fov, max_chnl_mask_len, max_chnl_mask_wid
+
+    # Normalize concensus mask between 0 and 1.
+    consensus_mask = consensus_mask.astype('float32') / float(np.amax(consensus_mask))
+
+    # threshhold and homogenize each channel mask within the mask, label them
+    # label when value is above 0.1 (so 90% occupancy), transpose.
+    # the [0] is for the array ([1] is the number of regions)
+    # It transposes and then transposes again so regions are labeled left to right
+    # clear border it to make sure the channels are off the edge
+    consensus_mask = segmentation.clear_border(consensus_mask.T > 0.1)
+    consensus_mask = ndi.label(consensus_mask)[0].T
+
+    # bounding box of each label, in label order
+    for label_slices in ndi.find_objects(consensus_mask):
+        if label_slices is None:
+            continue
+
+        # store the edge locations of the channel mask in the dictionary. Will be ints
+        min_row = label_slices[0].start
+        max_row = label_slices[0].stop - 1
+        min_col = label_slices[1].start
+        max_col = label_slices[1].stop - 1
+
+        # channel_id givin by horizontal position, the median of the columns of the channel.
+        # The columns of a connected region are contiguous so this is their middle.
+        # this is important. later updates to the positions will have to check
+        # if their channels contain this median value to match up
+        channel_id = int((min_col + max_col) / 2)
+
+        # if the min/max cols are within the image bounds,
+        # add the mask, as 4 points, to the dictionary
+        if min_col > 0 and max_col < image_cols:
+            channel_masks_1fov[channel_id] = [[min_row, max_row], [min_col, max_col]]
+
+            # find the largest channel width and height while you go round
+            max_chnl_mask_len = int(max(max_chnl_mask_len, max_row - min_row))
+            max_chnl_mask_wid = int(max(max_chnl_mask_wid, max_col - min_col))
+
+    return channel_masks_1fov, max_chnl_mask_len, max_chnl_mask_wid
+
 # get each fov_id, peak_id, frame's mask bounding box from bounding boxes arrived at by convolutional neural network
 def make_channel_masks_CNN(bboxes_dict):
     '''
@@ -1630,6 +4176,10 @@ def fix_orientation(image_data):
             # Pick the plane to analyze with the highest mean px value (should be phase)
             ph_channel = np.argmax([np.mean(image_data[ci]) for ci in range(image_data.shape[0])])
 
+        # a flat image is just the phase plane
+        if flat:
+            ph_channel = 0
+
         # flip based on the index of the higest average row value
         # this should be closer to the opening
         if np.argmax(image_data[ph_channel].mean(axis = 1)) < image_data[ph_channel].shape[0] / 2:
@@ -1639,7 +4189,7 @@ def fix_orientation(image_data):
 
     # flip if up is chosen
     elif image_orientation == "up":
-        return image_data[:,::-1,:]
+        image_data = image_data[:,::-1,:]
 
     # do not flip the images if "down is the specified image orientation"
     elif image_orientation == "down":
@@ -1651,7 +4201,7 @@ def fix_orientation(image_data):
     return image_data
 
 # cuts out channels from the image
-def cut_slice(image_data, channel_loc):
+def cut_slice(image_data, channel_loc, shift=None):
     '''Takes an image and cuts out the channel based on the slice location
     slice location is the list with the peak information, in the form
     [][y1, y2],[x1, x2]]. Returns the channel slice as a numpy array.
@@ -1668,8 +4218,15 @@ def cut_slice(image_data, channel_loc):
     image is and slice accordingly. It expects the images are in the order
     [t, x, y, c]. It assumes images with three dimensions are [x, y, c] not
     [t, x, y].
+
+    shift is the (y, x) drift of the image from find_fov_drift, which moves the slice
+    location by that much. For [t, x, y, c] stacks it can also be one shift per time point.
+    Parts of a shifted slice outside of the image are padded with the edge values.
     '''
 
+    if shift is not None:
+        return cut_shifted_slice(image_data, channel_loc, shift)
+
     # case where image is in form [x, y]
     if len(image_data.shape) == 2:
         # make slice object
@@ -1700,6 +4257,97 @@ def cut_slice(image_data, channel_loc):
 
     return channel_slice
 
+# cut_slice for a slice location moved by the drift of the image
+def cut_shifted_slice(image_data, channel_loc, shift):
+    # time points of a stack with their own shifts
+    if len(image_data.shape) == 4:
+        shift = np.asarray(shift)
+        if shift.ndim == 2:
+            return np.stack([cut_shifted_slice(image_data[t], channel_loc, shift[t])
+                             for t in range(image_data.shape[0])], axis=0)
+        return np.stack([cut_shifted_slice(frame, channel_loc, shift) for frame in image_data], axis=0)
+
+    y1, y2 = channel_loc[0][0] + int(shift[0]), channel_loc[0][1] + int(shift[0])
+    x1, x2 = channel_loc[1][0] + int(shift[1]), channel_loc[1][1] + int(shift[1])
+    rows, cols = image_data.shape[0], image_data.shape[1]
+
+    # the part of the slice inside the image
+    channel_slice = image_data[max(y1, 0):min(y2, rows), max(x1, 0):min(x2, cols)]
+    if channel_slice.size == 0:
+        return np.zeros((y2 - y1, x2 - x1) + image_data.shape[2:], dtype=image_data.dtype)
+
+    # pad the rest with the edge
+    paddings = [[max(-y1, 0), max(y2 - rows, 0)],
+                [max(-x1, 0), max(x2 - cols, 0)]] + [[0, 0]] * (len(image_data.shape) - 2)
+    if np.any(paddings):
+        channel_slice = np.pad(channel_slice, paddings, mode='edge')
+
+    return channel_slice
+
+# sums over every window of a given shape in an image. Along each axis the first window is
+# summed, and the following ones by adding the values that enter and removing those that leave.
+# Works over the last two axes, so a stack of images can be given
+def get_window_sums(image, window_shape):
+    h, w = window_shape
+    first = np.sum(image[..., :h, :], axis=-2, keepdims=True)
+    sums = np.concatenate([first, first + np.cumsum(image[..., h:, :] - image[..., :-h, :], axis=-2)], axis=-2)
+    first = np.sum(sums[..., :w], axis=-1, keepdims=True)
+    return np.concatenate([first, first + np.cumsum(sums[..., w:] - sums[..., :-w], axis=-1)], axis=-1)
+
+# normalized cross correlation of several templates against one image, using FFTs
+def batch_match_template(image, templates):
+    '''
+    Gives the same result as skimage.feature.match_template(image, template) for each
+    template, but the image FFT and window sums are only calculated once.
+
+    Parameters
+    ----------
+    image : 2D array
+    templates : 3D array
+        Templates of one shape (n, h, w), no larger than the image.
+
+    Returns
+    -------
+    responses : 3D array
+        Correlation of each template at every offset, (n, H - h + 1, W - w + 1).
+    '''
+
+    image = image.astype('float64')
+    templates = np.asarray(templates, dtype='float64')
+    n_templates, h, w = templates.shape
+    out_shape = (image.shape[0] - h + 1, image.shape[1] - w + 1)
+
+    # cross correlation through the FFT. The templates are zero padded to the image size,
+    # and offsets within out_shape never wrap around.
+    image_fft = np.fft.rfft2(image)
+    template_ffts = np.fft.rfft2(templates, s=image.shape)
+    xcorr = np.fft.irfft2(image_fft[np.newaxis] * np.conj(template_ffts), s=image.shape)
+    xcorr = xcorr[:, :out_shape[0], :out_shape[1]]
+
+    # normalize by the mean and variance of the image under each window and of each template
+    image_sums = get_window_sums(image, (h, w))
+    image_sums2 = get_window_sums(image**2, (h, w))
+    template_means = templates.mean(axis=(1, 2))
+    template_ssds = np.sum((templates - template_means[:, np.newaxis, np.newaxis])**2, axis=(1, 2))
+
+    numerator = xcorr - image_sums[np.newaxis] * template_means[:, np.newaxis, np.newaxis]
+    denominator = (image_sums2 - image_sums**2 / (h * w))[np.newaxis] * template_ssds[:, np.newaxis, np.newaxis]
+    denominator = np.sqrt(np.maximum(denominator, 0))
+
+    responses = np.zeros(numerator.shape)
+    mask = denominator > np.finfo('float64').eps
+    responses[mask] = numerator[mask] / denominator[mask]
+
+    return responses
+
+# path of the saved cross correlations for the given images
+def get_xcorr_cache_path(image_data, pad_size):
+    '''The name is a hash of the images and the padding, so changed images are recalculated.'''
+    key = hashlib.sha1()
+    key.update(str((image_data.shape, str(image_data.dtype), pad_size)).encode('utf8'))
+    key.update(np.ascontiguousarray(image_data).tobytes())
+    return os.path.join(params['ana_dir'], 'crosscorrs_cache', key.hexdigest() + '.npy')
+
 # calculate cross correlation between pixels in channel stack
 def channel_xcorr(fov_id, peak_id):
     '''
@@ -1709,6 +4357,10 @@ def channel_xcorr(fov_id, peak_id):
     correlation between that image and the first image.
 
     The very first value should be 1.
+
+    Only the sampled frames are read, and they are correlated all at once with
+    batch_match_template. Results are saved under a hash of those images, so they
+    are not calculated again for the same stack.
     '''
 
     pad_size = params['subtract']['alignment_pad']
@@ -1716,27 +4368,34 @@ def channel_xcorr(fov_id, peak_id):
     # Use this number of images to calculate cross correlations
     number_of_images = 20
 
-    # load the phase contrast images
-    image_data = load_stack(fov_id, peak_id, color=params['phase_plane'])
-
     # if there are more images than number_of_images, use number_of_images images evenly
     # spaced across the range
-    if image_data.shape[0] > number_of_images:
-        spacing = int(image_data.shape[0] / number_of_images)
-        image_data = image_data[::spacing,:,:]
-        if image_data.shape[0] > number_of_images:
-            image_data = image_data[:number_of_images,:,:]
+    frames = None
+    n_frames = get_stack_length(fov_id, peak_id, color=params['phase_plane'])
+    if n_frames > number_of_images:
+        spacing = int(n_frames / number_of_images)
+        frames = slice(0, spacing * number_of_images, spacing)
+
+    # load only those phase contrast images
+    image_data = load_stack(fov_id, peak_id, color=params['phase_plane'], frames=frames)
+
+    # use the saved results if these images were done before
+    cache_path = get_xcorr_cache_path(image_data, pad_size)
+    if os.path.isfile(cache_path):
+        try:
+            return np.load(cache_path).tolist()
+        except (IOError, ValueError): # partly written by another process
+            pass
 
     # we will compare all images to this one, needs to be padded to account for image drift
     first_img = np.pad(image_data[0,:,:], pad_size, mode='reflect')
 
-    xcorr_array = [] # array holds cross correlation vaues
-    for img in image_data:
-        # use match_template to find all cross correlations for the
-        # current image against the first image.
-        xcorr_array.append(np.max(match_template(first_img, img)))
+    # best cross correlation of each image against the first image
+    xcorr_array = np.amax(batch_match_template(first_img, image_data), axis=(1, 2))
+
+    save_npy_atomic(cache_path, xcorr_array)
 
-    return xcorr_array
+    return xcorr_array.tolist()
 
 ### functions about subtraction
 
@@ -1798,17 +4457,19 @@ def average_empties_stack(fov_id, specs, color='c1', align=True):
 
         information("%d empty channels designated for FOV %d." % (len(empty_stacks), fov_id))
 
-        # go through time points and create list of averaged empties
-        avg_empty_stack = [] # list will be later concatentated into numpy array
-        time_points = range(image_data.shape[0]) # index is time
-        for t in time_points:
-            # get images from one timepoint at a time and send to alignment and averaging
-            imgs = [stack[t] for stack in empty_stacks]
-            avg_empty = average_empties(imgs, align=align) # function is in mm3
-            avg_empty_stack.append(avg_empty)
+        # align every empty stack to the first one, all time points at once, the same way
+        # average_empties does it for one time point
+        if align:
+            pad_size = params['subtract']['alignment_pad']
+            subpixel = use_subpixel_alignment()
+            for n in range(1, len(empty_stacks)):
+                shifts = find_alignment_offsets(empty_stacks[0],
+                                                get_template_spectra(empty_stacks[n], pad_size),
+                                                subpixel=subpixel)
+                empty_stacks[n] = shift_stack(empty_stacks[n], shifts, subpixel=subpixel)
 
-        # concatenate list and then save out to tiff stack
-        avg_empty_stack = np.stack(avg_empty_stack, axis=0)
+        # average them per time point
+        avg_empty_stack = np.mean(np.stack(empty_stacks, axis=0), axis=0).astype('uint16')
 
     # save out data
     if params['output'] == 'TIFF':
@@ -1930,7 +4591,7 @@ def copy_empty_stack(from_fov, to_fov, color='c1'):
     information("Saved empty channel for FOV %d." % to_fov)
 
 # Do subtraction for an fov over many timepoints
-def subtract_fov_stack(fov_id, specs, color='c1', method='phase'):
+def subtract_fov_stack(fov_id, specs, color='c1', method='phase', pool=None):
     '''
     For a given FOV, loads the precomputed empty stack and does subtraction on
     all peaks in the FOV designated to be analyzed
@@ -1939,12 +4600,23 @@ def subtract_fov_stack(fov_id, specs, color='c1', method='phase'):
     ----------
     color : string, 'c1', 'c2', etc.
         This is the channel to subtraction. will be appended to the word empty.
+    pool : multiprocessing.Pool
+        If given, the empty stack is saved as a memory mapped file and each peak is
+        sent to the pool with subtract_peak_stack, so only the ids cross to the workers.
+        The same pool can be given for all FOVs. Pass the returned results to
+        finish_fov_subtraction once they are needed.
+
+    Returns
+    -------
+    True if the FOV was subtracted, False if it has no peaks to analyze. With a pool,
+    a dictionary of the AsyncResult of each peak instead of True.
 
     Called by
     mm3_Subtract.py
 
     Calls
-    mm3.subtract_phase
+    mm3.subtract_phase_stack
+    mm3.subtract_fluor_stack
 
     '''
 
@@ -1965,41 +4637,51 @@ def subtract_fov_stack(fov_id, specs, color='c1', method='phase'):
     if not ana_peak_ids:
         return False
 
+    # with a pool, the workers read the empty stack from a memory mapped file and load
+    # the channel stacks themselves
+    if pool is not None:
+        buffer_dir = get_subtraction_buffer_dir(fov_id, color)
+        if not os.path.exists(buffer_dir):
+            os.makedirs(buffer_dir)
+        np.save(os.path.join(buffer_dir, 'empty.npy'), avg_empty_stack)
+
+        peak_results = {}
+        for peak_id in ana_peak_ids:
+            peak_results[peak_id] = pool.apply_async(subtract_peak_stack,
+                                                     args=(fov_id, peak_id, color, method, buffer_dir))
+        return peak_results
+
+    # the empty stack is prepared for alignment once, and used for all channels
+    if method == 'phase':
+        empty_spectra = get_template_spectra(avg_empty_stack, params['subtract']['alignment_pad'])
+
     # load images for the peak and get phase images
     for peak_id in ana_peak_ids:
         information('Subtracting peak %d.' % peak_id)
 
         image_data = load_stack(fov_id, peak_id, color=color)
 
-        # make a list for all time points to send to a multiprocessing pool
-        # list will length of image_data with tuples (image, empty)
-        subtract_pairs = zip(image_data, avg_empty_stack)
-
-        # set up multiprocessing pool to do subtraction. Should wait until finished
-        pool = Pool(processes=params['num_analyzers'])
-
+        # all time points are aligned and subtracted at once
         if method == 'phase':
-            subtracted_imgs = pool.map(subtract_phase, subtract_pairs, chunksize=10)
+            subtracted_stack = subtract_phase_stack(image_data, avg_empty_stack, empty_spectra)
         elif method == 'fluor':
-            subtracted_imgs = pool.map(subtract_fluor, subtract_pairs, chunksize=10)
+            subtracted_stack = subtract_fluor_stack(image_data, avg_empty_stack)
 
-        pool.close() # tells the process nothing more will be added.
-        pool.join() # blocks script until everything has been processed and workers exit
-
-        # linear loop for debug
-        # subtracted_imgs = [subtract_phase(subtract_pair) for subtract_pair in subtract_pairs]
+        # save out the subtracted stack
+        save_subtracted_stack(fov_id, peak_id, color, subtracted_stack)
 
-        # stack them up along a time axis
-        subtracted_stack = np.stack(subtracted_imgs, axis=0)
+        information("Saved subtracted channel %d." % peak_id)
 
-        # save out the subtracted stack
-        if params['output'] == 'TIFF':
-            sub_filename = params['experiment_name'] + '_xy%03d_p%04d_sub_%s.tif' % (fov_id, peak_id, color)
-            tiff.imsave(os.path.join(params['sub_dir'],sub_filename), subtracted_stack, compress=4) # save it
+    return True
 
-        if params['output'] == 'HDF5':
-            h5f = h5py.File(os.path.join(params['hdf5_dir'],'xy%03d.hdf5' % fov_id), 'r+')
+# saves the subtracted stack of one channel
+def save_subtracted_stack(fov_id, peak_id, color, subtracted_stack):
+    if params['output'] == 'TIFF':
+        sub_filename = params['experiment_name'] + '_xy%03d_p%04d_sub_%s.tif' % (fov_id, peak_id, color)
+        tiff.imsave(os.path.join(params['sub_dir'],sub_filename), subtracted_stack, compress=4) # save it
 
+    if params['output'] == 'HDF5':
+        with h5py.File(os.path.join(params['hdf5_dir'],'xy%03d.hdf5' % fov_id), 'r+') as h5f:
             # put subtracted channel in correct group
             h5g = h5f['channel_%04d' % peak_id]
 
@@ -2013,12 +4695,269 @@ def subtract_fov_stack(fov_id, specs, color='c1', method='phase'):
                             maxshape=(None, subtracted_stack.shape[1], subtracted_stack.shape[2]),
                             compression="gzip", shuffle=True, fletcher32=True)
 
-        information("Saved subtracted channel %d." % peak_id)
+# smallest FFT size at least as large as each length, with only factors of 2, 3 and 5
+def get_fft_shape(shape):
+    fft_shape = []
+    for length in shape:
+        fft_length = max(length, 1)
+        while True:
+            remainder = fft_length
+            for factor in (2, 3, 5):
+                while remainder % factor == 0:
+                    remainder //= factor
+            if remainder == 1:
+                break
+            fft_length += 1
+        fft_shape.append(fft_length)
+    return tuple(fft_shape)
 
-    if params['output'] == 'HDF5':
-        h5f.close()
+# shapes for the FFTs of a stack of templates, for find_alignment_offsets
+def get_template_spectra(templates, pad_size):
+    '''
+    The FFT shape only needs to be found once, so the empty stack of a FOV is prepared
+    once and used for all of its channels. The templates are kept as they are, and
+    find_alignment_offsets transforms them block by block alongside the images, so the
+    FFTs of the whole stack are never held.
 
-    return True
+    Parameters
+    ----------
+    templates : 3D array
+        Stack of templates (t, y, x).
+    pad_size : int
+        Largest shift in pixels that will be looked for.
+
+    Returns
+    -------
+    template_spectra : dict
+        pad_size, template shape, FFT shape and the templates.
+    '''
+
+    h, w = templates.shape[1:]
+    fft_shape = get_fft_shape((h + 2 * pad_size, w + 2 * pad_size))
+
+    return {'pad_size' : pad_size,
+            'shape' : (h, w),
+            'fft_shape' : fft_shape,
+            'templates' : templates}
+
+# offsets of each template that best match each reflect padded image, found with FFTs
+def find_alignment_offsets(images, template_spectra, subpixel=False):
+    '''
+    Aligns a stack of templates to a stack of images frame by frame. Each image is reflect
+    padded by pad_size and the template of the same frame is matched against it, as
+    match_template(np.pad(image, pad_size, mode='reflect'), template) does. The normalized
+    cross correlation of all frames is calculated with one batch of FFTs (in blocks of
+    frames to limit memory), and only at the (2 * pad_size + 1)**2 offsets that are used.
+
+    Parameters
+    ----------
+    images : 3D array
+        Stack of images (t, y, x).
+    template_spectra : dict
+        From get_template_spectra, for templates of the same shape as the images and at
+        least as many frames.
+    subpixel : boolean
+        If True the position of each correlation peak is refined by fitting a parabola
+        through it and its neighbours along each axis.
+
+    Returns
+    -------
+    shifts : 2D array
+        (dy, dx) shift of each template relative to its image, (t, 2). Integers unless
+        subpixel is True.
+
+    Called by
+    subtract_phase_stack, average_empties_stack
+    '''
+
+    pad_size = template_spectra['pad_size']
+    h, w = template_spectra['shape']
+    fft_shape = template_spectra['fft_shape']
+    n_frames = len(images)
+    n_offsets = 2 * pad_size + 1
+    shifts = np.zeros((n_frames, 2))
+
+    # number of frames done together, so each array is at most about 32 MB
+    block_size = max(1, 2**22 // (fft_shape[0] * fft_shape[1]))
+
+    for start in range(0, n_frames, block_size):
+        stop = min(start + block_size, n_frames)
+        image_block = np.pad(images[start:stop],
+                             ((0, 0), (pad_size, pad_size), (pad_size, pad_size)), mode='reflect')
+        image_block = image_block.astype('float64')
+
+        # the templates of the block, mean subtracted, and their sums of squares
+        template_block = np.asarray(template_spectra['templates'][start:stop], dtype='float64')
+        template_block = template_block - template_block.mean(axis=(1, 2))[:, np.newaxis, np.newaxis]
+        template_ssds = np.sum(template_block**2, axis=(1, 2))[:, np.newaxis, np.newaxis]
+        template_ffts = np.conj(np.fft.rfft2(template_block, s=fft_shape, axes=(1, 2)))
+        del template_block
+
+        # cross correlation at all offsets within the padding, which never wrap around.
+        # Only the first rows are needed, so the inverse along x is only done for those
+        cross_power = np.fft.rfft2(image_block, s=fft_shape, axes=(1, 2)) * template_ffts
+        xcorr = np.fft.ifft(cross_power, axis=1)[:, :n_offsets]
+        xcorr = np.fft.irfft(xcorr, n=fft_shape[1], axis=2)[:, :, :n_offsets]
+
+        # normalize like match_template. The templates have a mean of 0, so the numerator
+        # is just the cross correlation
+        image_sums = get_window_sums(image_block, (h, w))
+        image_sums2 = get_window_sums(image_block**2, (h, w))
+        denominator = np.sqrt(np.maximum((image_sums2 - image_sums**2 / (h * w)) * template_ssds, 0))
+        responses = np.zeros(xcorr.shape)
+        mask = denominator > np.finfo('float64').eps
+        responses[mask] = xcorr[mask] / denominator[mask]
+
+        # position of the best correlation of each frame
+        best = np.argmax(responses.reshape(len(responses), -1), axis=1)
+        y, x = np.unravel_index(best, (n_offsets, n_offsets))
+        block_shifts = np.stack([y, x], axis=1).astype('float64')
+
+        if subpixel:
+            frames = np.arange(len(responses))
+            for axis, (peak, other) in enumerate([(y, x), (x, y)]):
+                # only peaks with a neighbour on both sides can be refined
+                inside = (peak > 0) & (peak < n_offsets - 1)
+                before = np.clip(peak - 1, 0, n_offsets - 1)
+                after = np.clip(peak + 1, 0, n_offsets - 1)
+                if axis == 0:
+                    c_before, c_peak, c_after = (responses[frames, before, other],
+                                                 responses[frames, peak, other],
+                                                 responses[frames, after, other])
+                else:
+                    c_before, c_peak, c_after = (responses[frames, other, before],
+                                                 responses[frames, other, peak],
+                                                 responses[frames, other, after])
+                curvature = c_before - 2 * c_peak + c_after
+                inside &= curvature < 0
+                delta = np.zeros(len(responses))
+                delta[inside] = 0.5 * (c_before[inside] - c_after[inside]) / curvature[inside]
+                block_shifts[:, axis] += np.clip(delta, -0.5, 0.5)
+
+        shifts[start:stop] = block_shifts
+
+    # match positions are relative to the top left corner of the padded image
+    return shifts - pad_size
+
+# shifts each image of a stack, filling the edges by reflection
+def shift_stack(stack, shifts, subpixel=False):
+    '''
+    Frame t of the returned stack is frame t of stack moved down by shifts[t, 0] and right
+    by shifts[t, 1]. The pixels moved in at the edges are the reflection of the image, as
+    with np.pad(..., mode='reflect').
+
+    Parameters
+    ----------
+    stack : 3D array
+        Stack of images (t, y, x).
+    shifts : 2D array
+        (dy, dx) shift of each image, (t, 2), from find_alignment_offsets.
+    subpixel : boolean
+        If True the images are moved by the fractional shifts with linear interpolation,
+        frame by frame. Otherwise the shifts are rounded to whole pixels and all frames
+        are moved at once.
+
+    Returns
+    -------
+    shifted_stack : 3D array
+        Same shape and type as stack.
+    '''
+
+    if subpixel:
+        shifted_stack = np.empty(stack.shape, dtype=stack.dtype)
+        for t in range(len(stack)):
+            # scipy's 'mirror' is the same reflection as np.pad's 'reflect'
+            shifted = ndi.shift(np.asarray(stack[t], dtype='float64'), shifts[t], order=1, mode='mirror')
+            if np.issubdtype(stack.dtype, np.integer):
+                shifted = np.round(shifted)
+            shifted_stack[t] = shifted
+        return shifted_stack
+
+    n_frames, h, w = stack.shape
+    shifts = np.round(shifts).astype('int64')
+    max_shift = int(np.max(np.abs(shifts))) if len(shifts) else 0
+    padded = np.pad(stack, ((0, 0), (max_shift, max_shift), (max_shift, max_shift)), mode='reflect')
+
+    # rows and columns of the padded stack which end up in each frame
+    rows = max_shift - shifts[:, 0, np.newaxis] + np.arange(h)
+    columns = max_shift - shifts[:, 1, np.newaxis] + np.arange(w)
+
+    return padded[np.arange(n_frames)[:, np.newaxis, np.newaxis],
+                  rows[:, :, np.newaxis], columns[:, np.newaxis, :]]
+
+# checks the subpixel_alignment parameter
+def use_subpixel_alignment():
+    return 'subpixel_alignment' in params['subtract'] and bool(params['subtract']['subpixel_alignment'])
+
+# subtracts a phase contrast channel stack from the empty stack, all frames at once
+def subtract_phase_stack(image_stack, empty_stack, empty_spectra=None):
+    '''
+    Stack version of subtract_phase. The empty channel of each frame is aligned to the
+    channel with find_alignment_offsets, moved with shift_stack, and the channel is
+    subtracted from it. Negative values are set to 0. Frames without an empty are dropped,
+    as before.
+
+    Parameters
+    ----------
+    image_stack : 3D array
+        Phase contrast channel stack (t, y, x).
+    empty_stack : 3D array
+        Averaged empty stack of the FOV, with images of the same size.
+    empty_spectra : dict
+        get_template_spectra of the empty stack. Pass it when subtracting several channels
+        with the same empty stack, otherwise it is calculated here.
+
+    Returns
+    -------
+    subtracted_stack : 3D array, uint16
+
+    Called by
+    subtract_fov_stack
+    '''
+
+    n_frames = min(len(image_stack), len(empty_stack))
+    image_stack = image_stack[:n_frames]
+    empty_stack = empty_stack[:n_frames]
+
+    if empty_spectra is None:
+        empty_spectra = get_template_spectra(empty_stack, params['subtract']['alignment_pad'])
+    subpixel = use_subpixel_alignment()
+    shifts = find_alignment_offsets(image_stack, empty_spectra, subpixel=subpixel)
+    aligned_empties = shift_stack(empty_stack, shifts, subpixel=subpixel)
+
+    subtracted_stack = aligned_empties.astype('int32') - image_stack.astype('int32')
+    subtracted_stack[subtracted_stack < 0] = 0
+
+    return subtracted_stack.astype('uint16')
+
+# subtracts the empty stack from a fluorescence channel stack, all frames at once
+def subtract_fluor_stack(image_stack, empty_stack):
+    '''
+    Stack version of subtract_fluor. There is no alignment. If the empty images are a
+    different size they are edge padded or cut to the size of the channel images.
+
+    Called by
+    subtract_fov_stack
+    '''
+
+    n_frames = min(len(image_stack), len(empty_stack))
+    image_stack = image_stack[:n_frames]
+    empty_stack = empty_stack[:n_frames]
+
+    crop_size = image_stack.shape[1:3]
+    pad_rows = max(crop_size[0] - empty_stack.shape[1], 0)
+    pad_columns = max(crop_size[1] - empty_stack.shape[2], 0)
+    if pad_rows or pad_columns:
+        empty_stack = np.pad(empty_stack,
+                             [[0, 0], [pad_rows // 2, pad_rows - pad_rows // 2],
+                              [pad_columns // 2, pad_columns - pad_columns // 2]]
+                             + [[0, 0]] * (empty_stack.ndim - 3), 'edge')
+    empty_stack = empty_stack[:, :crop_size[0], :crop_size[1]]
+
+    subtracted_stack = image_stack.astype('int32') - empty_stack.astype('int32')
+    subtracted_stack[subtracted_stack < 0] = 0
+
+    return subtracted_stack.astype('uint16')
 
 # subtracts one phase contrast image from another.
 def subtract_phase(image_pair):
@@ -2116,6 +5055,94 @@ def subtract_fluor(image_pair):
 
     return channel_subtracted
 
+### subtraction in a pool
+# subtract_fov_stack saves the empty stack of a FOV to a buffer directory and sends one task
+# per channel to a pool that is kept for the whole run, so channels of all FOVs are worked
+# on together. Workers memory map the empty stack and load the channel stacks themselves.
+# TIFF stacks are saved by the workers. HDF5 stacks are passed back as memory mapped files
+# and saved by finish_fov_subtraction in the main process, as the FOV file can only be
+# written by one process, and only once all channels of that FOV are done.
+
+# directory for the memory mapped buffers of one FOV
+def get_subtraction_buffer_dir(fov_id, color):
+    return os.path.join(params['ana_dir'], 'subtract_buffers', 'xy%03d_%s' % (fov_id, color))
+
+# subtracts one channel, in a pool worker
+def subtract_peak_stack(fov_id, peak_id, color, method, buffer_dir):
+    '''
+    Loads the channel stack and the memory mapped empty stack from buffer_dir and
+    subtracts them.
+
+    Returns
+    -------
+    None if the subtracted stack was saved (TIFF), or the path of the memory mapped
+    subtracted stack to be saved by finish_fov_subtraction (HDF5).
+
+    Called by
+    subtract_fov_stack, through a pool
+    '''
+
+    empty_stack = np.load(os.path.join(buffer_dir, 'empty.npy'), mmap_mode='r')
+    image_data = load_stack(fov_id, peak_id, color=color)
+
+    if method == 'phase':
+        subtracted_stack = subtract_phase_stack(image_data, empty_stack)
+    elif method == 'fluor':
+        subtracted_stack = subtract_fluor_stack(image_data, empty_stack)
+
+    if params['output'] == 'HDF5':
+        sub_path = os.path.join(buffer_dir, 'p%04d_sub.npy' % peak_id)
+        np.save(sub_path, subtracted_stack)
+        return sub_path
+
+    save_subtracted_stack(fov_id, peak_id, color, subtracted_stack)
+    return None
+
+# waits for the channels of one FOV sent to a pool by subtract_fov_stack and saves them
+def finish_fov_subtraction(fov_id, peak_results, color='c1'):
+    '''
+    Parameters
+    ----------
+    fov_id : int
+    peak_results : dict
+        AsyncResult of each peak, returned by subtract_fov_stack.
+    color : string
+        Same color as given to subtract_fov_stack.
+
+    Returns
+    -------
+    True if all channels were subtracted.
+
+    Called by
+    mm3_Subtract.py
+    '''
+
+    all_successful = True
+    for peak_id in sorted(peak_results.keys()):
+        result = peak_results[peak_id]
+        result.wait()
+        if not result.successful():
+            try:
+                result.get()
+            except Exception as e:
+                warning('Subtraction failed for FOV %d peak %d: %s' % (fov_id, peak_id, e))
+            all_successful = False
+            continue
+
+        sub_path = result.get()
+        if sub_path is not None:
+            save_subtracted_stack(fov_id, peak_id, color, np.load(sub_path, mmap_mode='r'))
+        information("Saved subtracted channel %d." % peak_id)
+
+    buffer_dir = get_subtraction_buffer_dir(fov_id, color)
+    shutil.rmtree(buffer_dir, ignore_errors=True)
+    try:
+        os.rmdir(os.path.dirname(buffer_dir)) # only removed once it is empty
+    except OSError:
+        pass
+
+    return all_successful
+
 ### functions that deal with segmentation and lineages
 
 # Do segmentation for an channel time stack
@@ -3237,7 +6264,7 @@ def make_lineage_chnl_stack(fov_and_peak_id):
     fov_id, peak_id = fov_and_peak_id
 
     # start time is the first time point for this series of TIFFs.
-    start_time_index = min(params['time_table'][fov_id].keys())
+    start_time_index = params['time_table'].first_t(fov_id)
 
     information('Creating lineage for FOV %d, channel %d.' % (fov_id, peak_id))
 
@@ -3522,7 +6549,7 @@ class Cell():
 
         # the following information is on a per timepoint basis
         self.times = [t]
-        self.abs_times = [params['time_table'][self.fov][t]] # elapsed time in seconds
+        self.abs_times = [params['time_table'].lookup(self.fov, t)] # elapsed time in seconds
         self.labels = [region.label]
         self.bboxes = [region.bbox]
         self.areas = [region.area]
@@ -3565,7 +6592,7 @@ class Cell():
         use cell.times[-1] to get most current value'''
 
         self.times.append(t)
-        self.abs_times.append(params['time_table'][self.fov][t])
+        self.abs_times.append(params['time_table'].lookup(self.fov, t))
         self.labels.append(region.label)
         self.bboxes.append(region.bbox)
         self.areas.append(region.area)
@@ -3601,7 +6628,7 @@ class Cell():
 
         # update times
         self.times_w_div = self.times + [self.division_time]
-        self.abs_times.append(params['time_table'][self.fov][self.division_time])
+        self.abs_times.append(params['time_table'].lookup(self.fov, self.division_time))
 
         # flesh out the stats for this cell
         # size at birth
@@ -3749,7 +6776,7 @@ class CellFromGraph():
 
         # the following information is on a per timepoint basis
         self.times = [t]
-        self.abs_times = [params['time_table'][self.fov][t]] # elapsed time in seconds
+        self.abs_times = [params['time_table'].lookup(self.fov, t)] # elapsed time in seconds
         self.labels = [region.label]
         self.bboxes = [region.bbox]
         self.areas = [region.area]
@@ -3803,7 +6830,7 @@ class CellFromGraph():
         use cell.times[-1] to get most current value'''
 
         self.times.append(t)
-        self.abs_times.append(params['time_table'][self.fov][t])
+        self.abs_times.append(params['time_table'].lookup(self.fov, t))
         self.labels.append(region.label)
         self.bboxes.append(region.bbox)
         self.areas.append(region.area)
@@ -3857,7 +6884,7 @@ class CellFromGraph():
 
         # update times
         self.times_w_div = self.times + [self.division_time]
-        self.abs_times.append(params['time_table'][self.fov][self.division_time])
+        self.abs_times.append(params['time_table'].lookup(self.fov, self.division_time))
 
         # flesh out the stats for this cell
         # size at birth
@@ -4059,7 +7086,7 @@ class Focus():
 
         # the following information is on a per timepoint basis
         self.times = [t]
-        self.abs_times = [params['time_table'][cell.fov][t]] # elapsed time in seconds
+        self.abs_times = [params['time_table'].lookup(cell.fov, t)] # elapsed time in seconds
         self.labels = [region.label]
         self.bboxes = [region.bbox]
         self.areas = [region.area]
@@ -4122,7 +7149,7 @@ class Focus():
             self.add_cell(current_cell)
 
         self.times.append(t)
-        self.abs_times.append(params['time_table'][self.cells[-1].fov][t])
+        self.abs_times.append(params['time_table'].lookup(self.cells[-1].fov, t))
         self.labels.append(region.label)
         self.bboxes.append(region.bbox)
         self.areas.append(region.area)
@@ -5859,13 +8886,7 @@ def find_cell_intensities(fov_id, peak_id, Cells, midline=False, channel_name='s
     seg_stack = load_stack(fov_id, peak_id, color='seg_unet')
 
     # determine absolute time index
-    times_all = []
-    for fov in params['time_table']:
-        times_all = np.append(times_all, time_table[fov].keys())
-    times_all = np.unique(times_all)
-    times_all = np.sort(times_all)
-    times_all = np.array(times_all,np.int_)
-    t0 = times_all[0] # first time index
+    t0 = params['time_table'].first_t() # first time index
 
     # Loop through cells
     for Cell in Cells.values():
@@ -5921,13 +8942,7 @@ def foci_analysis(fov_id, peak_id, Cells):
                                color='sub_{}'.format(params['foci']['foci_plane']))
 
     # determine absolute time index
-    times_all = []
-    for fov, times in params['time_table'].items():
-        times_all = np.append(times_all, list(times.keys()))
-    times_all = np.unique(times_all)
-    times_all = np.sort(times_all)
-    times_all = np.array(times_all, np.int_)
-    t0 = times_all[0] # first time index
+    t0 = params['time_table'].first_t() # first time index
 
     for cell_id, cell in six.iteritems(Cells):
 
@@ -5999,9 +9014,8 @@ def foci_analysis_pool(fov_id, peak_id, Cells):
                                color='sub_{}'.format(params['foci']['foci_plane']))
 
     # Load time table to determine first image index.
-    times_all = np.array(np.sort(params['time_table'][fov_id].keys()), np.int_)
-    t0 = times_all[0] # first time index
-    tN = times_all[-1] # last time index
+    t0 = params['time_table'].first_t(fov_id) # first time index
+    tN = params['time_table'].last_t(fov_id) # last time index
 
     # call foci_cell for each cell object
     pool = Pool(processes=params['num_analyzers'])
@@ -6267,7 +9281,7 @@ def foci_info_unet(foci, Cells, specs, time_table, channel_name='sub_c2'):
     Cells : dictionary of Cell objects to which foci will be added
     specs : dictionary containing information on which fov/peak ids
         are to be used, and which are to be excluded from analysis
-    time_table : dictionary containing information on which time
+    time_table : TimeTable containing information on which time
         points correspond to which absolute times in seconds
     channel_name : name of fluorescent channel for reading in
         fluorescence images for focus quantification
@@ -6586,8 +9600,7 @@ def ring_analysis(fov_id, peak_id, Cells, ring_plane='c2'):
 
     # Load time table to determine first image index.
     time_table = load_time_table()
-    times_all = np.array(np.sort(time_table[fov_id].keys()), np.int_)
-    t0 = times_all[0] # first time index
+    t0 = time_table.first_t(fov_id) # first time index
 
     # Loop through cells
     for Cell in Cells.values():
@@ -6686,13 +9699,7 @@ def profile_analysis(fov_id, peak_id, Cells, profile_plane='c2'):
 
     # Load time table to determine first image index.
     # load_time_table()
-    times_all = []
-    for fov in params['time_table']:
-        times_all = np.append(times_all, list(params['time_table'][fov].keys()))
-    times_all = np.unique(times_all)
-    times_all = np.sort(times_all)
-    times_all = np.array(times_all,np.int_)
-    t0 = times_all[0] # first time index
+    t0 = params['time_table'].first_t() # first time index
 
     # Loop through cells
     for Cell in Cells.values():
@@ -6763,7 +9770,7 @@ def x_profile_analysis(fov_id, peak_id, Cells, profile_plane='sub_c2'):
 
     # Load time table to determine first image index.
     time_table = load_time_table()
-    t0 = times_all[0] # first time index
+    t0 = time_table.first_t() # first time index
 
     # Loop through cells
     for Cell in Cells.values():
@@ -6864,7 +9871,7 @@ def constriction_analysis(fov_id, peak_id, Cells, plane='sub_c1'):
 
     # Load time table to determine first image index.
     time_table = load_time_table()
-    t0 = times_all[0] # first time index
+    t0 = time_table.first_t() # first time index
 
     # Loop through cells
     for Cell in Cells.values():
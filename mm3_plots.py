@@ -3357,16 +3357,12 @@ def plot_lineage_images(Cells, fov_id, peak_id, Cells2=None, bgcolor='c1', fgcol
     # filter cells
     Cells = find_cells_of_fov_and_peak(Cells, fov_id, peak_id)
 
-    # load subtracted and segmented data
-    image_data_bg = mm3.load_stack(fov_id, peak_id, color=bgcolor)
+    # load subtracted and segmented data, only reading the time window if trimming
+    frames = slice(time_set[0], time_set[1]) if trim_time else None
+    image_data_bg = mm3.load_stack(fov_id, peak_id, color=bgcolor, frames=frames)
 
     if fgcolor:
-        image_data_seg = mm3.load_stack(fov_id, peak_id, color=fgcolor)
-
-    if trim_time:
-        image_data_bg = image_data_bg[time_set[0]:time_set[1]]
-        if fgcolor:
-            image_data_seg = image_data_seg[time_set[0]:time_set[1]]
+        image_data_seg = mm3.load_stack(fov_id, peak_id, color=fgcolor, frames=frames)
 
     n_imgs = image_data_bg.shape[0]
     image_indicies = range(n_imgs)